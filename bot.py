@@ -1,15 +1,36 @@
 import asyncio
+import html
+import itertools
+import json
 import logging
+import math
 import os
-from typing import Optional, Tuple
-from aiogram import Router, F, Bot, Dispatcher, types
+import re
+import secrets
+import signal
+import socket
+import time
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from typing import Any, Dict, Optional, Tuple
+from aiogram import BaseMiddleware, Router, F, Bot, Dispatcher, types
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.methods import AnswerCallbackQuery
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramConflictError, TelegramEntityTooLarge, TelegramForbiddenError,
+    TelegramNetworkError, TelegramNotFound, TelegramRetryAfter, TelegramServerError, TelegramUnauthorizedError,
+)
 from aiogram.filters import Command, CommandStart
 from aiogram.types import Message
+from aiogram.types.update import UpdateTypeLookupError
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.utils.keyboard import ReplyKeyboardBuilder
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 import asyncpg
 from contextlib import asynccontextmanager
 from dotenv import load_dotenv
@@ -25,6 +46,74 @@ TOKEN = os.getenv("BOT_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
 
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Публичный адрес вебхука; на Railway по умолчанию берём выданный домен.
+# Без адреса сервер поднимается, но вебхук не регистрируется (локальная отладка)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") or (
+    f"https://{os.getenv('RAILWAY_PUBLIC_DOMAIN')}" if os.getenv("RAILWAY_PUBLIC_DOMAIN") else None
+)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEB_SERVER_HOST = os.getenv("WEB_SERVER_HOST", "0.0.0.0")
+WEB_SERVER_PORT = int(os.getenv("PORT", "8080"))
+# /metrics слушает отдельно от публичного вебхука: по умолчанию только localhost
+# (на Railway для сбора по внутренней сети — METRICS_HOST=::)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9091"))
+
+if BOT_MODE not in ("polling", "webhook"):
+    raise ValueError(f"❌ Неизвестный BOT_MODE: {BOT_MODE} (ожидается polling или webhook)")
+
+# Хранилище FSM: postgres (по умолчанию), redis (нужен REDIS_URL и пакет redis) или memory
+FSM_STORAGE = os.getenv("FSM_STORAGE", "postgres")
+REDIS_URL = os.getenv("REDIS_URL")
+
+# Период фонового подбора пар (секунды)
+MATCH_SCHEDULER_INTERVAL = float(os.getenv("MATCH_SCHEDULER_INTERVAL", "3"))
+# Период сброса накопленных счётчиков сообщений в БД (секунды)
+MESSAGE_COUNT_FLUSH_INTERVAL = float(os.getenv("MESSAGE_COUNT_FLUSH_INTERVAL", "10"))
+# Период пакетной записи users.last_seen (секунды)
+PRESENCE_FLUSH_INTERVAL = float(os.getenv("PRESENCE_FLUSH_INTERVAL", "60"))
+# Период сверки счётчиков /stats с БД (секунды)
+STATS_RECONCILE_INTERVAL = float(os.getenv("STATS_RECONCILE_INTERVAL", "600"))
+# Обновления дольше порога (миллисекунды) логируются с разбивкой времени
+SLOW_UPDATE_THRESHOLD_MS = float(os.getenv("SLOW_UPDATE_THRESHOLD_MS", "500"))
+# Размер пула asyncpg; обновление держит одно соединение от первого запроса до запроса к Bot API
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+# Отправка уведомлений после коммита: число воркеров и попыток на сообщение
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+# Сколько обновлений одного пользователя может ждать своей очереди; лишние отбрасываются
+USER_QUEUE_LIMIT = int(os.getenv("USER_QUEUE_LIMIT", "20"))
+# Фоновая очистка: период (секунды), размер пачки и число пачек на таблицу за проход
+JANITOR_INTERVAL = float(os.getenv("JANITOR_INTERVAL", "300"))
+JANITOR_BATCH_SIZE = int(os.getenv("JANITOR_BATCH_SIZE", "500"))
+JANITOR_MAX_BATCHES = int(os.getenv("JANITOR_MAX_BATCHES", "20"))
+# Сколько часов можно висеть в очереди поиска без активности в боте, прежде чем поиск снимается
+SEARCH_QUEUE_TTL_HOURS = float(os.getenv("SEARCH_QUEUE_TTL_HOURS", "6"))
+# Сколько пользователей без премиума помнить в кэше, не обращаясь к БД
+PREMIUM_NEGATIVE_CACHE_SIZE = int(os.getenv("PREMIUM_NEGATIVE_CACHE_SIZE", "50000"))
+# Сколько профилей пользователей держать в памяти
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "50000"))
+# Несколько реплик на одной БД: события через LISTEN/NOTIFY, подбор и очистка — только у лидера
+CLUSTER_MODE = os.getenv("CLUSTER_MODE", "0") == "1"
+NODE_ID = os.getenv("NODE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+# Как часто реплика пытается стать лидером и проверяет соединение кластера (секунды)
+LEADER_RETRY_INTERVAL = float(os.getenv("LEADER_RETRY_INTERVAL", "5"))
+# Сколько ждать, пока другая реплика отпустит пользователя, прежде чем обработать обновление без блокировки
+USER_LOCK_TIMEOUT = float(os.getenv("USER_LOCK_TIMEOUT", "10"))
+# Сколько отдельных соединений держать под блокировки пользователей (захваты на одном идут по очереди)
+USER_LOCK_CONNECTIONS = int(os.getenv("USER_LOCK_CONNECTIONS", "4"))
+
+# Лимиты Bot API: общий, на личный чат и на группу (сообщений в секунду)
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_GROUP_RATE = float(os.getenv("TELEGRAM_GROUP_RATE", str(20 / 60)))
+# Сколько сообщений подряд можно отправить в личный чат без ожидания (ответ из нескольких сообщений)
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+
 if not TOKEN:
     raise ValueError("❌ BOT_TOKEN не найден в .env файле")
 if not DATABASE_URL:
@@ -37,6 +126,1533 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+# ========== ОЧЕРЕДЬ ПОИСКА 1-НА-1 В ПАМЯТИ ==========
+class Matchmaker:
+    """FIFO-очереди поиска по (пол, целевой пол) — подбор партнёра за O(1) без запросов к БД"""
+
+    GENDERS = ('male', 'female')
+
+    def __init__(self):
+        # (пол, целевой пол) -> {telegram_id: порядковый номер постановки}
+        self._buckets = {}
+        # telegram_id -> (пол, целевой пол, порядковый номер постановки)
+        self._entries = {}
+        self._seq = itertools.count()
+        # telegram_id, чьё место в очереди менялось с track_changes(); None — не отслеживаем
+        self._changed: Optional[set] = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, telegram_id: int) -> bool:
+        return telegram_id in self._entries
+
+    def add(self, telegram_id: int, gender: str, target_gender: Optional[str] = None):
+        """Поставить в конец очереди (повторная постановка сбрасывает место)"""
+        self.remove(telegram_id)
+        self._put(telegram_id, (gender, target_gender, next(self._seq)))
+
+    def remove(self, telegram_id: int) -> Optional[tuple]:
+        """Убрать из очереди, вернуть запись (для отката)"""
+        if self._changed is not None:
+            self._changed.add(telegram_id)
+        entry = self._entries.pop(telegram_id, None)
+        if entry:
+            self._buckets[entry[:2]].pop(telegram_id, None)
+        return entry
+
+    def restore(self, telegram_id: int, entry: tuple):
+        """Вернуть запись на её прежнее место в очереди (откат неудачного соединения)"""
+        if telegram_id in self._entries:
+            return
+        bucket = self._buckets.get(entry[:2])
+        out_of_order = bool(bucket) and next(reversed(bucket.values())) > entry[2]
+        self._put(telegram_id, entry)
+        if out_of_order:
+            # Запись вернулась не в хвост — восстанавливаем порядок (редкий путь)
+            bucket = self._buckets[entry[:2]]
+            ordered = sorted(bucket.items(), key=lambda item: item[1])
+            bucket.clear()
+            bucket.update(ordered)
+
+    def entry(self, telegram_id: int) -> Optional[tuple]:
+        """(пол, целевой пол, порядковый номер) или None, если не в очереди"""
+        return self._entries.get(telegram_id)
+
+    def track_changes(self):
+        """Начать запоминать, кто вставал в очередь и уходил из неё (на время перечитывания из БД)"""
+        self._changed = set()
+
+    def changed(self) -> set:
+        """Закончить отслеживание и вернуть изменившихся с track_changes()"""
+        changed, self._changed = self._changed or set(), None
+        return changed
+
+    def bucket_sizes(self) -> Dict[tuple, int]:
+        """(пол, целевой пол) -> число ожидающих"""
+        return {key: len(bucket) for key, bucket in self._buckets.items()}
+
+    def waiting(self) -> list:
+        """telegram_id всех ожидающих в порядке постановки в очередь"""
+        return [telegram_id for telegram_id, _ in sorted(self._entries.items(), key=lambda item: item[1][2])]
+
+    def _put(self, telegram_id: int, entry: tuple):
+        if self._changed is not None:
+            self._changed.add(telegram_id)
+        self._entries[telegram_id] = entry
+        self._buckets.setdefault(entry[:2], OrderedDict())[telegram_id] = entry[2]
+
+    def _candidate_tiers(self, gender: str, target_gender: Optional[str]) -> list:
+        """Корзины кандидатов по приоритету; внутри уровня выигрывает дольше всех ждущий"""
+        if target_gender is None:
+            # Обычный поиск: любой случайный или тот, кто ищет именно мой пол
+            return [[(g, None) for g in self.GENDERS] + [(g, gender) for g in self.GENDERS]]
+
+        # Гендерный поиск: сначала взаимные
+        tiers = [[(target_gender, gender)]]
+        if gender != target_gender:
+            # Однополый поиск ждёт только взаимных, иначе — случайные нужного пола
+            tiers.append([(target_gender, None)])
+        return tiers
+
+    def _head(self, key: tuple, exclude: int) -> Optional[Tuple[int, int]]:
+        for telegram_id, seq in self._buckets.get(key, {}).items():
+            if telegram_id != exclude:
+                return telegram_id, seq
+        return None
+
+    def find(self, telegram_id: int) -> Optional[int]:
+        """Подобрать партнёра, не меняя очередь"""
+        entry = self._entries.get(telegram_id)
+        if not entry:
+            return None
+
+        gender, target_gender, _ = entry
+        for tier in self._candidate_tiers(gender, target_gender):
+            best = None
+            for key in tier:
+                head = self._head(key, telegram_id)
+                if head and (best is None or head[1] < best[1]):
+                    best = head
+            if best:
+                return best[0]
+        return None
+
+    def pop_pair(self, telegram_id: int) -> Optional[Tuple[int, tuple, tuple]]:
+        """Подобрать партнёра и снять обоих с очереди: (partner_id, моя запись, запись партнёра)"""
+        partner_id = self.find(telegram_id)
+        if partner_id is None:
+            return None
+        return partner_id, self.remove(telegram_id), self.remove(partner_id)
+
+
+# ========== СЧЁТЧИКИ СООБЩЕНИЙ (ОТЛОЖЕННАЯ ЗАПИСЬ) ==========
+class MessageCounter:
+    """Буфер приращений chat_sessions.message_count по session_id"""
+
+    def __init__(self):
+        self._pending = {}
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def increment(self, session_id: int, count: int = 1):
+        self._pending[session_id] = self._pending.get(session_id, 0) + count
+
+    def drain(self) -> Tuple[list, list]:
+        """Забрать накопленное: (session_ids, приращения)"""
+        pending, self._pending = self._pending, {}
+        return list(pending.keys()), list(pending.values())
+
+
+class PresenceTracker:
+    """Последняя активность пользователей до пакетной записи users.last_seen"""
+
+    def __init__(self):
+        self._seen = {}
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def touch(self, telegram_id: int):
+        # naive UTC — как и остальные TIMESTAMP, которые пишет бот
+        self._seen[telegram_id] = datetime.now(timezone.utc).replace(tzinfo=None)
+
+    def drain(self) -> Tuple[list, list]:
+        """Забрать накопленное: (telegram_ids, время) в порядке telegram_id"""
+        seen, self._seen = self._seen, {}
+        telegram_ids = sorted(seen)
+        return telegram_ids, [seen[telegram_id] for telegram_id in telegram_ids]
+
+    def restore(self, telegram_ids: list, seen_at: list):
+        """Вернуть несохранённое, не затирая более свежие отметки"""
+        for telegram_id, moment in zip(telegram_ids, seen_at):
+            self._seen.setdefault(telegram_id, moment)
+
+
+# ========== МАРШРУТЫ ПЕРЕСЫЛКИ ==========
+class ChatRoute:
+    """Куда пересылать сообщения пользователя: собеседник(и), сессия или группа"""
+
+    __slots__ = ('partners', 'session_id', 'group_id')
+
+    def __init__(self, partners: list, session_id: Optional[int] = None, group_id: Optional[int] = None):
+        self.partners = partners
+        self.session_id = session_id
+        self.group_id = group_id
+
+
+class RoutingTable:
+    """Маршруты активных чатов в памяти: telegram_id -> ChatRoute.
+
+    Заполняется при соединении, сбрасывается явно при выходе из чата;
+    при промахе Database.get_route подгружает маршрут из БД.
+    """
+
+    def __init__(self):
+        self._routes = {}
+        # telegram_id -> кто пересылает ему сообщения (у кого он в ChatRoute.partners)
+        self._watchers = {}
+
+    def __len__(self) -> int:
+        return len(self._routes)
+
+    def get(self, telegram_id: int) -> Optional[ChatRoute]:
+        return self._routes.get(telegram_id)
+
+    def set(self, telegram_id: int, route: ChatRoute):
+        self._drop(telegram_id)
+        self._routes[telegram_id] = route
+        for partner in route.partners:
+            self._watchers.setdefault(partner, set()).add(telegram_id)
+
+    def set_pair(self, user_id: int, partner_id: int, session_id: int):
+        self.set(user_id, ChatRoute([partner_id], session_id=session_id))
+        self.set(partner_id, ChatRoute([user_id], session_id=session_id))
+
+    def set_group(self, group_id: int, members: list):
+        for member in members:
+            self.set(member, ChatRoute([m for m in members if m != member], group_id=group_id))
+
+    def _drop(self, telegram_id: int) -> Optional[ChatRoute]:
+        route = self._routes.pop(telegram_id, None)
+        if route:
+            for partner in route.partners:
+                watchers = self._watchers.get(partner)
+                if watchers:
+                    watchers.discard(telegram_id)
+                    if not watchers:
+                        del self._watchers[partner]
+        return route
+
+    def invalidate(self, *telegram_ids: int):
+        """Сбросить маршруты пользователей и всех, чей маршрут ведёт к ним (собеседник, группа).
+
+        Работает и когда маршрута самого пользователя в памяти нет.
+        """
+        for telegram_id in telegram_ids:
+            route = self._drop(telegram_id)
+            affected = self._watchers.pop(telegram_id, set())
+            if route:
+                affected.update(route.partners)
+            for other in affected:
+                self._drop(other)
+
+
+# ========== КЭШ ПРЕМИУМА ==========
+class PremiumCache:
+    """Сроки премиума в памяти: telegram_id -> expires_at (aware UTC).
+
+    Срок меняют только покупка, реферальный бонус и выдача админом — все они
+    идут через Database и обновляют кэш. Запись действует до expires_at,
+    после чего пользователь переходит в отрицательный кэш. Отрицательный кэш
+    (пользователи без премиума) ограничен по размеру и вытесняет старейших.
+    """
+
+    def __init__(self, negative_size: int = PREMIUM_NEGATIVE_CACHE_SIZE):
+        self._expires = {}
+        self._negative = OrderedDict()
+        self._negative_size = negative_size
+
+    def get(self, telegram_id: int) -> Tuple[bool, Optional[datetime]]:
+        """(есть ли ответ в кэше, срок действующего премиума или None)"""
+        expires_at = self._expires.get(telegram_id)
+        if expires_at is not None:
+            if expires_at > datetime.now(timezone.utc):
+                return True, expires_at
+            # Истёк — дальше отвечаем отрицательно, без похода в БД
+            del self._expires[telegram_id]
+            self._remember_negative(telegram_id)
+            return True, None
+
+        if telegram_id in self._negative:
+            self._negative.move_to_end(telegram_id)
+            return True, None
+        return False, None
+
+    def set(self, telegram_id: int, expires_at: Optional[datetime]):
+        if expires_at is not None and expires_at > datetime.now(timezone.utc):
+            self._negative.pop(telegram_id, None)
+            self._expires[telegram_id] = expires_at
+        else:
+            self._expires.pop(telegram_id, None)
+            self._remember_negative(telegram_id)
+
+    def invalidate(self, telegram_id: int):
+        self._expires.pop(telegram_id, None)
+        self._negative.pop(telegram_id, None)
+
+    def _remember_negative(self, telegram_id: int):
+        self._negative[telegram_id] = True
+        self._negative.move_to_end(telegram_id)
+        while len(self._negative) > self._negative_size:
+            self._negative.popitem(last=False)
+
+
+# ========== КЭШ ПРОФИЛЕЙ ==========
+class ProfileCache:
+    """LRU профилей: telegram_id -> {id, telegram_id, username, first_name, gender, age}.
+
+    Профиль почти не меняется; все записи в users идут через Database
+    и обновляют кэш сразу после запроса (write-through).
+    """
+
+    def __init__(self, size: int = PROFILE_CACHE_SIZE):
+        self._profiles = OrderedDict()
+        self._size = size
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._profiles)
+
+    def get(self, telegram_id: int) -> Optional[dict]:
+        profile = self._profiles.get(telegram_id)
+        if profile is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._profiles.move_to_end(telegram_id)
+        return profile
+
+    def put(self, profile: dict):
+        self._profiles[profile['telegram_id']] = profile
+        self._profiles.move_to_end(profile['telegram_id'])
+        while len(self._profiles) > self._size:
+            self._profiles.popitem(last=False)
+
+    def update(self, telegram_id: int, **fields):
+        """Обновить поля закэшированного профиля; если его нет — прочитается из БД при промахе"""
+        profile = self._profiles.get(telegram_id)
+        if profile is not None:
+            profile.update(fields)
+
+    def invalidate(self, telegram_id: int):
+        self._profiles.pop(telegram_id, None)
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+# ========== СТАТИСТИКА В ПАМЯТИ ==========
+class BotStats:
+    """Счётчики для /stats в памяти.
+
+    Обновляются событиями из Database (регистрация, смена пола, групповая очередь,
+    соединение и выход, премиум) и периодически сверяются с БД — сверка убирает дрейф
+    и выводит из «новых за 24 часа» тех, кто вышел из окна.
+    Очередь 1-на-1 берётся прямо из Matchmaker.
+    """
+
+    def __init__(self):
+        self.users_by_gender = {}
+        self.new_by_gender = {}
+        # telegram_id -> target_gender ожидающих в group_search_queue
+        self.group_queue = {}
+        # telegram_id участников active_chats
+        self.chat_users = set()
+        # group_id -> число участников активных групп от 2 человек
+        self.groups = {}
+        # telegram_id -> expires_at (aware UTC) действующего премиума
+        self.premium = {}
+        self.reconciled_at: Optional[datetime] = None
+
+    @staticmethod
+    def _gender_key(gender: Optional[str]) -> str:
+        return gender if gender in Matchmaker.GENDERS else 'unknown'
+
+    def on_signup(self):
+        self.users_by_gender['unknown'] = self.users_by_gender.get('unknown', 0) + 1
+        self.new_by_gender['unknown'] = self.new_by_gender.get('unknown', 0) + 1
+
+    def on_gender_change(self, old: Optional[str], new: Optional[str], is_new: bool):
+        old, new = self._gender_key(old), self._gender_key(new)
+        if old == new:
+            return
+        counters = (self.users_by_gender, self.new_by_gender) if is_new else (self.users_by_gender,)
+        for counter in counters:
+            counter[old] = max(counter.get(old, 0) - 1, 0)
+            counter[new] = counter.get(new, 0) + 1
+
+    def on_group_enqueue(self, telegram_id: int, target_gender: Optional[str]):
+        self.group_queue[telegram_id] = target_gender
+
+    def on_group_dequeue(self, *telegram_ids: int):
+        for telegram_id in telegram_ids:
+            self.group_queue.pop(telegram_id, None)
+
+    def on_chat_start(self, *telegram_ids: int):
+        self.chat_users.update(telegram_ids)
+
+    def on_chat_end(self, *telegram_ids: int):
+        self.chat_users.difference_update(telegram_ids)
+
+    def on_group_size(self, group_id: int, size: int):
+        if size >= 2:
+            self.groups[group_id] = size
+        else:
+            self.groups.pop(group_id, None)
+
+    def on_group_leave(self, group_id: int, close_group: bool):
+        size = 0 if close_group else self.groups.get(group_id, 0) - 1
+        self.on_group_size(group_id, size)
+
+    def on_premium(self, telegram_id: int, expires_at: datetime):
+        self.premium[telegram_id] = expires_at
+
+    def load(self, users_by_gender: dict, new_by_gender: dict, group_queue: dict,
+             chat_users: set, groups: dict, premium: dict):
+        """Заменить счётчики результатом сверки с БД"""
+        self.users_by_gender = users_by_gender
+        self.new_by_gender = new_by_gender
+        self.group_queue = group_queue
+        self.chat_users = chat_users
+        self.groups = groups
+        self.premium = premium
+        self.reconciled_at = datetime.now(timezone.utc)
+
+    def active_premium(self) -> int:
+        now = datetime.now(timezone.utc)
+        for telegram_id in [tid for tid, expires_at in self.premium.items() if expires_at <= now]:
+            del self.premium[telegram_id]
+        return len(self.premium)
+
+
+def as_utc(value: datetime) -> datetime:
+    """TIMESTAMP из БД (naive UTC) -> aware UTC"""
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+# ========== МЕТРИКИ PROMETHEUS ==========
+def quantile(ordered: list, q: float) -> float:
+    """Квантиль q отсортированной выборки по ближайшему рангу (p99 из 100 значений — 99-е)"""
+    if not ordered:
+        return 0.0
+    # Поправка на погрешность float: 0.07 * 100 == 7.000000000000001
+    rank = math.ceil(q * len(ordered) - 1e-9)
+    return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    """{name="value",...} с экранированием по формату Prometheus"""
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Счётчик Prometheus с метками"""
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def expose(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """Гистограмма Prometheus с метками: накопительные корзины, сумма и число наблюдений"""
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        # метки -> [счётчики по корзинам..., сумма, число]
+        self._values = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        series = self._values.get(key)
+        if series is None:
+            series = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def expose(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        bucket_labels = self.labels + ("le",)
+        for key, series in self._values.items():
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{_format_labels(bucket_labels, key + (bound,))} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(bucket_labels, key + ('+Inf',))} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {series[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {series[-1]}")
+        return lines
+
+
+class Gauge:
+    """Gauge Prometheus, значения которого считываются в момент опроса: collect() -> {метки: значение}"""
+
+    def __init__(self, name: str, documentation: str, collect, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.collect = collect
+
+    def expose(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class MetricsRegistry:
+    """Набор метрик процесса в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def expose(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+MATCH_SECONDS = METRICS.register(Histogram(
+    "bot_match_duration_seconds", "Время подбора собеседника", labels=("kind", "result")))
+RELAY_SECONDS = METRICS.register(Histogram(
+    "bot_relay_duration_seconds", "Время пересылки сообщения в chat_forward", labels=("chat",)))
+TELEGRAM_API_SECONDS = METRICS.register(Histogram(
+    "bot_telegram_api_duration_seconds", "Время запроса к Bot API", labels=("method",)))
+TELEGRAM_API_ERRORS = METRICS.register(Counter(
+    "bot_telegram_api_errors_total", "Ошибки Bot API по коду", labels=("method", "code")))
+POOL_ACQUIRE_SECONDS = METRICS.register(Histogram(
+    "bot_db_pool_acquire_seconds", "Ожидание соединения из пула asyncpg",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)))
+
+
+# ========== ТРАССИРОВКА ОБНОВЛЕНИЙ ==========
+class RollingSummary:
+    """Summary Prometheus по скользящему окну последних наблюдений: квантили, сумма и число"""
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), window: int = 1000,
+                 quantiles: tuple = (0.5, 0.9, 0.99)):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.window = window
+        self.quantiles = quantiles
+        # метки -> [окно наблюдений, сумма, число]
+        self._values = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        series = self._values.get(key)
+        if series is None:
+            series = self._values[key] = [deque(maxlen=self.window), 0.0, 0]
+        series[0].append(value)
+        series[1] += value
+        series[2] += 1
+
+    def percentiles(self, **labels) -> Dict[float, float]:
+        key = tuple(labels.get(name, "") for name in self.labels)
+        series = self._values.get(key)
+        return self._percentiles(series[0]) if series else {}
+
+    def _percentiles(self, window) -> Dict[float, float]:
+        ordered = sorted(window)
+        return {q: quantile(ordered, q) for q in self.quantiles}
+
+    def expose(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} summary"]
+        quantile_labels = self.labels + ("quantile",)
+        for key, (window, total, count) in self._values.items():
+            for q, value in self._percentiles(window).items():
+                lines.append(f"{self.name}{_format_labels(quantile_labels, key + (q,))} {value}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+UPDATE_SECONDS = METRICS.register(RollingSummary(
+    "bot_update_duration_seconds", "Время обработки обновления по обработчикам", labels=("handler",)))
+
+
+class UpdateTrace:
+    """Куда ушло время одного обновления: обработчик, запросы к БД и к Bot API"""
+
+    __slots__ = ('handler', 'db_calls', 'db_seconds', 'api_calls', 'api_seconds')
+
+    def __init__(self):
+        self.handler = "unhandled"
+        self.db_calls = 0
+        self.db_seconds = 0.0
+        self.api_calls = 0
+        self.api_seconds = 0.0
+
+
+# Трассировка текущего обновления; задачи, порождённые обработчиком, наследуют её
+CURRENT_TRACE: ContextVar[Optional[UpdateTrace]] = ContextVar("current_trace", default=None)
+
+
+class UpdateTimingMiddleware(BaseMiddleware):
+    """Внешний middleware: время обновления по обработчику и лог медленных обновлений"""
+
+    async def __call__(self, handler, event, data):
+        trace = UpdateTrace()
+        token = CURRENT_TRACE.set(trace)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            elapsed = time.perf_counter() - started
+            CURRENT_TRACE.reset(token)
+            UPDATE_SECONDS.observe(elapsed, handler=trace.handler)
+            if elapsed * 1000 >= SLOW_UPDATE_THRESHOLD_MS:
+                self._log_slow(event, trace, elapsed)
+
+    @staticmethod
+    def _log_slow(event, trace: UpdateTrace, elapsed: float):
+        user = getattr(event.event, 'from_user', None)
+        other = max(elapsed - trace.db_seconds - trace.api_seconds, 0.0)
+        logger.warning(
+            f"🐢 Медленное обновление: handler={trace.handler} update_id={event.update_id} "
+            f"user_id={user.id if user else None} total_ms={elapsed * 1000:.0f} "
+            f"db_calls={trace.db_calls} db_ms={trace.db_seconds * 1000:.0f} "
+            f"api_calls={trace.api_calls} api_ms={trace.api_seconds * 1000:.0f} "
+            f"other_ms={other * 1000:.0f}"
+        )
+
+
+class HandlerNameMiddleware(BaseMiddleware):
+    """Внутренний middleware: записывает в трассировку имя выбранного обработчика"""
+
+    async def __call__(self, handler, event, data):
+        trace = CURRENT_TRACE.get()
+        if trace is not None:
+            trace.handler = data['handler'].callback.__name__
+        return await handler(event, data)
+
+
+# ========== СТАТИСТИКА SQL-ЗАПРОСОВ ==========
+_SQL_STRING = re.compile(r"'(?:[^']|'')*'")
+_SQL_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_SQL_SPACES = re.compile(r"\s+")
+
+
+def fingerprint_query(query: str) -> str:
+    """Отпечаток запроса: литералы заменены на ?, пробелы схлопнуты ($1... остаются)"""
+    query = _SQL_STRING.sub("?", query)
+    query = _SQL_NUMBER.sub(lambda m: m.group(0) if m.string[m.start() - 1:m.start()] == "$" else "?", query)
+    return _SQL_SPACES.sub(" ", query).strip()
+
+
+class QueryStat:
+    __slots__ = ('calls', 'errors', 'total_seconds', 'rows', 'window')
+
+    def __init__(self, window: int):
+        self.calls = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.rows = 0
+        self.window = deque(maxlen=window)
+
+    def p99(self) -> float:
+        return quantile(sorted(self.window), 0.99)
+
+
+class QueryStats:
+    """Число вызовов, время (всего и p99 по окну) и строки по отпечаткам SQL-запросов"""
+
+    # Отпечатки считаются один раз на текст запроса; динамических текстов немного, но кэш ограничен
+    FINGERPRINT_CACHE_SIZE = 2000
+
+    def __init__(self, window: int = 512):
+        self.window = window
+        self._stats = {}
+        self._fingerprints = {}
+
+    def fingerprint(self, query: str) -> str:
+        fingerprint = self._fingerprints.get(query)
+        if fingerprint is None:
+            if len(self._fingerprints) >= self.FINGERPRINT_CACHE_SIZE:
+                self._fingerprints.clear()
+            fingerprint = self._fingerprints[query] = fingerprint_query(query)
+        return fingerprint
+
+    def record(self, query: str, elapsed: float, rows: int, failed: bool = False):
+        fingerprint = self.fingerprint(query)
+        stat = self._stats.get(fingerprint)
+        if stat is None:
+            stat = self._stats[fingerprint] = QueryStat(self.window)
+        stat.calls += 1
+        stat.errors += failed
+        stat.total_seconds += elapsed
+        stat.rows += rows
+        stat.window.append(elapsed)
+
+    def top(self, limit: int = 10, order: str = "total") -> list:
+        """[(отпечаток, QueryStat)] по убыванию total | p99 | calls | rows"""
+        keys = {
+            "total": lambda item: item[1].total_seconds,
+            "p99": lambda item: item[1].p99(),
+            "calls": lambda item: item[1].calls,
+            "rows": lambda item: item[1].rows,
+        }
+        return sorted(self._stats.items(), key=keys.get(order, keys["total"]), reverse=True)[:limit]
+
+    def reset(self):
+        self._stats.clear()
+
+    def expose(self) -> list:
+        """Метрики по запросам для /metrics; метка query — отпечаток, обрезанный до 200 символов"""
+        series = (
+            ("bot_db_query_calls_total", "counter", "Вызовы SQL-запроса", lambda stat: stat.calls),
+            ("bot_db_query_errors_total", "counter", "Ошибки SQL-запроса", lambda stat: stat.errors),
+            ("bot_db_query_seconds_total", "counter", "Суммарное время SQL-запроса", lambda stat: stat.total_seconds),
+            ("bot_db_query_rows_total", "counter", "Строки, возвращённые или затронутые запросом",
+             lambda stat: stat.rows),
+            ("bot_db_query_p99_seconds", "gauge", "p99 времени SQL-запроса по окну", lambda stat: stat.p99()),
+        )
+        lines = []
+        for name, kind, documentation, value in series:
+            lines.extend([f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"])
+            for fingerprint, stat in self._stats.items():
+                lines.append(f"{name}{_format_labels(('query',), (fingerprint[:200],))} {value(stat)}")
+        return lines
+
+
+QUERY_STATS = METRICS.register(QueryStats())
+
+
+def _affected_rows(status: str) -> int:
+    """Число строк из статуса команды: 'UPDATE 3' -> 3, 'INSERT 0 1' -> 1"""
+    tail = status.rsplit(" ", 1)[-1] if status else ""
+    return int(tail) if tail.isdigit() else 0
+
+
+class InstrumentedConnection:
+    """Обёртка соединения asyncpg: каждый запрос учитывается в QUERY_STATS и трассировке обновления"""
+
+    __slots__ = ('_conn',)
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        # transaction(), add_listener() и прочее — напрямую
+        return getattr(self._conn, name)
+
+    async def _run(self, method, count_rows, query: str, *args, **kwargs):
+        started = time.perf_counter()
+        failed = True
+        rows = 0
+        try:
+            result = await method(query, *args, **kwargs)
+            failed = False
+            rows = count_rows(result)
+            return result
+        finally:
+            elapsed = time.perf_counter() - started
+            QUERY_STATS.record(query, elapsed, rows, failed)
+            trace = CURRENT_TRACE.get()
+            if trace is not None:
+                trace.db_calls += 1
+                trace.db_seconds += elapsed
+
+    async def execute(self, query: str, *args, **kwargs):
+        return await self._run(self._conn.execute, _affected_rows, query, *args, **kwargs)
+
+    async def fetch(self, query: str, *args, **kwargs):
+        return await self._run(self._conn.fetch, len, query, *args, **kwargs)
+
+    async def fetchrow(self, query: str, *args, **kwargs):
+        return await self._run(self._conn.fetchrow, lambda row: int(row is not None), query, *args, **kwargs)
+
+    async def fetchval(self, query: str, *args, **kwargs):
+        return await self._run(self._conn.fetchval, lambda value: int(value is not None), query, *args, **kwargs)
+
+
+class ConnectionScope:
+    """Одно соединение пула на все запросы задачи (обычно — обработки одного обновления).
+
+    Соединение берётся из пула при первом запросе и возвращается при выходе из области
+    или раньше — перед запросом к Bot API вне транзакции (release_idle), чтобы ожидание
+    Telegram и лимитов отправки не занимало пул; следующий запрос к БД возьмёт соединение заново.
+    Пользоваться им может только задача-владелец: дочерние задачи (asyncio.gather)
+    наследуют контекст, но берут свои соединения — одно соединение asyncpg
+    не выполняет два запроса одновременно.
+    """
+
+    __slots__ = ('pool', 'owner', '_raw', '_conn')
+
+    def __init__(self, pool: asyncpg.Pool):
+        self.pool = pool
+        self.owner = asyncio.current_task()
+        self._raw = None
+        self._conn = None
+
+    def owned(self) -> bool:
+        return self.owner is asyncio.current_task()
+
+    async def connection(self) -> InstrumentedConnection:
+        if self._conn is None:
+            started = time.perf_counter()
+            self._raw = await self.pool.acquire()
+            POOL_ACQUIRE_SECONDS.observe(time.perf_counter() - started)
+            self._conn = InstrumentedConnection(self._raw)
+        return self._conn
+
+    async def release(self):
+        if self._raw is not None:
+            raw, self._raw, self._conn = self._raw, None, None
+            await self.pool.release(raw)
+
+    async def release_idle(self):
+        """Вернуть соединение в пул, если на нём нет открытой транзакции"""
+        if self._raw is not None and not self._raw.is_in_transaction():
+            await self.release()
+
+
+CONNECTION_SCOPE: ContextVar[Optional[ConnectionScope]] = ContextVar("connection_scope", default=None)
+
+
+class ConnectionScopeMiddleware(BaseMiddleware):
+    """Внешний middleware: методы Database в рамках обновления используют одно соединение
+    (между запросами к Bot API)"""
+
+    def __init__(self, database):
+        self.database = database
+
+    async def __call__(self, handler, event, data):
+        async with self.database.connection_scope():
+            return await handler(event, data)
+
+
+# ========== ОГРАНИЧЕНИЕ ЧАСТОТЫ ЗАПРОСОВ К TELEGRAM ==========
+class TokenBucket:
+    """Корзина токенов с резервированием: запрос не отбрасывается, а ждёт своей очереди"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def reserve(self, now: float) -> float:
+        """Занять токен; вернуть, сколько секунд ждать до отправки"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(delay, self.blocked_until - now)
+
+
+# Методы, которые отправляют сообщение в чат: только на них действует лимит чата
+CHAT_PACED_METHODS = frozenset({
+    "sendMessage", "sendPhoto", "sendAudio", "sendDocument", "sendVideo", "sendAnimation", "sendVoice",
+    "sendVideoNote", "sendMediaGroup", "sendLocation", "sendVenue", "sendContact", "sendPoll", "sendDice",
+    "sendSticker", "sendInvoice", "sendGame", "sendPaidMedia",
+    "copyMessage", "copyMessages", "forwardMessage", "forwardMessages",
+})
+
+
+class TelegramRateLimiter(BaseRequestMiddleware):
+    """Планировщик исходящих запросов Bot API: общий лимит, лимит на чат и учёт retry_after.
+
+    Лимит чата действует только на отправку сообщений (CHAT_PACED_METHODS): правки,
+    удаления и sendChatAction ждут лишь общий лимит и retry_after своего чата.
+    """
+
+    # Сколько раз повторять запрос после 429 Too Many Requests
+    MAX_RETRIES = 3
+    # Корзины чатов, простаивающие дольше этого, удаляются (секунды)
+    IDLE_BUCKET_TTL = 60
+
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE, chat_rate: float = TELEGRAM_CHAT_RATE,
+                 group_rate: float = TELEGRAM_GROUP_RATE, chat_burst: int = TELEGRAM_CHAT_BURST):
+        self.global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self._last_cleanup = time.monotonic()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательный id (или @username) — группа/канал: 20 сообщений в минуту
+            is_group = not isinstance(chat_id, int) or chat_id < 0
+            if is_group:
+                bucket = TokenBucket(self.group_rate, capacity=20)
+            else:
+                bucket = TokenBucket(self.chat_rate, capacity=self.chat_burst)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _cleanup(self, now: float):
+        if now - self._last_cleanup < self.IDLE_BUCKET_TTL:
+            return
+        self._last_cleanup = now
+        self.chat_buckets = {
+            chat_id: bucket for chat_id, bucket in self.chat_buckets.items()
+            if now - bucket.updated < self.IDLE_BUCKET_TTL or bucket.blocked_until > now
+        }
+
+    async def _acquire(self, chat_id, paced: bool):
+        now = time.monotonic()
+        self._cleanup(now)
+        bucket = self._chat_bucket(chat_id)
+        delay = bucket.reserve(now) if paced else bucket.blocked_until - now
+        if delay > 0:
+            await asyncio.sleep(delay)
+            now = time.monotonic()
+        # Общий токен — только когда чат готов: пока ждём чат, он достанется другим
+        delay = self.global_bucket.reserve(now)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            # Служебные методы (getMe, getUpdates, answerCallbackQuery...) не лимитируем
+            return await make_request(bot, method)
+
+        paced = method.__api_method__ in CHAT_PACED_METHODS
+        for attempt in range(self.MAX_RETRIES + 1):
+            await self._acquire(chat_id, paced)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.MAX_RETRIES:
+                    raise
+                logger.warning(f"429 от Telegram для чата {chat_id}: ждём {e.retry_after} с "
+                               f"(попытка {attempt + 1}/{self.MAX_RETRIES})")
+                blocked_until = time.monotonic() + e.retry_after
+                self._chat_bucket(chat_id).blocked_until = blocked_until
+                if paced:
+                    # Отправка уже шла в темпе чата — упёрлись в общий лимит бота: ждут все чаты
+                    self.global_bucket.blocked_until = max(self.global_bucket.blocked_until, blocked_until)
+
+
+# Код ошибки Bot API для метрик (исключения aiogram не хранят HTTP-статус)
+TELEGRAM_ERROR_CODES = (
+    (TelegramRetryAfter, "429"),
+    (TelegramBadRequest, "400"),
+    (TelegramUnauthorizedError, "401"),
+    (TelegramForbiddenError, "403"),
+    (TelegramNotFound, "404"),
+    (TelegramConflictError, "409"),
+    (TelegramEntityTooLarge, "413"),
+    (TelegramServerError, "5xx"),
+    (TelegramNetworkError, "network"),
+)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Время и ошибки каждого запроса к Bot API (регистрируется после планировщика — без учёта ожидания)"""
+
+    async def __call__(self, make_request, bot, method):
+        method_name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            code = next((code for error_type, code in TELEGRAM_ERROR_CODES if isinstance(e, error_type)), "other")
+            TELEGRAM_API_ERRORS.inc(method=method_name, code=code)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            TELEGRAM_API_SECONDS.observe(elapsed, method=method_name)
+            trace = CURRENT_TRACE.get()
+            if trace is not None:
+                trace.api_calls += 1
+                trace.api_seconds += elapsed
+
+
+class ConnectionReleaseMiddleware(BaseRequestMiddleware):
+    """Перед запросом к Bot API вернуть в пул соединение области текущей задачи.
+
+    Регистрируется первым — соединение отдаётся ещё до ожидания в TelegramRateLimiter.
+    """
+
+    async def __call__(self, make_request, bot, method):
+        scope = CONNECTION_SCOPE.get()
+        if scope is not None and scope.owned():
+            await scope.release_idle()
+        return await make_request(bot, method)
+
+
+# ========== ОТЛОЖЕННЫЕ УВЕДОМЛЕНИЯ ==========
+class Notification:
+    """Сообщение пользователю, которое отправляется после фиксации транзакции"""
+
+    __slots__ = ('chat_id', 'text', 'kwargs', 'attempts')
+
+    def __init__(self, chat_id: int, text: str, **kwargs):
+        self.chat_id = chat_id
+        self.text = text
+        self.kwargs = kwargs
+        self.attempts = 0
+
+
+class Outbox:
+    """Очередь уведомлений: Database кладёт их после коммита, воркеры отправляют с повторами.
+
+    Вызовы Bot API не выполняются под блокировками БД — время удержания
+    блокировок не зависит от задержек Telegram.
+    """
+
+    def __init__(self, max_attempts: int = OUTBOX_MAX_ATTEMPTS):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.max_attempts = max_attempts
+        # Уведомления, ждущие повтора вне очереди, и их таймеры
+        self._retrying: Dict[Notification, asyncio.TimerHandle] = {}
+
+    def __len__(self) -> int:
+        return self.queue.qsize() + len(self._retrying)
+
+    def put(self, notification: Notification):
+        self.queue.put_nowait(notification)
+
+    def _requeue(self, notification: Notification):
+        self._retrying.pop(notification, None)
+        self.put(notification)
+
+    def flush_retries(self):
+        """Вернуть в очередь отложенные повторы, не дожидаясь таймеров (перед остановкой)"""
+        for notification, handle in list(self._retrying.items()):
+            handle.cancel()
+            self._requeue(notification)
+
+    async def deliver(self, bot: Bot, notification: Notification):
+        notification.attempts += 1
+        try:
+            await bot.send_message(notification.chat_id, notification.text, **notification.kwargs)
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Бот заблокирован или чат недоступен — повтор не поможет
+            logger.warning(f"Уведомление для {notification.chat_id} не доставлено: {e}")
+        except Exception as e:
+            if notification.attempts >= self.max_attempts:
+                logger.error(f"Уведомление для {notification.chat_id} не доставлено "
+                             f"после {notification.attempts} попыток: {e}")
+                return
+            delay = 2 ** notification.attempts
+            logger.warning(f"Ошибка отправки уведомления {notification.chat_id}: {e} — повтор через {delay} с")
+            self._retrying[notification] = asyncio.get_running_loop().call_later(
+                delay, self._requeue, notification)
+
+    async def run(self, bot: Bot):
+        while True:
+            notification = await self.queue.get()
+            try:
+                await self.deliver(bot, notification)
+            finally:
+                self.queue.task_done()
+
+
+# Уведомления, накопленные в открытой транзакции Database.transaction()
+PENDING_NOTIFICATIONS: ContextVar[Optional[list]] = ContextVar("pending_notifications", default=None)
+
+METRICS.register(Gauge("bot_outbox_size", "Уведомления, ожидающие отправки",
+                       lambda: len(db.outbox)))
+
+
+# ========== КЛАСТЕР: СОБЫТИЯ МЕЖДУ РЕПЛИКАМИ ==========
+CLUSTER_CHANNEL = "bot_events"
+# Лидер кластера выполняет фоновый подбор и очистку
+LEADER_LOCK_ID = 0x66657402
+# Блокировка пользователя (ClusterBus.lock_user) — USER_LOCK_BASE + telegram_id, не пересекается с ID выше
+USER_LOCK_BASE = 1 << 62
+# Сколько ID в одном событии: NOTIFY ограничен 8000 байтами
+CLUSTER_EVENT_CHUNK = 400
+
+CLUSTER_EVENTS = METRICS.register(Counter(
+    "bot_cluster_events_total", "События между репликами", labels=("direction", "kind")))
+USER_LOCK_FAILURES = METRICS.register(Counter(
+    "bot_cluster_user_lock_failures_total", "Обновления, обработанные без блокировки пользователя",
+    labels=("reason",)))
+
+
+class ClusterBus:
+    """События между репликами через LISTEN/NOTIFY и выбор лидера advisory-блокировкой.
+
+    Держит своё соединение вне пула: на нём LISTEN и сессионная блокировка лидера.
+    Блокировки пользователей — на отдельных соединениях (USER_LOCK_CONNECTIONS), пользователь
+    всегда на одном и том же: сессионные блокировки снимаются только той сессией, что их взяла.
+    Без соединения реплика не лидер и не получает событий, поэтому после
+    переподключения вызываются resync_callbacks — состояние в памяти перечитывается из БД.
+    """
+
+    def __init__(self, dsn: str, node_id: str = NODE_ID):
+        self.dsn = dsn
+        self.node_id = node_id
+        self.conn: Optional[asyncpg.Connection] = None
+        self.handlers = {}
+        self.resync_callbacks = []
+        self.is_leader = False
+        # asyncpg не выполняет два запроса на одном соединении одновременно
+        self._conn_lock = asyncio.Lock()
+        self._user_conns: list = [None] * USER_LOCK_CONNECTIONS
+        self._user_conn_locks = [asyncio.Lock() for _ in range(USER_LOCK_CONNECTIONS)]
+
+    def subscribe(self, kind: str, handler):
+        self.handlers[kind] = handler
+
+    def encode(self, kind: str, data: dict) -> str:
+        CLUSTER_EVENTS.inc(direction="out", kind=kind)
+        return json.dumps({"node": self.node_id, "kind": kind, **data}, separators=(",", ":"))
+
+    def _on_notify(self, conn, pid, channel, payload):
+        event = json.loads(payload)
+        # Свои события уже применены локально
+        if event.pop("node") == self.node_id:
+            return
+        kind = event.pop("kind")
+        handler = self.handlers.get(kind)
+        if handler is None:
+            return
+        CLUSTER_EVENTS.inc(direction="in", kind=kind)
+        try:
+            handler(**event)
+        except Exception as e:
+            logger.error(f"Ошибка обработки события кластера {kind}: {e}")
+
+    async def connect(self):
+        """Подключиться и начать слушать канал событий"""
+        self.conn = await asyncpg.connect(self.dsn)
+        await self.conn.add_listener(CLUSTER_CHANNEL, self._on_notify)
+        logger.info(f"✅ Реплика {self.node_id} слушает события кластера")
+
+    def close(self):
+        if self.is_leader:
+            logger.warning(f"Реплика {self.node_id} больше не лидер")
+        self.is_leader = False
+        conns = [self.conn] + self._user_conns
+        self.conn = None
+        self._user_conns = [None] * len(self._user_conns)
+        for conn in conns:
+            if conn is not None and not conn.is_closed():
+                # Вместе с сессией освобождаются и её блокировки: лидера и пользователей
+                conn.terminate()
+
+    async def _fetchval(self, query: str, *args):
+        async with self._conn_lock:
+            if self.conn is None:
+                raise ConnectionError("соединение кластера не установлено")
+            return await self.conn.fetchval(query, *args)
+
+    async def _elect(self):
+        if self.is_leader:
+            # Проверяем соединение: с ним теряется и лидерство
+            await self._fetchval("SELECT 1")
+            return
+        if await self._fetchval("SELECT pg_try_advisory_lock($1)", LEADER_LOCK_ID):
+            self.is_leader = True
+            logger.info(f"👑 Реплика {self.node_id} стала лидером")
+
+    async def _user_lock_query(self, query: str, telegram_id: int):
+        shard = telegram_id % len(self._user_conns)
+        async with self._user_conn_locks[shard]:
+            if self.conn is None:
+                raise ConnectionError("соединение кластера не установлено")
+            conn = self._user_conns[shard]
+            if conn is None:
+                conn = self._user_conns[shard] = await asyncpg.connect(self.dsn)
+            try:
+                return await conn.fetchval(query, USER_LOCK_BASE + telegram_id)
+            except Exception:
+                # Соединение могло оборваться — следующий запрос откроет новое
+                self._user_conns[shard] = None
+                conn.terminate()
+                raise
+
+    async def lock_user(self, telegram_id: int) -> bool:
+        """Занять пользователя за этой репликой: его обновления на других репликах ждут.
+
+        Блокировка сессионная, соединения пула не заняты, пока ждём. Повторный захват
+        той же репликой проходит сразу (блокировки складываются). False — обрабатываем
+        без блокировки: нет соединения или истёк USER_LOCK_TIMEOUT.
+        """
+        deadline = time.monotonic() + USER_LOCK_TIMEOUT
+        delay = 0.01
+        while True:
+            try:
+                if await self._user_lock_query("SELECT pg_try_advisory_lock($1)", telegram_id):
+                    return True
+            except Exception as e:
+                USER_LOCK_FAILURES.inc(reason="unavailable")
+                logger.warning(f"Блокировка пользователя {telegram_id} недоступна — обрабатываем без неё: {e}")
+                return False
+            if time.monotonic() >= deadline:
+                USER_LOCK_FAILURES.inc(reason="timeout")
+                logger.warning(f"Пользователь {telegram_id} занят другой репликой дольше "
+                               f"{USER_LOCK_TIMEOUT} с — обрабатываем без блокировки")
+                return False
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+    async def unlock_user(self, telegram_id: int):
+        try:
+            await self._user_lock_query("SELECT pg_advisory_unlock($1)", telegram_id)
+        except Exception as e:
+            # Без соединения блокировки сессии сняты сами
+            logger.warning(f"Не удалось снять блокировку пользователя {telegram_id}: {e}")
+
+    async def run(self):
+        """Держать соединение кластера и периодически пытаться стать лидером.
+
+        Обрыв замечается не сразу, и пару секунд лидеров может быть два — это безопасно:
+        подбор и очистка защищены блокировками строк.
+        """
+        while True:
+            try:
+                if self.conn is None:
+                    await self.connect()
+                    for callback in self.resync_callbacks:
+                        await callback()
+                await self._elect()
+                await asyncio.sleep(LEADER_RETRY_INTERVAL)
+            except asyncio.CancelledError:
+                self.close()
+                raise
+            except Exception as e:
+                logger.error(f"Соединение кластера потеряно: {e}")
+                self.close()
+                await asyncio.sleep(LEADER_RETRY_INTERVAL)
+
+
+# ========== МИГРАЦИИ СХЕМЫ ==========
+class Migration:
+    """Шаг миграции схемы; transactional=False — вне транзакции (нужно для CREATE INDEX CONCURRENTLY)"""
+
+    __slots__ = ('version', 'description', 'statements', 'transactional')
+
+    def __init__(self, version: int, description: str, statements: list, transactional: bool = True):
+        self.version = version
+        self.description = description
+        self.statements = statements
+        self.transactional = transactional
+
+
+# Фиксация пары одним запросом: проверка очереди, сессия, active_chats, очистка очереди.
+# Строки очереди блокируются в порядке telegram_id — два параллельных подбора
+# не заберут одного кандидата и не взаимоблокируются
+COMMIT_MATCH_FUNCTION = """
+    CREATE OR REPLACE FUNCTION commit_match(p_user BIGINT, p_partner BIGINT)
+    RETURNS INTEGER AS $$
+    DECLARE
+        v_queued INTEGER;
+        v_user1 INTEGER;
+        v_user2 INTEGER;
+        v_session INTEGER;
+    BEGIN
+        SELECT COUNT(*) INTO v_queued FROM (
+            SELECT 1 FROM search_queue
+            WHERE telegram_id IN (p_user, p_partner)
+            ORDER BY telegram_id
+            FOR UPDATE
+        ) q;
+        IF v_queued < 2 THEN
+            RETURN NULL;
+        END IF;
+
+        SELECT id INTO v_user1 FROM users WHERE telegram_id = p_user;
+        SELECT id INTO v_user2 FROM users WHERE telegram_id = p_partner;
+        IF v_user1 IS NULL OR v_user2 IS NULL THEN
+            RETURN NULL;
+        END IF;
+
+        -- Сессия пары может быть записана в любом порядке — возобновляем её
+        UPDATE chat_sessions
+        SET ended_at = NULL, created_at = CURRENT_TIMESTAMP
+        WHERE id = (
+            SELECT id FROM chat_sessions
+            WHERE (user1_id = v_user1 AND user2_id = v_user2)
+               OR (user1_id = v_user2 AND user2_id = v_user1)
+            ORDER BY created_at DESC
+            LIMIT 1
+        )
+        RETURNING id INTO v_session;
+
+        IF v_session IS NULL THEN
+            INSERT INTO chat_sessions (user1_id, user2_id)
+            VALUES (v_user1, v_user2)
+            ON CONFLICT (user1_id, user2_id) DO UPDATE SET
+                ended_at = NULL, created_at = CURRENT_TIMESTAMP
+            RETURNING id INTO v_session;
+        END IF;
+
+        INSERT INTO active_chats (telegram_id, partner_telegram_id, session_id)
+        VALUES (p_user, p_partner, v_session), (p_partner, p_user, v_session)
+        ON CONFLICT (telegram_id) DO UPDATE SET
+            partner_telegram_id = EXCLUDED.partner_telegram_id,
+            session_id = EXCLUDED.session_id,
+            created_at = CURRENT_TIMESTAMP;
+
+        DELETE FROM search_queue WHERE telegram_id IN (p_user, p_partner);
+
+        RETURN v_session;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+# Каждый индекс обслуживает конкретный запрос из кода (указан в комментарии)
+HOT_QUERY_INDEXES = [
+    # _load_search_queue, /stats: очередь в порядке ожидания; случайный поиск отдельно
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_search_queue_joined_at ON search_queue (joined_at)",
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_search_queue_random ON search_queue (joined_at)
+       WHERE target_gender IS NULL""",
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_search_queue_gender ON search_queue (target_gender, joined_at)
+       WHERE target_gender IS NOT NULL""",
+    # find_group_partner, get_group_search_queue: кандидаты по target_gender в порядке ожидания
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_group_search_queue_target ON group_search_queue (target_gender, joined_at)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_group_search_queue_joined_at ON group_search_queue (joined_at)",
+    # commit_match, add_rating, add_complaint: пара в обратном порядке (прямой покрыт UNIQUE)
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_chat_sessions_user2 ON chat_sessions (user2_id, user1_id)",
+    # find_last_partner: (user1_id = $1 OR user2_id = $1) AND ended_at IS NOT NULL ORDER BY ended_at
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_chat_sessions_user1_ended ON chat_sessions (user1_id, ended_at)
+       WHERE ended_at IS NOT NULL""",
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_chat_sessions_user2_ended ON chat_sessions (user2_id, ended_at)
+       WHERE ended_at IS NOT NULL""",
+    # end_chat: остались ли активные соединения с сессией
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_active_chats_session ON active_chats (session_id)",
+    # get_route, get_group_members, leave_group: группа пользователя (PK начинается с group_id)
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_group_chat_members_telegram ON group_chat_members (telegram_id)",
+    # get_group_id, /stats: активные группы по времени создания
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_group_chats_active ON group_chats (created_at) WHERE is_active = TRUE",
+    # get_user_rating_stats: агрегаты по оцениваемому
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_user_ratings_rated ON user_ratings (rated_user_id)",
+    # /stats: активный премиум
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_premium_active ON premium (expires_at)
+       WHERE is_active = TRUE""",
+    # /stats: новые пользователи за 24 часа
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_created_at ON users (created_at)",
+]
+
+
+# Счётчик участников группы ведёт триггер — в той же транзакции, что и вставка/удаление участника.
+# Заодно покрывает каскадное удаление и любой код, который меняет group_chat_members напрямую
+GROUP_MEMBER_COUNT_TRIGGER = [
+    "ALTER TABLE group_chats ADD COLUMN IF NOT EXISTS member_count INTEGER NOT NULL DEFAULT 0",
+    """
+    UPDATE group_chats gc
+    SET member_count = sub.cnt
+    FROM (
+        SELECT group_id, COUNT(*) AS cnt FROM group_chat_members GROUP BY group_id
+    ) sub
+    WHERE gc.id = sub.group_id AND gc.member_count <> sub.cnt
+    """,
+    """
+    CREATE OR REPLACE FUNCTION group_member_count_sync()
+    RETURNS TRIGGER AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            UPDATE group_chats SET member_count = member_count + 1 WHERE id = NEW.group_id;
+            RETURN NEW;
+        END IF;
+        UPDATE group_chats SET member_count = member_count - 1 WHERE id = OLD.group_id;
+        RETURN OLD;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS group_member_count_sync ON group_chat_members",
+    """
+    CREATE TRIGGER group_member_count_sync
+    AFTER INSERT OR DELETE ON group_chat_members
+    FOR EACH ROW EXECUTE FUNCTION group_member_count_sync()
+    """,
+]
+
+# find_group_partner, has_open_group: группы со свободным местом. Предикат запросов
+# (member_count = 2) следует из предиката индекса, поэтому поиск — один спуск по крошечному индексу
+OPEN_GROUP_INDEXES = [
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_group_chats_open ON group_chats (created_at)
+       WHERE is_active = TRUE AND member_count BETWEEN 1 AND 2""",
+]
+
+
+# Миграции применяются по порядку версий; уже применённые не меняем — только добавляем новые
+MIGRATIONS = [
+    Migration(1, "Базовые таблицы", [
+        # Пользователи
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            telegram_id BIGINT UNIQUE NOT NULL,
+            username VARCHAR(255),
+            first_name VARCHAR(255),
+            gender VARCHAR(10),
+            age INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_active BOOLEAN DEFAULT TRUE
+        )
+        """,
+        # Сессии чатов
+        """
+        CREATE TABLE IF NOT EXISTS chat_sessions (
+            id SERIAL PRIMARY KEY,
+            user1_id INTEGER NOT NULL REFERENCES users(id),
+            user2_id INTEGER NOT NULL REFERENCES users(id),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            ended_at TIMESTAMP,
+            message_count INTEGER DEFAULT 0,
+            UNIQUE(user1_id, user2_id)
+        )
+        """,
+        # Активные соединения
+        """
+        CREATE TABLE IF NOT EXISTS active_chats (
+            telegram_id BIGINT PRIMARY KEY,
+            partner_telegram_id BIGINT NOT NULL,
+            session_id INTEGER REFERENCES chat_sessions(id),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # Очередь поиска
+        """
+        CREATE TABLE IF NOT EXISTS search_queue (
+                telegram_id BIGINT PRIMARY KEY,
+                joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                target_gender VARCHAR(10)  -- NULL = обычный поиск, 'male'/'female' = гендерный поиск
+            )
+        """,
+        # Оценки собеседников
+        """
+        CREATE TABLE IF NOT EXISTS user_ratings (
+            id SERIAL PRIMARY KEY,
+            rater_user_id INTEGER NOT NULL REFERENCES users(id),
+            rated_user_id INTEGER NOT NULL REFERENCES users(id),
+            session_id INTEGER REFERENCES chat_sessions(id),
+            rating INTEGER CHECK (rating IN (-1, 0, 1)), -- -1=👎, 0=нет оценки, 1=👍
+            complaint TEXT,
+            complaint_category VARCHAR(50),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(rater_user_id, rated_user_id, session_id)
+        )
+        """,
+        # Премиум-подписки (покупка за Telegram Stars)
+        """
+        CREATE TABLE IF NOT EXISTS premium (
+            id SERIAL PRIMARY KEY,
+            telegram_id BIGINT UNIQUE NOT NULL,
+            stars_paid INTEGER NOT NULL,  -- сколько заплатил (49, 99, 199)
+            duration_days INTEGER NOT NULL,  -- 1, 7, 30
+            purchased_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP NOT NULL,
+            is_active BOOLEAN DEFAULT TRUE
+        )
+        """,
+        # Групповые чаты (до 3 участников)
+        """
+        CREATE TABLE IF NOT EXISTS group_chats (
+            id SERIAL PRIMARY KEY,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            ended_at TIMESTAMP,
+            message_count INTEGER DEFAULT 0,
+            is_active BOOLEAN DEFAULT TRUE
+        )
+        """,
+        # Участники групповых чатов
+        """
+        CREATE TABLE IF NOT EXISTS group_chat_members (
+            group_id INTEGER REFERENCES group_chats(id) ON DELETE CASCADE,
+            telegram_id BIGINT NOT NULL,
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (group_id, telegram_id)
+        )
+        """,
+        # Очередь для группового поиска
+        """
+        CREATE TABLE IF NOT EXISTS group_search_queue (
+            telegram_id BIGINT PRIMARY KEY,
+            target_gender VARCHAR(10),  -- NULL = случайные, 'male'/'female' = конкретный
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # Реферальная система
+        """
+        CREATE TABLE IF NOT EXISTS referrals (
+            id SERIAL PRIMARY KEY,
+            referrer_telegram_id BIGINT NOT NULL REFERENCES users(telegram_id) ON DELETE CASCADE,
+            referred_telegram_id BIGINT NOT NULL REFERENCES users(telegram_id) ON DELETE CASCADE,
+            registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            premium_hours_granted BOOLEAN DEFAULT FALSE,
+            UNIQUE(referrer_telegram_id, referred_telegram_id)
+        )
+        """,
+        # Состояния FSM (переживают перезапуск бота)
+        """
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            bot_id BIGINT NOT NULL,
+            chat_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            state VARCHAR(255),
+            data JSONB NOT NULL DEFAULT '{}'::jsonb,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (bot_id, chat_id, user_id)
+        )
+        """,
+    ]),
+    Migration(2, "Функция commit_match", [COMMIT_MATCH_FUNCTION]),
+    Migration(3, "Индексы горячих запросов", HOT_QUERY_INDEXES, transactional=False),
+    Migration(4, "Счётчик участников group_chats.member_count", GROUP_MEMBER_COUNT_TRIGGER),
+    Migration(5, "Индекс групп со свободным местом", OPEN_GROUP_INDEXES, transactional=False),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1].version
+# Ключ advisory-блокировки, под которой реплики применяют миграции по одной
+MIGRATION_LOCK_ID = 0x66657401
+# Как часто реплика проверяет, освободила ли другая блокировку миграций (секунды)
+MIGRATION_LOCK_POLL_INTERVAL = 0.5
+# Имя индекса в CREATE INDEX CONCURRENTLY IF NOT EXISTS <имя>
+CONCURRENT_INDEX_NAME = re.compile(r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)", re.I)
+
+
 # ========== БАЗА ДАННЫХ POSTGRESQL ==========
 class Database:
     """PostgreSQL база данных для Railway"""
@@ -44,158 +1660,310 @@ class Database:
     def __init__(self):
         self.dsn = DATABASE_URL
         self.pool: Optional[asyncpg.Pool] = None
+        self.matchmaker = Matchmaker()
+        self.message_counter = MessageCounter()
+        self.presence = PresenceTracker()
+        self.routes = RoutingTable()
+        self.premium_cache = PremiumCache()
+        self.profiles = ProfileCache()
+        self.stats = BotStats()
+        self.outbox = Outbox()
+        # Шина событий между репликами; None — бот работает одним процессом
+        self.bus: Optional[ClusterBus] = None
 
     async def init(self) -> bool:
         """Инициализация подключения и таблиц"""
         try:
             self.pool = await asyncpg.create_pool(
                 dsn=self.dsn,
-                min_size=1,
-                max_size=10,
+                min_size=DB_POOL_MIN_SIZE,
+                max_size=DB_POOL_MAX_SIZE,
                 command_timeout=60,
                 server_settings={
                     'client_encoding': 'UTF8'
                 }
             )
-            await self._create_tables()
+            await self._migrate()
+            if self.bus is not None:
+                # Слушаем события до загрузки очереди — иначе изменения между ними потеряются
+                await self.bus.connect()
+            await self._load_search_queue()
+            await self.reconcile_stats()
             logger.info("✅ База данных PostgreSQL подключена")
             return True
         except Exception as e:
             logger.error(f"❌ Ошибка подключения к PostgreSQL: {e}")
             return False
 
-    async def _create_tables(self):
-        """Создание необходимых таблиц"""
+    async def _migrate(self):
+        """Применить недостающие миграции схемы"""
         async with self.pool.acquire() as conn:
-            # Пользователи
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id SERIAL PRIMARY KEY,
-                    telegram_id BIGINT UNIQUE NOT NULL,
-                    username VARCHAR(255),
-                    first_name VARCHAR(255),
-                    gender VARCHAR(10),
-                    age INTEGER,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    is_active BOOLEAN DEFAULT TRUE
-                )
-            """)
+            # Быстрый путь: схема актуальна — один запрос
+            current = await self._schema_version(conn)
+            if current >= SCHEMA_VERSION:
+                logger.info(f"✅ Схема БД актуальна (версия {current})")
+                return
 
-            # Сессии чатов
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS chat_sessions (
-                    id SERIAL PRIMARY KEY,
-                    user1_id INTEGER NOT NULL REFERENCES users(id),
-                    user2_id INTEGER NOT NULL REFERENCES users(id),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    ended_at TIMESTAMP,
-                    message_count INTEGER DEFAULT 0,
-                    UNIQUE(user1_id, user2_id)
-                )
-            """)
+            # Реплики применяют миграции по очереди. Ждём блокировку опросом, а не
+            # pg_advisory_lock: висящий запрос — старый снимок, и CREATE INDEX CONCURRENTLY
+            # у держателя блокировки ждал бы его, а он — держателя (deadlock)
+            while not await conn.fetchval("SELECT pg_try_advisory_lock($1)", MIGRATION_LOCK_ID):
+                await asyncio.sleep(MIGRATION_LOCK_POLL_INTERVAL)
+            try:
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS schema_version (
+                        version INTEGER PRIMARY KEY,
+                        description TEXT,
+                        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
 
-            # Активные соединения
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS active_chats (
-                    telegram_id BIGINT PRIMARY KEY,
-                    partner_telegram_id BIGINT NOT NULL,
-                    session_id INTEGER REFERENCES chat_sessions(id),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                # Пока ждали блокировку, миграции могла применить другая реплика
+                current = await self._schema_version(conn)
+                for migration in MIGRATIONS:
+                    if migration.version <= current:
+                        continue
+                    logger.info(f"🔄 Миграция {migration.version}: {migration.description}")
+                    await self._apply_migration(conn, migration)
+
+                logger.info(f"✅ Схема БД обновлена до версии {SCHEMA_VERSION}")
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_ID)
+
+    @staticmethod
+    async def _schema_version(conn) -> int:
+        try:
+            return await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+        except asyncpg.UndefinedTableError:
+            return 0
+
+    @staticmethod
+    async def _apply_migration(conn, migration: Migration):
+        if migration.transactional:
+            async with conn.transaction():
+                for statement in migration.statements:
+                    await conn.execute(statement)
+                await conn.execute(
+                    "INSERT INTO schema_version (version, description) VALUES ($1, $2)",
+                    migration.version, migration.description
                 )
-            """)
+            return
 
-            # Очередь поиска
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS search_queue (
-                        telegram_id BIGINT PRIMARY KEY,
-                        joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        target_gender VARCHAR(10)  -- NULL = обычный поиск, 'male'/'female' = гендерный поиск
-                    )
+        # CONCURRENTLY нельзя в транзакции. Прерванная сборка оставляет невалидный индекс,
+        # который IF NOT EXISTS пропустил бы, — удаляем такие перед повтором. Только индексы
+        # этой миграции: невалиден и индекс, который сейчас строит другая сессия
+        names = [m.group(1) for m in map(CONCURRENT_INDEX_NAME.search, migration.statements) if m]
+        invalid = await conn.fetch("""
+            SELECT c.relname
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE NOT i.indisvalid AND n.nspname = current_schema()
+              AND c.relname = ANY($1::text[])
+        """, names)
+        for row in invalid:
+            logger.warning(f"Удаляем невалидный индекс {row['relname']}")
+            await conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{row["relname"]}"')
+
+        for statement in migration.statements:
+            await conn.execute(statement)
+        await conn.execute(
+            "INSERT INTO schema_version (version, description) VALUES ($1, $2)",
+            migration.version, migration.description
+        )
+
+    async def _load_search_queue(self):
+        """Восстановить очередь поиска в памяти из search_queue после перезапуска.
+
+        Новая очередь собирается отдельно и подменяет текущую целиком: пока идёт запрос,
+        поиск работает со старой. Кто встал в неё или ушёл за это время — берём из неё, а не из снимка.
+        """
+        live = self.matchmaker
+        live.track_changes()
+        try:
+            async with self.get_connection() as conn:
+                rows = await conn.fetch("""
+                    SELECT sq.telegram_id, sq.target_gender, u.gender
+                    FROM search_queue sq
+                    JOIN users u ON u.telegram_id = sq.telegram_id
+                    WHERE u.gender IS NOT NULL
+                    ORDER BY sq.joined_at ASC
                 """)
+        finally:
+            changed = live.changed()
+
+        matchmaker = Matchmaker()
+        for row in rows:
+            matchmaker.add(row['telegram_id'], row['gender'], row['target_gender'])
+        for telegram_id in changed:
+            matchmaker.remove(telegram_id)
+            entry = live.entry(telegram_id)
+            if entry:
+                matchmaker.add(telegram_id, entry[0], entry[1])
+        self.matchmaker = matchmaker
+        logger.info(f"✅ Очередь поиска восстановлена: {len(self.matchmaker)} пользователей")
+
+    # ========== СОБЫТИЯ КЛАСТЕРА ==========
+    @property
+    def is_leader(self) -> bool:
+        """Выполнять ли фоновые задачи, нужные в одном экземпляре"""
+        return self.bus is None or self.bus.is_leader
+
+    def attach_bus(self, bus: ClusterBus):
+        """Применять события других реплик к очереди, маршрутам, кэшам и счётчикам"""
+        self.bus = bus
+        bus.resync_callbacks.append(self.resync)
+        for kind in ("search_join", "search_leave", "group_queue_join", "group_queue_leave",
+                     "chat_start", "chat_end", "group", "group_leave", "groups_closed", "routes",
+                     "profile", "premium"):
+            bus.subscribe(kind, getattr(self, f"_on_{kind}"))
+
+    async def publish(self, kind: str, **data):
+        """Разослать событие другим репликам; внутри транзакции оно уйдёт при коммите"""
+        if self.bus is None:
+            return
+        async with self.get_connection() as conn:
+            await conn.execute("SELECT pg_notify($1, $2)", CLUSTER_CHANNEL, self.bus.encode(kind, data))
+
+    async def publish_ids(self, kind: str, ids: list):
+        """Событие со списком ID, порезанное на части по CLUSTER_EVENT_CHUNK"""
+        for start in range(0, len(ids), CLUSTER_EVENT_CHUNK):
+            await self.publish(kind, ids=ids[start:start + CLUSTER_EVENT_CHUNK])
+
+    async def resync(self):
+        """Перечитать состояние в памяти после пропуска событий кластера"""
+        self.routes = RoutingTable()
+        self.premium_cache = PremiumCache()
+        self.profiles = ProfileCache()
+        await self._load_search_queue()
+        await self.reconcile_stats()
+
+    def _on_search_join(self, user: int, gender: str, target: Optional[str]):
+        self.matchmaker.add(user, gender, target)
+
+    def _on_search_leave(self, ids: list):
+        for telegram_id in ids:
+            self.matchmaker.remove(telegram_id)
+
+    def _on_group_queue_join(self, user: int, target: Optional[str]):
+        self.stats.on_group_enqueue(user, target)
+
+    def _on_group_queue_leave(self, ids: list):
+        self.stats.on_group_dequeue(*ids)
+
+    def _on_chat_start(self, user: int, partner: int, session: int):
+        self.matchmaker.remove(user)
+        self.matchmaker.remove(partner)
+        self.routes.set_pair(user, partner, session)
+        self.stats.on_chat_start(user, partner)
+
+    def _on_chat_end(self, ids: list):
+        self.routes.invalidate(*ids)
+        self.stats.on_chat_end(*ids)
+
+    def _on_group(self, group: int, members: list):
+        self.routes.invalidate(*members)
+        self.routes.set_group(group, members)
+        self.stats.on_group_dequeue(*members)
+        self.stats.on_group_size(group, len(members))
+
+    def _on_group_leave(self, user: int, group: int, close: bool):
+        self.routes.invalidate(user)
+        self.stats.on_group_leave(group, close)
+
+    def _on_groups_closed(self, ids: list):
+        for group_id in ids:
+            self.stats.on_group_size(group_id, 0)
+
+    def _on_routes(self, ids: list):
+        self.routes.invalidate(*ids)
+
+    def _on_profile(self, user: int, signup: bool = False, gender: Optional[str] = None,
+                    old_gender: Optional[str] = None, is_new: bool = False):
+        self.profiles.invalidate(user)
+        if signup:
+            self.stats.on_signup()
+        if gender is not None:
+            self.stats.on_gender_change(old_gender, gender, is_new)
+
+    def _on_premium(self, user: int, expires: str):
+        expires_at = datetime.fromisoformat(expires)
+        self.premium_cache.set(user, expires_at)
+        self.stats.on_premium(user, expires_at)
 
-            # Оценки собеседников
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS user_ratings (
-                    id SERIAL PRIMARY KEY,
-                    rater_user_id INTEGER NOT NULL REFERENCES users(id),
-                    rated_user_id INTEGER NOT NULL REFERENCES users(id),
-                    session_id INTEGER REFERENCES chat_sessions(id),
-                    rating INTEGER CHECK (rating IN (-1, 0, 1)), -- -1=👎, 0=нет оценки, 1=👍
-                    complaint TEXT,
-                    complaint_category VARCHAR(50),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(rater_user_id, rated_user_id, session_id)
-                )
-            """)
+    @asynccontextmanager
+    async def connection_scope(self):
+        """Область, в которой все get_connection() текущей задачи получают одно соединение"""
+        scope = CONNECTION_SCOPE.get()
+        if scope is not None and scope.owned():
+            yield scope
+            return
 
-            # Премиум-подписки (покупка за Telegram Stars)
-            await conn.execute("""
-                            CREATE TABLE IF NOT EXISTS premium (
-                                id SERIAL PRIMARY KEY,
-                                telegram_id BIGINT UNIQUE NOT NULL,
-                                stars_paid INTEGER NOT NULL,  -- сколько заплатил (49, 99, 199)
-                                duration_days INTEGER NOT NULL,  -- 1, 7, 30
-                                purchased_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                                expires_at TIMESTAMP NOT NULL,
-                                is_active BOOLEAN DEFAULT TRUE
-                            )
-                        """)
-
-            # Групповые чаты (до 3 участников)
-            await conn.execute("""
-                            CREATE TABLE IF NOT EXISTS group_chats (
-                                id SERIAL PRIMARY KEY,
-                                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                                ended_at TIMESTAMP,
-                                message_count INTEGER DEFAULT 0,
-                                is_active BOOLEAN DEFAULT TRUE
-                            )
-                        """)
-
-            # Участники групповых чатов
-            await conn.execute("""
-                            CREATE TABLE IF NOT EXISTS group_chat_members (
-                                group_id INTEGER REFERENCES group_chats(id) ON DELETE CASCADE,
-                                telegram_id BIGINT NOT NULL,
-                                joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                                PRIMARY KEY (group_id, telegram_id)
-                            )
-                        """)
-
-            # Очередь для группового поиска
-            await conn.execute("""
-                            CREATE TABLE IF NOT EXISTS group_search_queue (
-                                telegram_id BIGINT PRIMARY KEY,
-                                target_gender VARCHAR(10),  -- NULL = случайные, 'male'/'female' = конкретный
-                                joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                            )
-                        """)
-
-            # Реферальная система
-            await conn.execute("""
-                            CREATE TABLE IF NOT EXISTS referrals (
-                                id SERIAL PRIMARY KEY,
-                                referrer_telegram_id BIGINT NOT NULL REFERENCES users(telegram_id) ON DELETE CASCADE,
-                                referred_telegram_id BIGINT NOT NULL REFERENCES users(telegram_id) ON DELETE CASCADE,
-                                registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                                premium_hours_granted BOOLEAN DEFAULT FALSE,
-                                UNIQUE(referrer_telegram_id, referred_telegram_id)
-                            )
-                        """)
-
-            logger.info("✅ Таблицы созданы/проверены")
+        scope = ConnectionScope(self.pool)
+        token = CONNECTION_SCOPE.set(scope)
+        try:
+            yield scope
+        finally:
+            CONNECTION_SCOPE.reset(token)
+            await scope.release()
 
     @asynccontextmanager
     async def get_connection(self):
-        """Контекстный менеджер для подключений"""
-        async with self.pool.acquire() as conn:
-            yield conn
+        """Контекстный менеджер для подключений: соединение области текущей задачи или новое из пула.
+
+        Вложенные вызовы в той же задаче получают то же соединение — метод,
+        держащий транзакцию, не занимает второе соединение из пула.
+        """
+        async with self.connection_scope() as scope:
+            yield await scope.connection()
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Транзакция на соединении области: вложенные методы Database выполняются внутри неё.
+
+        Уведомления из notify() уходят в Outbox только после коммита внешней транзакции;
+        при откате они отбрасываются.
+        """
+        if PENDING_NOTIFICATIONS.get() is not None:
+            # Вложенная транзакция (savepoint) — уведомления копятся во внешней
+            async with self.get_connection() as conn:
+                async with conn.transaction():
+                    yield conn
+            return
+
+        pending = []
+        token = PENDING_NOTIFICATIONS.set(pending)
+        committed = False
+        try:
+            async with self.get_connection() as conn:
+                async with conn.transaction():
+                    yield conn
+            committed = True
+        finally:
+            PENDING_NOTIFICATIONS.reset(token)
+        if committed:
+            for notification in pending:
+                self.outbox.put(notification)
+
+    def notify(self, chat_id: int, text: str, **kwargs):
+        """Отправить сообщение после коммита текущей транзакции (вне транзакции — сразу в очередь)"""
+        notification = Notification(chat_id, text, **kwargs)
+        pending = PENDING_NOTIFICATIONS.get()
+        if pending is not None:
+            pending.append(notification)
+        else:
+            self.outbox.put(notification)
 
     async def ensure_user(self, telegram_id: int, username: str, first_name: str):
         """Создать или обновить пользователя"""
+        # Известный пользователь с теми же именами — только отметка активности, без записи в users
+        profile = await self._load_profile(telegram_id)
+        if profile and profile['username'] == username and profile['first_name'] == first_name:
+            self.presence.touch(telegram_id)
+            return
+
         async with self.get_connection() as conn:
-            await conn.execute("""
+            user = await conn.fetchrow("""
                 INSERT INTO users (telegram_id, username, first_name, last_seen)
                 VALUES ($1, $2, $3, CURRENT_TIMESTAMP)
                 ON CONFLICT (telegram_id) DO UPDATE SET
@@ -203,35 +1971,65 @@ class Database:
                     first_name = EXCLUDED.first_name,
                     last_seen = EXCLUDED.last_seen,
                     is_active = TRUE
+                RETURNING id, telegram_id, username, first_name, gender, age, (xmax = 0) AS inserted
             """, telegram_id, username, first_name)
+        profile = dict(user)
+        signup = profile.pop('inserted')
+        if signup:
+            self.stats.on_signup()
+        self.profiles.put(profile)
+        await self.publish("profile", user=telegram_id, signup=signup)
+
+    async def _load_profile(self, telegram_id: int) -> Optional[dict]:
+        """Профиль из кэша, при промахе — из БД"""
+        profile = self.profiles.get(telegram_id)
+        if profile is not None:
+            return profile
 
-    async def get_user_profile(self, telegram_id: int) -> Optional[dict]:
-        """Получить профиль пользователя"""
         async with self.get_connection() as conn:
             user = await conn.fetchrow("""
-                SELECT telegram_id, username, first_name, gender, age 
+                SELECT id, telegram_id, username, first_name, gender, age
                 FROM users WHERE telegram_id = $1
             """, telegram_id)
 
-            if user:
-                return dict(user)
+        if not user:
             return None
+        profile = dict(user)
+        self.profiles.put(profile)
+        return profile
+
+    async def get_user_profile(self, telegram_id: int) -> Optional[dict]:
+        """Получить профиль пользователя"""
+        profile = await self._load_profile(telegram_id)
+        # Копия — вызывающий код не должен менять закэшированный профиль
+        return dict(profile) if profile else None
 
     async def get_user_gender(self, telegram_id: int) -> Optional[str]:
         """Получить пол пользователя"""
-        async with self.get_connection() as conn:
-            result = await conn.fetchrow("""
-                SELECT gender FROM users WHERE telegram_id = $1
-            """, telegram_id)
-            return result['gender'] if result else None
+        profile = await self._load_profile(telegram_id)
+        return profile['gender'] if profile else None
+
+    async def get_user_internal_id(self, telegram_id: int) -> Optional[int]:
+        """users.id по telegram_id"""
+        profile = await self._load_profile(telegram_id)
+        return profile['id'] if profile else None
 
     async def update_user_gender(self, telegram_id: int, gender: str):
         """Обновить пол пользователя"""
         async with self.get_connection() as conn:
-            await conn.execute("""
-                UPDATE users SET gender = $1 
-                WHERE telegram_id = $2
+            # Прежний пол нужен счётчикам /stats
+            row = await conn.fetchrow("""
+                UPDATE users u SET gender = $1
+                FROM (SELECT gender FROM users WHERE telegram_id = $2 FOR UPDATE) old
+                WHERE u.telegram_id = $2
+                RETURNING old.gender AS old_gender,
+                          u.created_at >= CURRENT_TIMESTAMP - INTERVAL '24 hours' AS is_new
             """, gender, telegram_id)
+        self.profiles.update(telegram_id, gender=gender)
+        if row:
+            self.stats.on_gender_change(row['old_gender'], gender, bool(row['is_new']))
+            await self.publish("profile", user=telegram_id, gender=gender,
+                               old_gender=row['old_gender'], is_new=bool(row['is_new']))
 
     async def update_user_age(self, telegram_id: int, age: int):
         """Обновить возраст пользователя"""
@@ -240,11 +2038,17 @@ class Database:
                 UPDATE users SET age = $1 
                 WHERE telegram_id = $2
             """, age, telegram_id)
+        self.profiles.update(telegram_id, age=age)
+        await self.publish("profile", user=telegram_id)
 
-    async def add_to_search(self, telegram_id: int, target_gender: Optional[str] = None):
+    async def add_to_search(self, telegram_id: int, target_gender: Optional[str] = None,
+                            gender: Optional[str] = None):
         """Добавить в очередь поиска, с опциональным целевым полом"""
+        if target_gender not in ('male', 'female'):
+            target_gender = None
+
         async with self.get_connection() as conn:
-            if target_gender in ('male', 'female'):
+            if target_gender:
                 await conn.execute("""
                     INSERT INTO search_queue (telegram_id, target_gender)
                     VALUES ($1, $2)
@@ -261,270 +2065,111 @@ class Database:
                         target_gender = NULL
                 """, telegram_id)
 
-    async def is_in_active_group(self, telegram_id: int) -> bool:
-        """Проверяет, состоит ли пользователь в активной группе (с хотя бы 2 участниками)"""
-        async with self.get_connection() as conn:
-            result = await conn.fetchrow("""
-                SELECT gc.id
-                FROM group_chats gc
-                JOIN group_chat_members gcm ON gc.id = gcm.group_id
-                WHERE gcm.telegram_id = $1
-                  AND gc.is_active = TRUE
-                  AND (SELECT COUNT(*) FROM group_chat_members gcm2 WHERE gcm2.group_id = gc.id) >= 2
-                LIMIT 1
-            """, telegram_id)
-            return result is not None
+        # Подбор идёт в памяти, search_queue остаётся долговременной копией очереди
+        if gender is None:
+            gender = await self.get_user_gender(telegram_id)
+        if gender:
+            self.matchmaker.add(telegram_id, gender, target_gender)
+            await self.publish("search_join", user=telegram_id, gender=gender, target=target_gender)
 
     async def remove_from_search(self, telegram_id: int):
-        """Удалить из очереди поиска"""
-        async with self.get_connection() as conn:
-            await conn.execute("""
-                DELETE FROM search_queue WHERE telegram_id = $1
-            """, telegram_id)
-
-    async def remove_from_group_chat(self, telegram_id: int):
-        """Удалить пользователя из группового чата"""
-        async with self.get_connection() as conn:
-            await conn.execute("""
-                DELETE FROM group_chat_members
-                WHERE telegram_id = $1
-            """, telegram_id)
-
-    async def find_partner(self, telegram_id: int) -> Optional[Tuple[int, int]]:
-        """Обычный поиск с защитой гендерных предпочтений + логирование"""
-        async with self.get_connection() as conn:
-            # Мой пол
-            my_row = await conn.fetchrow(
-                "SELECT gender FROM users WHERE telegram_id = $1",
-                telegram_id
-            )
-            if not my_row or not my_row['gender']:
-                logger.warning(f"find_partner: пользователь {telegram_id} без пола")
-                return None
-            my_gender = my_row['gender']
-
-            logger.info(f"find_partner: пользователь {telegram_id} (пол {my_gender}) начинает обычный поиск")
-
-            partner_id = None
-            skipped_id = None
-
-            # Первый кандидат в очереди
-            candidate = await conn.fetchrow("""
-                SELECT sq.telegram_id, sq.target_gender, u.gender AS partner_gender
-                FROM search_queue sq
-                JOIN users u ON u.telegram_id = sq.telegram_id
-                WHERE sq.telegram_id != $1
-                ORDER BY sq.joined_at ASC
-                LIMIT 1
-                FOR UPDATE SKIP LOCKED
-            """, telegram_id)
-
-            if candidate:
-                candidate_id = candidate['telegram_id']
-                target_of_partner = candidate['target_gender']
-                partner_gender = candidate['partner_gender']
-
-                logger.info(
-                    f"find_partner: проверяем кандидата {candidate_id} (пол {partner_gender}, target_gender={target_of_partner})")
-
-                # Защита: если кандидат в гендерном поиске и я НЕ подхожу под его запрос
-                if target_of_partner is not None and my_gender != target_of_partner:
-                    logger.info(
-                        f"find_partner: пропускаем {candidate_id} — он ищет {target_of_partner}, а я {my_gender}")
-                    skipped_id = candidate_id
-                else:
-                    partner_id = candidate_id
-                    logger.info(f"find_partner: кандидат {candidate_id} подходит — соединяем")
-
-            # Fallback — если не подошёл или не было кандидата
-            if partner_id is None:
-                logger.info(f"find_partner: ищем fallback (пропустили: {skipped_id})")
-                if skipped_id:
-                    next_candidate = await conn.fetchrow("""
-                        SELECT sq.telegram_id
-                        FROM search_queue sq
-                        WHERE sq.telegram_id != $1
-                          AND sq.telegram_id != $2
-                        ORDER BY sq.joined_at ASC
-                        LIMIT 1
-                        FOR UPDATE SKIP LOCKED
-                    """, telegram_id, skipped_id)
-                else:
-                    next_candidate = await conn.fetchrow("""
-                        SELECT sq.telegram_id
-                        FROM search_queue sq
-                        WHERE sq.telegram_id != $1
-                        ORDER BY sq.joined_at ASC
-                        LIMIT 1
-                        FOR UPDATE SKIP LOCKED
-                    """, telegram_id)
-
-                if not next_candidate:
-                    logger.info("find_partner: никого не нашли")
-                    return None
-
-                partner_id = next_candidate['telegram_id']
-                logger.info(f"find_partner: fallback выбран — {partner_id}")
-
-            # === Создание сессии чата ===
-            user1 = await conn.fetchrow("SELECT id FROM users WHERE telegram_id = $1", telegram_id)
-            user2 = await conn.fetchrow("SELECT id FROM users WHERE telegram_id = $1", partner_id)
-
-            if not user1 or not user2:
-                logger.error(f"Не найден пользователь в БД: {telegram_id} или {partner_id}")
-                return None
-
-            existing_session = await conn.fetchrow("""
-                SELECT id FROM chat_sessions 
-                WHERE (user1_id = $1 AND user2_id = $2) 
-                   OR (user1_id = $2 AND user2_id = $1)
-                  AND ended_at IS NULL
-            """, user1['id'], user2['id'])
-
-            if existing_session:
-                session_id = existing_session['id']
-                await conn.execute("""
-                    UPDATE chat_sessions 
-                    SET ended_at = NULL, created_at = CURRENT_TIMESTAMP
-                    WHERE id = $1
-                """, session_id)
-            else:
-                session = await conn.fetchrow("""
-                    INSERT INTO chat_sessions (user1_id, user2_id)
-                    VALUES ($1, $2)
-                    ON CONFLICT (user1_id, user2_id) DO UPDATE SET
-                        ended_at = NULL, created_at = CURRENT_TIMESTAMP
-                    RETURNING id
-                """, user1['id'], user2['id'])
-                if not session:
-                    logger.error("Не удалось создать сессию чата")
-                    return None
-                session_id = session['id']
-
+        """Удалить из очереди поиска"""
+        self.matchmaker.remove(telegram_id)
+        async with self.get_connection() as conn:
             await conn.execute("""
-                INSERT INTO active_chats (telegram_id, partner_telegram_id, session_id)
-                VALUES ($1, $2, $3), ($4, $5, $6)
-                ON CONFLICT (telegram_id) DO UPDATE SET
-                    partner_telegram_id = EXCLUDED.partner_telegram_id,
-                    session_id = EXCLUDED.session_id,
-                    created_at = CURRENT_TIMESTAMP
-            """, telegram_id, partner_id, session_id, partner_id, telegram_id, session_id)
+                DELETE FROM search_queue WHERE telegram_id = $1
+            """, telegram_id)
+        await self.publish_ids("search_leave", [telegram_id])
 
+    async def remove_from_group_chat(self, telegram_id: int):
+        """Удалить пользователя из группового чата"""
+        self.routes.invalidate(telegram_id)
+        async with self.get_connection() as conn:
             await conn.execute("""
-                DELETE FROM search_queue WHERE telegram_id IN ($1, $2)
-            """, telegram_id, partner_id)
+                DELETE FROM group_chat_members
+                WHERE telegram_id = $1
+            """, telegram_id)
+        await self.publish_ids("routes", [telegram_id])
 
-            logger.info(f"find_partner: чат успешно создан {telegram_id} ↔ {partner_id} (session_id={session_id})")
-            return partner_id, session_id
+    async def find_partner(self, telegram_id: int) -> Optional[Tuple[int, int]]:
+        """Обычный поиск с защитой гендерных предпочтений + логирование"""
+        logger.info(f"find_partner: пользователь {telegram_id} начинает обычный поиск")
+        started = time.perf_counter()
+        result = await self._match_from_queue(telegram_id, "find_partner")
+        MATCH_SECONDS.observe(time.perf_counter() - started, kind="random",
+                              result="matched" if result else "none")
+        return result
 
     async def find_partner_by_gender(self, telegram_id: int, target_gender: str) -> Optional[Tuple[int, int]]:
         """Гендерный поиск с приоритетом на взаимность + логирование"""
-        async with self.get_connection() as conn:
-            my_row = await conn.fetchrow(
-                "SELECT gender FROM users WHERE telegram_id = $1",
-                telegram_id
-            )
-            if not my_row or not my_row['gender']:
-                logger.warning(f"find_partner_by_gender: пользователь {telegram_id} без пола")
-                return None
-            my_gender = my_row['gender']
-
-            logger.info(f"find_partner_by_gender: {telegram_id} (пол {my_gender}) ищет {target_gender}")
-
-            partner_id = None
-
-            # Взаимный поиск
-            mutual = await conn.fetchrow("""
-                SELECT sq.telegram_id
-                FROM search_queue sq
-                JOIN users u ON u.telegram_id = sq.telegram_id
-                WHERE sq.telegram_id != $1
-                  AND sq.target_gender = $2
-                  AND u.gender = $3
-                  AND sq.target_gender IS NOT NULL
-                ORDER BY sq.joined_at ASC
-                LIMIT 1
-                FOR UPDATE SKIP LOCKED
-            """, telegram_id, my_gender, target_gender)
-
-            if mutual:
-                partner_id = mutual['telegram_id']
-                logger.info(f"find_partner_by_gender: найден взаимный партнёр {partner_id}")
-
-            else:
-                if my_gender == target_gender:
-                    logger.info("find_partner_by_gender: строгий однополый поиск — ждём только взаимных")
-                    return None
-
-                fallback = await conn.fetchrow("""
-                    SELECT sq.telegram_id
-                    FROM search_queue sq
-                    JOIN users u ON u.telegram_id = sq.telegram_id
-                    WHERE sq.telegram_id != $1
-                      AND u.gender = $2
-                    ORDER BY sq.joined_at ASC
-                    LIMIT 1
-                    FOR UPDATE SKIP LOCKED
-                """, telegram_id, target_gender)
-
-                if fallback:
-                    partner_id = fallback['telegram_id']
-                    logger.info(f"find_partner_by_gender: fallback — любой с полом {target_gender}: {partner_id}")
-                else:
-                    logger.info("find_partner_by_gender: никого не нашли")
-                    return None
-
-            # === Создание сессии (то же самое, что в find_partner) ===
-            user1 = await conn.fetchrow("SELECT id FROM users WHERE telegram_id = $1", telegram_id)
-            user2 = await conn.fetchrow("SELECT id FROM users WHERE telegram_id = $1", partner_id)
+        logger.info(f"find_partner_by_gender: {telegram_id} ищет {target_gender}")
+        started = time.perf_counter()
+        result = await self._match_from_queue(telegram_id, "find_partner_by_gender")
+        MATCH_SECONDS.observe(time.perf_counter() - started, kind="gender",
+                              result="matched" if result else "none")
+        return result
+
+    async def match_waiting_users(self) -> list:
+        """Пакетный подбор по всей очереди 1-на-1 в порядке ожидания: [(user_id, partner_id, session_id)]"""
+        matches = []
+        for telegram_id in self.matchmaker.waiting():
+            # Пользователь мог уже получить пару раньше в этом же проходе
+            if self.matchmaker.find(telegram_id) is None:
+                continue
+            result = await self._match_from_queue(telegram_id, "match_waiting_users")
+            if result:
+                matches.append((telegram_id, *result))
+        return matches
+
+    async def _match_from_queue(self, telegram_id: int, caller: str) -> Optional[Tuple[int, int]]:
+        """Подобрать пару в памяти и записать её в БД одной транзакцией"""
+        if telegram_id not in self.matchmaker:
+            logger.warning(f"{caller}: пользователь {telegram_id} не в очереди (нет пола?)")
+            return None
 
-            if not user1 or not user2:
-                logger.error(f"Не найден пользователь в БД: {telegram_id} или {partner_id}")
-                return None
+        pair = self.matchmaker.pop_pair(telegram_id)
+        if not pair:
+            logger.info(f"{caller}: никого не нашли для {telegram_id}")
+            return None
 
-            existing_session = await conn.fetchrow("""
-                SELECT id FROM chat_sessions 
-                WHERE (user1_id = $1 AND user2_id = $2) 
-                   OR (user1_id = $2 AND user2_id = $1)
-                  AND ended_at IS NULL
-            """, user1['id'], user2['id'])
+        partner_id, my_entry, partner_entry = pair
+        logger.info(f"{caller}: кандидат {partner_id} (пол {partner_entry[0]}, "
+                    f"target_gender={partner_entry[1]}) подходит — соединяем")
 
-            if existing_session:
-                session_id = existing_session['id']
-                await conn.execute("""
-                    UPDATE chat_sessions 
-                    SET ended_at = NULL, created_at = CURRENT_TIMESTAMP
-                    WHERE id = $1
-                """, session_id)
-            else:
-                session = await conn.fetchrow("""
-                    INSERT INTO chat_sessions (user1_id, user2_id)
-                    VALUES ($1, $2)
-                    ON CONFLICT (user1_id, user2_id) DO UPDATE SET
-                        ended_at = NULL, created_at = CURRENT_TIMESTAMP
-                    RETURNING id
-                """, user1['id'], user2['id'])
-                if not session:
-                    logger.error("Не удалось создать сессию чата")
-                    return None
-                session_id = session['id']
+        try:
+            session_id = await self._commit_match(telegram_id, partner_id)
+        except Exception as e:
+            # Не удалось записать — возвращаем обоих на их места в очереди
+            logger.error(f"Не удалось создать сессию чата {telegram_id} ↔ {partner_id}: {e}")
+            self.matchmaker.restore(telegram_id, my_entry)
+            self.matchmaker.restore(partner_id, partner_entry)
+            return None
 
-            await conn.execute("""
-                INSERT INTO active_chats (telegram_id, partner_telegram_id, session_id)
-                VALUES ($1, $2, $3), ($4, $5, $6)
-                ON CONFLICT (telegram_id) DO UPDATE SET
-                    partner_telegram_id = EXCLUDED.partner_telegram_id,
-                    session_id = EXCLUDED.session_id,
-                    created_at = CURRENT_TIMESTAMP
-            """, telegram_id, partner_id, session_id, partner_id, telegram_id, session_id)
+        if session_id is None:
+            # Кто-то из пары уже не в search_queue (снят с поиска или соединён другим обработчиком) —
+            # в памяти оставляем только тех, кто действительно ждёт
+            logger.info(f"{caller}: пара {telegram_id} ↔ {partner_id} уже недоступна")
+            async with self.get_connection() as conn:
+                rows = await conn.fetch(
+                    "SELECT telegram_id FROM search_queue WHERE telegram_id = ANY($1::bigint[])",
+                    [telegram_id, partner_id]
+                )
+            still_waiting = {row['telegram_id'] for row in rows}
+            for user_id, entry in ((telegram_id, my_entry), (partner_id, partner_entry)):
+                if user_id in still_waiting:
+                    self.matchmaker.restore(user_id, entry)
+            return None
 
-            await conn.execute("""
-                DELETE FROM search_queue WHERE telegram_id IN ($1, $2)
-            """, telegram_id, partner_id)
+        self.routes.set_pair(telegram_id, partner_id, session_id)
+        self.stats.on_chat_start(telegram_id, partner_id)
+        await self.publish("chat_start", user=telegram_id, partner=partner_id, session=session_id)
+        logger.info(f"{caller}: чат успешно создан {telegram_id} ↔ {partner_id} (session_id={session_id})")
+        return partner_id, session_id
 
-            logger.info(
-                f"find_partner_by_gender: чат успешно создан {telegram_id} ↔ {partner_id} (session_id={session_id})")
-            return partner_id, session_id
+    async def _commit_match(self, telegram_id: int, partner_id: int) -> Optional[int]:
+        """Атомарно зафиксировать пару (функция commit_match); None — кто-то из пары уже не в очереди"""
+        async with self.get_connection() as conn:
+            return await conn.fetchval("SELECT commit_match($1, $2)", telegram_id, partner_id)
 
     async def add_to_group_search(self, telegram_id: int, target_gender: Optional[str] = None):
         """Добавить в очередь группового поиска"""
@@ -536,6 +2181,8 @@ class Database:
                     joined_at = CURRENT_TIMESTAMP,
                     target_gender = EXCLUDED.target_gender
             """, telegram_id, target_gender)
+        self.stats.on_group_enqueue(telegram_id, target_gender)
+        await self.publish("group_queue_join", user=telegram_id, target=target_gender)
 
     async def remove_from_group_search(self, telegram_id: int):
         """Удалить из очереди группового поиска"""
@@ -543,207 +2190,248 @@ class Database:
             await conn.execute("""
                 DELETE FROM group_search_queue WHERE telegram_id = $1
             """, telegram_id)
+        self.stats.on_group_dequeue(telegram_id)
+        await self.publish_ids("group_queue_leave", [telegram_id])
+
+    async def get_group_search_queue(self) -> list:
+        """Очередь группового поиска в порядке ожидания (с полом пользователя)"""
+        async with self.get_connection() as conn:
+            rows = await conn.fetch("""
+                SELECT gsq.telegram_id, gsq.target_gender, u.gender
+                FROM group_search_queue gsq
+                JOIN users u ON u.telegram_id = gsq.telegram_id
+                ORDER BY gsq.joined_at ASC
+            """)
+            return [dict(row) for row in rows]
+
+    async def has_open_group(self) -> bool:
+        """Есть ли активная группа со свободным местом"""
+        async with self.get_connection() as conn:
+            result = await conn.fetchrow("""
+                SELECT 1
+                FROM group_chats
+                WHERE is_active = TRUE AND member_count = 2
+                LIMIT 1
+            """)
+            return result is not None
 
-    async def find_group_partner(self, telegram_id: int, target_gender: Optional[str], bot: Bot) -> Optional[
+    async def find_group_partner(self, telegram_id: int, target_gender: Optional[str]) -> Optional[
         Tuple[list, int, bool]]:
         logger.info(f"find_group_partner вызван для {telegram_id} с target_gender={target_gender}")
 
-        async with self.get_connection() as conn:
-            async with conn.transaction():
-                # Очистка зависших групп
-                await conn.execute("""
-                    UPDATE group_chats gc
-                    SET is_active = FALSE, ended_at = CURRENT_TIMESTAMP
-                    WHERE gc.is_active = TRUE
-                      AND (SELECT COUNT(*) FROM group_chat_members gcm WHERE gcm.group_id = gc.id) = 1
-                """)
+        started = time.perf_counter()
+        async with self.transaction() as conn:
+            result = await self._find_group_partner(conn, telegram_id, target_gender)
+            if result:
+                # Другие реплики узнают о группе только при коммите
+                await self.publish("group", group=result[1], members=result[0])
+        MATCH_SECONDS.observe(time.perf_counter() - started, kind="group",
+                              result="matched" if result else "none")
+
+        # Маршруты и счётчики обновляем только после фиксации транзакции
+        if result:
+            members, group_id, _ = result
+            self.routes.set_group(group_id, members)
+            self.stats.on_group_dequeue(*members)
+            self.stats.on_group_size(group_id, len(members))
+        return result
+
+    async def _find_group_partner(self, conn, telegram_id: int, target_gender: Optional[str]) -> Optional[
+        Tuple[list, int, bool]]:
+        """Подбор группы внутри транзакции вызывающего"""
+        # Группы, где остался один участник, не считаются: их закрывает фоновая очистка
+        # 1. Уже в группе — сразу возвращаем, если пользователь состоит в активной группе
+        existing = await conn.fetchrow("""
+            SELECT gcm.group_id, gc.member_count
+            FROM group_chat_members gcm
+            JOIN group_chats gc ON gc.id = gcm.group_id
+            WHERE gcm.telegram_id = $1 AND gc.is_active = TRUE AND gc.member_count >= 2
+            LIMIT 1
+        """, telegram_id)
+
+        if existing:
+            group_id = existing['group_id']
+            members = await conn.fetch("SELECT telegram_id FROM group_chat_members WHERE group_id = $1",
+                                       group_id)
+            member_ids = [row['telegram_id'] for row in members]
+
+            # Уже в группе — в очереди ему делать нечего
+            await conn.execute("DELETE FROM group_search_queue WHERE telegram_id = $1", telegram_id)
+
+            logger.info(f"Пользователь {telegram_id} уже в группе {group_id} с {len(member_ids)} участниками")
+
+            return member_ids, group_id, False
+
+        # 2. Присоединение к неполной группе — только если совместимо с target_gender
+        candidate_group = await conn.fetchrow("""
+            SELECT id AS group_id
+            FROM group_chats
+            WHERE is_active = TRUE AND member_count = 2
+            ORDER BY created_at ASC
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        """)
 
-                # 1. Уже в группе — сразу возвращаем, если пользователь состоит в активной группе
-                existing = await conn.fetchrow("""
-                    SELECT gcm.group_id, 
-                           COUNT(*) OVER (PARTITION BY gcm.group_id) AS member_count
-                    FROM group_chat_members gcm
-                    JOIN group_chats gc ON gc.id = gcm.group_id
-                    WHERE gcm.telegram_id = $1 AND gc.is_active = TRUE
-                    LIMIT 1
-                """, telegram_id)
+        if candidate_group:
+            group_id = candidate_group['group_id']
+            logger.info(f"Найдена неполная группа {group_id}")
 
-                if existing:
-                    group_id = existing['group_id']
-                    members = await conn.fetch("SELECT telegram_id FROM group_chat_members WHERE group_id = $1",
-                                               group_id)
-                    member_ids = [row['telegram_id'] for row in members]
+            # Получаем полы участников
+            existing = await conn.fetch("""
+                SELECT u.telegram_id, u.gender
+                FROM group_chat_members gcm
+                JOIN users u ON u.telegram_id = gcm.telegram_id
+                WHERE gcm.group_id = $1
+            """, group_id)
 
-                    logger.info(f"Пользователь {telegram_id} уже в группе {group_id} с {len(member_ids)} участниками")
+            genders = [row['gender'] for row in existing if row['gender'] is not None]
+            logger.info(f"Полы в группе {group_id}: {genders}")
 
-                    return member_ids, group_id, False
+            # Проверка совместимости
+            compatible = True
+            if target_gender:
+                # Гендерный поиск: все существующие должны быть целевым полом
+                if not all(g == target_gender for g in genders):
+                    logger.info(
+                        f"Группа {group_id} НЕ подходит — существующие полы {genders}, а ищем {target_gender}. Пропускаем.")
+                    compatible = False
 
-                # 2. Присоединение к неполной группе — только если совместимо с target_gender
-                candidate_group = await conn.fetchrow("""
-                    SELECT gc.id AS group_id
-                    FROM group_chats gc
-                    WHERE gc.is_active = TRUE
-                      AND (SELECT COUNT(*) FROM group_chat_members gcm WHERE gcm.group_id = gc.id) BETWEEN 1 AND 2
-                    ORDER BY gc.created_at ASC
-                    LIMIT 1
-                    FOR UPDATE OF gc SKIP LOCKED
-                """)
+            if compatible:
+                # Подходит — присоединяемся
+                before_count = len(existing)
 
-                if candidate_group:
-                    group_id = candidate_group['group_id']
-                    logger.info(f"Найдена неполная группа {group_id}")
-
-                    # Получаем полы участников
-                    existing = await conn.fetch("""
-                        SELECT u.telegram_id, u.gender
-                        FROM group_chat_members gcm
-                        JOIN users u ON u.telegram_id = gcm.telegram_id
-                        WHERE gcm.group_id = $1
-                    """, group_id)
-
-                    genders = [row['gender'] for row in existing if row['gender'] is not None]
-                    logger.info(f"Полы в группе {group_id}: {genders}")
-
-                    # Проверка совместимости
-                    compatible = True
-                    if target_gender:
-                        # Гендерный поиск: все существующие должны быть целевым полом
-                        if not all(g == target_gender for g in genders):
-                            logger.info(
-                                f"Группа {group_id} НЕ подходит — существующие полы {genders}, а ищем {target_gender}. Пропускаем.")
-                            compatible = False
-
-                    if compatible:
-                        # Подходит — присоединяемся
-                        before_count = len(existing)
-
-                        await conn.execute(
-                            "INSERT INTO group_chat_members (group_id, telegram_id) VALUES ($1, $2) ON CONFLICT DO NOTHING",
-                            group_id, telegram_id)
-                        await self.remove_from_group_search(telegram_id)
-
-                        after_count = before_count + 1
-                        after_ids = [row['telegram_id'] for row in existing] + [telegram_id]
-
-                        if after_count < 2:
-                            await conn.execute("DELETE FROM group_chat_members WHERE group_id = $1", group_id)
-                            await conn.execute("UPDATE group_chats SET is_active = FALSE WHERE id = $1", group_id)
-                            return None
-
-                        # === УВЕДОМЛЕНИЯ ПРИ ПРИСОЕДИНЕНИИ ===
-                        initiator_id = telegram_id
-
-                        # Новому участнику
-                        await bot.send_message(
-                            initiator_id,
-                            f"👥 Вы присоединились к групповому чату!\n\n"
-                            f"Участников: {after_count}\n\n"
-                            f"/leave - Покинуть групповой чат",
-                            parse_mode="HTML"
-                        )
+                await conn.execute(
+                    "INSERT INTO group_chat_members (group_id, telegram_id) VALUES ($1, $2) ON CONFLICT DO NOTHING",
+                    group_id, telegram_id)
+                await conn.execute("DELETE FROM group_search_queue WHERE telegram_id = $1", telegram_id)
+
+                after_count = before_count + 1
+                after_ids = [row['telegram_id'] for row in existing] + [telegram_id]
 
-                        # Существующим участникам — только если стал третий
-                        if before_count == 2 and after_count == 3:
-                            for old in [r['telegram_id'] for r in existing]:
-                                await bot.send_message(
-                                    old,
-                                    f"👤 Новый участник присоединился к чату!\n\n"
-                                    f"Теперь в чате {after_count} участников"
-                                )
-
-                        # ВАЖНО: возвращаем True только для присоединения,
-                        # но уведомления "чат создан" больше не отправляем здесь
-                        return after_ids, group_id, True
-
-                # 3. Создание новой группы — с поддержкой постепенного заполнения
-                logger.info(f"Создаём новую группу для {telegram_id} с target_gender={target_gender}")
-
-                my_gender_row = await conn.fetchrow("SELECT gender FROM users WHERE telegram_id = $1", telegram_id)
-                my_gender = my_gender_row['gender'] if my_gender_row else None
-                if not my_gender:
-                    logger.warning(f"Пользователь {telegram_id} без пола — не можем создать группу")
+                if after_count < 2:
+                    await conn.execute("DELETE FROM group_chat_members WHERE group_id = $1", group_id)
+                    await conn.execute("UPDATE group_chats SET is_active = FALSE WHERE id = $1", group_id)
                     return None
-                logger.info(f"Мой пол: {my_gender}")
-
-                base_query = """
-                    SELECT gsq.telegram_id, u.gender, gsq.target_gender
-                    FROM group_search_queue gsq
-                    JOIN users u ON u.telegram_id = gsq.telegram_id
-                    WHERE gsq.telegram_id != $1
-                """
-                base_params = [telegram_id]
-
-                partners = []
-
-                if target_gender:
-                    # === ГЕНДЕРНЫЙ ПОИСК ===
-                    # Приоритет: случайные нужного пола (чтобы не смешиваться с другими гендерными искателями)
-                    # Этап 1: ищем случайных нужного пола
-                    random_gender_query = base_query + " AND u.gender = $2 AND gsq.target_gender IS NULL ORDER BY gsq.joined_at ASC LIMIT 2 FOR UPDATE SKIP LOCKED"
-                    random_params = [telegram_id, target_gender]
-                    random_partners = await conn.fetch(random_gender_query, *random_params)
-
-                    if random_partners:
-                        logger.info(f"Гендерный поиск: найдены случайные нужного пола ({len(random_partners)})")
-                        partners = random_partners
-                    else:
-                        # Этап 2: случайных нет — берём ОДНОГО, кто ищет мой пол (взаимность)
-                        mutual_gender_query = base_query + " AND u.gender = $2 AND gsq.target_gender = $3 ORDER BY gsq.joined_at ASC LIMIT 1 FOR UPDATE SKIP LOCKED"
-                        mutual_params = [telegram_id, target_gender, my_gender]
-                        partners = await conn.fetch(mutual_gender_query, *mutual_params)
-                        logger.info(f"Гендерный поиск: случайных нет, найден 1 взаимный (ищущий {my_gender})")
-
-                    if not partners:
-                        logger.info("Гендерный поиск: никого не найдено — ждём")
-                else:
-                    # === СЛУЧАЙНЫЙ ПОИСК (остаётся как было) ===
-                    mutual_query = base_query + " AND gsq.target_gender = $2 ORDER BY gsq.joined_at ASC LIMIT 1 FOR UPDATE SKIP LOCKED"
-                    mutual_params = [telegram_id, my_gender]
-                    mutual_partners = await conn.fetch(mutual_query, *mutual_params)
-
-                    if mutual_partners:
-                        logger.info(f"Случайный поиск: найден 1 взаимный партнёр")
-                        partners = mutual_partners
-                    else:
-                        random_query = base_query + " AND gsq.target_gender IS NULL ORDER BY gsq.joined_at ASC LIMIT 2 FOR UPDATE SKIP LOCKED"
-                        partners = await conn.fetch(random_query, *base_params)
-                        logger.info(f"Случайный поиск: берём случайных ({len(partners)})")
-
-                logger.info(
-                    f"Найдено подходящих партнёров: {[(p['telegram_id'], p['gender'], p['target_gender']) for p in partners]}"
+
+                # === УВЕДОМЛЕНИЯ ПРИ ПРИСОЕДИНЕНИИ ===
+                # Отправятся после коммита — не держим блокировки group_chats на время запросов к Telegram
+                initiator_id = telegram_id
+
+                # Новому участнику
+                self.notify(
+                    initiator_id,
+                    f"👥 Вы присоединились к групповому чату!\n\n"
+                    f"Участников: {after_count}\n\n"
+                    f"/leave - Покинуть групповой чат",
+                    parse_mode="HTML"
                 )
 
-                if len(partners) == 0:
-                    logger.info("Нет подходящих партнёров — ждём первого")
-                    return None
+                # Существующим участникам — только если стал третий
+                if before_count == 2 and after_count == 3:
+                    for old in [r['telegram_id'] for r in existing]:
+                        self.notify(
+                            old,
+                            f"👤 Новый участник присоединился к чату!\n\n"
+                            f"Теперь в чате {after_count} участников"
+                        )
 
-                # Создаём группу
-                partner_ids = [row['telegram_id'] for row in partners]
-                all_members = [telegram_id] + partner_ids
+                # ВАЖНО: возвращаем True только для присоединения,
+                # но уведомления "чат создан" больше не отправляем здесь
+                return after_ids, group_id, True
 
-                new_group = await conn.fetchrow("INSERT INTO group_chats DEFAULT VALUES RETURNING id")
-                group_id = new_group['id']
+        # 3. Создание новой группы — с поддержкой постепенного заполнения
+        logger.info(f"Создаём новую группу для {telegram_id} с target_gender={target_gender}")
 
-                for member in all_members:
-                    await conn.execute(
-                        "INSERT INTO group_chat_members (group_id, telegram_id) VALUES ($1, $2)",
-                        group_id, member
-                    )
+        # Профиль из кэша; при промахе читаем на своём соединении, не занимая второе из пула
+        profile = self.profiles.get(telegram_id)
+        if profile is not None:
+            my_gender = profile['gender']
+        else:
+            my_gender = await conn.fetchval("SELECT gender FROM users WHERE telegram_id = $1", telegram_id)
+        if not my_gender:
+            logger.warning(f"Пользователь {telegram_id} без пола — не можем создать группу")
+            return None
+        logger.info(f"Мой пол: {my_gender}")
+
+        base_query = """
+            SELECT gsq.telegram_id, u.gender, gsq.target_gender
+            FROM group_search_queue gsq
+            JOIN users u ON u.telegram_id = gsq.telegram_id
+            WHERE gsq.telegram_id != $1
+        """
+        base_params = [telegram_id]
+
+        partners = []
+
+        if target_gender:
+            # === ГЕНДЕРНЫЙ ПОИСК ===
+            # Приоритет: случайные нужного пола (чтобы не смешиваться с другими гендерными искателями)
+            # Этап 1: ищем случайных нужного пола
+            random_gender_query = base_query + " AND u.gender = $2 AND gsq.target_gender IS NULL ORDER BY gsq.joined_at ASC LIMIT 2 FOR UPDATE SKIP LOCKED"
+            random_params = [telegram_id, target_gender]
+            random_partners = await conn.fetch(random_gender_query, *random_params)
+
+            if random_partners:
+                logger.info(f"Гендерный поиск: найдены случайные нужного пола ({len(random_partners)})")
+                partners = random_partners
+            else:
+                # Этап 2: случайных нет — берём ОДНОГО, кто ищет мой пол (взаимность)
+                mutual_gender_query = base_query + " AND u.gender = $2 AND gsq.target_gender = $3 ORDER BY gsq.joined_at ASC LIMIT 1 FOR UPDATE SKIP LOCKED"
+                mutual_params = [telegram_id, target_gender, my_gender]
+                partners = await conn.fetch(mutual_gender_query, *mutual_params)
+                logger.info(f"Гендерный поиск: случайных нет, найден 1 взаимный (ищущий {my_gender})")
+
+            if not partners:
+                logger.info("Гендерный поиск: никого не найдено — ждём")
+        else:
+            # === СЛУЧАЙНЫЙ ПОИСК (остаётся как было) ===
+            mutual_query = base_query + " AND gsq.target_gender = $2 ORDER BY gsq.joined_at ASC LIMIT 1 FOR UPDATE SKIP LOCKED"
+            mutual_params = [telegram_id, my_gender]
+            mutual_partners = await conn.fetch(mutual_query, *mutual_params)
+
+            if mutual_partners:
+                logger.info(f"Случайный поиск: найден 1 взаимный партнёр")
+                partners = mutual_partners
+            else:
+                random_query = base_query + " AND gsq.target_gender IS NULL ORDER BY gsq.joined_at ASC LIMIT 2 FOR UPDATE SKIP LOCKED"
+                partners = await conn.fetch(random_query, *base_params)
+                logger.info(f"Случайный поиск: берём случайных ({len(partners)})")
+
+        logger.info(
+            f"Найдено подходящих партнёров: {[(p['telegram_id'], p['gender'], p['target_gender']) for p in partners]}"
+        )
+
+        if len(partners) == 0:
+            logger.info("Нет подходящих партнёров — ждём первого")
+            return None
+
+        # Создаём группу
+        partner_ids = [row['telegram_id'] for row in partners]
+        all_members = [telegram_id] + partner_ids
+
+        new_group = await conn.fetchrow("INSERT INTO group_chats DEFAULT VALUES RETURNING id")
+        group_id = new_group['id']
 
-                await conn.execute("DELETE FROM group_search_queue WHERE telegram_id = ANY($1)", all_members)
+        for member in all_members:
+            await conn.execute(
+                "INSERT INTO group_chat_members (group_id, telegram_id) VALUES ($1, $2)",
+                group_id, member
+            )
+
+        await conn.execute("DELETE FROM group_search_queue WHERE telegram_id = ANY($1)", all_members)
 
-                logger.info(f"Создана группа {group_id} с участниками {all_members} (ожидаем до 3)")
+        logger.info(f"Создана группа {group_id} с участниками {all_members} (ожидаем до 3)")
 
-                return all_members, group_id, False
+        return all_members, group_id, False
 
     async def add_to_group_chat(self, group_id: int, telegram_id: int) -> bool:
         """Добавить третьего участника в существующий групповой чат"""
         async with self.get_connection() as conn:
             # Проверяем, есть ли уже 3 участника
-            count = await conn.fetchrow("""
-                SELECT COUNT(*) as cnt FROM group_chat_members WHERE group_id = $1
+            member_count = await conn.fetchval("""
+                SELECT member_count FROM group_chats WHERE id = $1
             """, group_id)
-            if count['cnt'] >= 3:
+            if member_count is None or member_count >= 3:
                 return False
 
             # Добавляем нового
@@ -756,6 +2444,12 @@ class Database:
             # Удаляем из очереди
             await self.remove_from_group_search(telegram_id)
 
+            self.routes.invalidate(telegram_id)
+            members = await conn.fetch("SELECT telegram_id FROM group_chat_members WHERE group_id = $1", group_id)
+            members = [row['telegram_id'] for row in members]
+            self.routes.set_group(group_id, members)
+            self.stats.on_group_size(group_id, len(members))
+            await self.publish("group", group=group_id, members=members)
             return True
 
     async def get_group_id(self, telegram_id: int) -> Optional[int]:
@@ -838,9 +2532,261 @@ class Database:
             await conn.execute("""
                 DELETE FROM group_chat_members WHERE telegram_id = ANY($1)
             """, members)
+            self.routes.invalidate(*members)
+            await self.publish_ids("routes", members)
+
+    async def leave_group(self, telegram_id: int, group_id: int, close_group: bool):
+        """Выйти из группового чата; close_group — группа опустела, деактивировать её"""
+        async with self.get_connection() as conn:
+            await conn.execute("""
+                DELETE FROM group_chat_members 
+                WHERE telegram_id = $1
+            """, telegram_id)
+            logger.info(f"Пользователь {telegram_id} удален из group_chat_members")
+
+            # Если группа почти пуста, деактивируем её; строки участников удалит фоновая очистка
+            if close_group:
+                await conn.execute("""
+                    UPDATE group_chats 
+                    SET is_active = FALSE, ended_at = CURRENT_TIMESTAMP 
+                    WHERE id = $1
+                """, group_id)
+                logger.info(f"Группа {group_id} деактивирована")
+
+        # Состав группы изменился — маршруты всех участников устарели
+        self.routes.invalidate(telegram_id)
+        self.stats.on_group_leave(group_id, close_group)
+        await self.publish("group_leave", user=telegram_id, group=group_id, close=close_group)
+
+    # ========== ФОНОВАЯ ОЧИСТКА ==========
+    async def _reclaim(self, query: str, *args) -> list:
+        """Выполнить запрос очистки пачками по JANITOR_BATCH_SIZE; вернуть все возвращённые строки"""
+        reclaimed = []
+        for _ in range(JANITOR_MAX_BATCHES):
+            # Каждая пачка — отдельный короткий запрос, блокировки не копятся
+            async with self.get_connection() as conn:
+                rows = await conn.fetch(query, JANITOR_BATCH_SIZE, *args)
+            reclaimed.extend(rows)
+            if len(rows) < JANITOR_BATCH_SIZE:
+                break
+        return reclaimed
+
+    async def cleanup_stale_groups(self) -> Tuple[int, int]:
+        """Закрыть активные группы меньше чем из 2 участников и удалить участников закрытых групп"""
+        closed = await self._reclaim("""
+            UPDATE group_chats
+            SET is_active = FALSE, ended_at = CURRENT_TIMESTAMP
+            WHERE id IN (
+                SELECT id FROM group_chats
+                WHERE is_active = TRUE AND member_count < 2
+                LIMIT $1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id
+        """)
+
+        members = await self._reclaim("""
+            DELETE FROM group_chat_members
+            WHERE ctid IN (
+                SELECT gcm.ctid
+                FROM group_chat_members gcm
+                JOIN group_chats gc ON gc.id = gcm.group_id
+                WHERE gc.is_active = FALSE
+                LIMIT $1
+            )
+            RETURNING telegram_id
+        """)
+        self.routes.invalidate(*[row['telegram_id'] for row in members])
+        for row in closed:
+            self.stats.on_group_size(row['id'], 0)
+        await self.publish_ids("routes", [row['telegram_id'] for row in members])
+        await self.publish_ids("groups_closed", [row['id'] for row in closed])
+        return len(closed), len(members)
+
+    async def cleanup_search_queues(self) -> Tuple[int, int]:
+        """Удалить из очередей тех, кто уже в чате"""
+        in_chat = await self._reclaim("""
+            DELETE FROM search_queue
+            WHERE ctid IN (
+                SELECT sq.ctid
+                FROM search_queue sq
+                WHERE EXISTS (SELECT 1 FROM active_chats ac WHERE ac.telegram_id = sq.telegram_id)
+                LIMIT $1
+            )
+            RETURNING telegram_id
+        """)
+        for row in in_chat:
+            self.matchmaker.remove(row['telegram_id'])
+        await self.publish_ids("search_leave", [row['telegram_id'] for row in in_chat])
+
+        group_in_chat = await self._reclaim("""
+            DELETE FROM group_search_queue
+            WHERE ctid IN (
+                SELECT gsq.ctid
+                FROM group_search_queue gsq
+                WHERE EXISTS (
+                    SELECT 1
+                    FROM group_chat_members gcm
+                    JOIN group_chats gc ON gc.id = gcm.group_id
+                    WHERE gcm.telegram_id = gsq.telegram_id
+                      AND gc.is_active = TRUE AND gc.member_count >= 2
+                )
+                LIMIT $1
+            )
+            RETURNING telegram_id
+        """)
+        self.stats.on_group_dequeue(*[row['telegram_id'] for row in group_in_chat])
+        await self.publish_ids("group_queue_leave", [row['telegram_id'] for row in group_in_chat])
+        return len(in_chat), len(group_in_chat)
+
+    async def expire_searches(self) -> list:
+        """Снять с поиска тех, кто ждёт дольше SEARCH_QUEUE_TTL_HOURS и столько же не заходил в бота.
+
+        Возвращает их telegram_id — вызывающий сбрасывает состояние FSM и уведомляет.
+        Активные пользователи остаются в очереди, сколько бы ни ждали.
+        """
+        ttl = SEARCH_QUEUE_TTL_HOURS * 3600
+        expired = await self._reclaim("""
+            DELETE FROM search_queue
+            WHERE ctid IN (
+                SELECT sq.ctid
+                FROM search_queue sq
+                LEFT JOIN users u ON u.telegram_id = sq.telegram_id
+                WHERE sq.joined_at < CURRENT_TIMESTAMP - make_interval(secs => $2)
+                  AND (u.last_seen IS NULL OR u.last_seen < CURRENT_TIMESTAMP - make_interval(secs => $2))
+                LIMIT $1
+            )
+            RETURNING telegram_id
+        """, ttl)
+        for row in expired:
+            self.matchmaker.remove(row['telegram_id'])
+        await self.publish_ids("search_leave", [row['telegram_id'] for row in expired])
+
+        group_expired = await self._reclaim("""
+            DELETE FROM group_search_queue
+            WHERE ctid IN (
+                SELECT gsq.ctid
+                FROM group_search_queue gsq
+                LEFT JOIN users u ON u.telegram_id = gsq.telegram_id
+                WHERE gsq.joined_at < CURRENT_TIMESTAMP - make_interval(secs => $2)
+                  AND (u.last_seen IS NULL OR u.last_seen < CURRENT_TIMESTAMP - make_interval(secs => $2))
+                LIMIT $1
+            )
+            RETURNING telegram_id
+        """, ttl)
+        self.stats.on_group_dequeue(*[row['telegram_id'] for row in group_expired])
+        await self.publish_ids("group_queue_leave", [row['telegram_id'] for row in group_expired])
+
+        return list({row['telegram_id'] for row in expired + group_expired})
+
+    async def cleanup_dead_chats(self) -> int:
+        """Удалить односторонние соединения и соединения завершённых сессий"""
+        dead = await self._reclaim("""
+            DELETE FROM active_chats
+            WHERE ctid IN (
+                SELECT ac.ctid
+                FROM active_chats ac
+                LEFT JOIN chat_sessions cs ON cs.id = ac.session_id
+                WHERE cs.ended_at IS NOT NULL
+                   OR NOT EXISTS (
+                       SELECT 1 FROM active_chats p
+                       WHERE p.telegram_id = ac.partner_telegram_id
+                         AND p.partner_telegram_id = ac.telegram_id
+                   )
+                LIMIT $1
+            )
+            RETURNING telegram_id
+        """)
+        self.routes.invalidate(*[row['telegram_id'] for row in dead])
+        self.stats.on_chat_end(*[row['telegram_id'] for row in dead])
+        await self.publish_ids("chat_end", [row['telegram_id'] for row in dead])
+        return len(dead)
+
+    async def run_maintenance(self) -> Dict[str, int]:
+        """Один проход фоновой очистки; возвращает число освобождённых строк по категориям"""
+        closed_groups, group_members = await self.cleanup_stale_groups()
+        search_rows, group_search_rows = await self.cleanup_search_queues()
+        dead_chats = await self.cleanup_dead_chats()
+        return {
+            "closed_groups": closed_groups,
+            "group_members": group_members,
+            "search_queue": search_rows,
+            "group_search_queue": group_search_rows,
+            "active_chats": dead_chats,
+        }
+
+    # ========== СВЕРКА СТАТИСТИКИ ==========
+    async def reconcile_stats(self):
+        """Пересчитать счётчики /stats по БД и заменить ими накопленные в памяти"""
+        async with self.get_connection() as conn:
+            users = await conn.fetch("""
+                SELECT COALESCE(gender, 'unknown') AS gender,
+                       COUNT(*) AS total,
+                       COUNT(*) FILTER (WHERE created_at >= CURRENT_TIMESTAMP - INTERVAL '24 hours') AS new_24h
+                FROM users
+                GROUP BY COALESCE(gender, 'unknown')
+            """)
+            group_queue = await conn.fetch("SELECT telegram_id, target_gender FROM group_search_queue")
+            chat_users = await conn.fetch("SELECT telegram_id FROM active_chats")
+            groups = await conn.fetch("""
+                SELECT id, member_count FROM group_chats
+                WHERE is_active = TRUE AND member_count >= 2
+            """)
+            premium = await conn.fetch("""
+                SELECT telegram_id, expires_at FROM premium
+                WHERE is_active = TRUE AND expires_at > CURRENT_TIMESTAMP
+            """)
+
+        self.stats.load(
+            users_by_gender={BotStats._gender_key(row['gender']): row['total'] for row in users},
+            new_by_gender={BotStats._gender_key(row['gender']): row['new_24h'] for row in users},
+            group_queue={row['telegram_id']: row['target_gender'] for row in group_queue},
+            chat_users={row['telegram_id'] for row in chat_users},
+            groups={row['id']: row['member_count'] for row in groups},
+            premium={row['telegram_id']: as_utc(row['expires_at']) for row in premium},
+        )
+
+    async def get_route(self, telegram_id: int) -> Optional[ChatRoute]:
+        """Маршрут пересылки из памяти; при промахе — из group_chat_members/active_chats"""
+        route = self.routes.get(telegram_id)
+        if route:
+            return route
+
+        async with self.get_connection() as conn:
+            # Групповой чат имеет приоритет, как и раньше в chat_forward
+            group = await conn.fetchrow("""
+                SELECT gcm.group_id,
+                       ARRAY(SELECT m.telegram_id FROM group_chat_members m
+                             WHERE m.group_id = gcm.group_id) AS members
+                FROM group_chat_members gcm
+                JOIN group_chats gc ON gc.id = gcm.group_id
+                WHERE gcm.telegram_id = $1
+                  AND gc.is_active = TRUE
+                LIMIT 1
+            """, telegram_id)
+
+            if group and len(group['members']) > 1:
+                self.routes.set_group(group['group_id'], list(group['members']))
+                return self.routes.get(telegram_id)
+
+            chat = await conn.fetchrow("""
+                SELECT partner_telegram_id, session_id FROM active_chats
+                WHERE telegram_id = $1
+            """, telegram_id)
+
+        if not chat:
+            return None
+
+        route = ChatRoute([chat['partner_telegram_id']], session_id=chat['session_id'])
+        self.routes.set(telegram_id, route)
+        return route
 
     async def get_partner(self, telegram_id: int) -> Optional[int]:
         """Получить ID партнера"""
+        route = self.routes.get(telegram_id)
+        if route and route.group_id is None:
+            return route.partners[0]
+
         async with self.get_connection() as conn:
             result = await conn.fetchrow("""
                 SELECT partner_telegram_id FROM active_chats 
@@ -848,14 +2794,58 @@ class Database:
             """, telegram_id)
             return result['partner_telegram_id'] if result else None
 
-    async def get_session(self, telegram_id: int) -> Optional[int]:
-        """Получить ID сессии"""
-        async with self.get_connection() as conn:
-            result = await conn.fetchrow("""
-                SELECT session_id FROM active_chats 
-                WHERE telegram_id = $1
-            """, telegram_id)
-            return result['session_id'] if result else None
+    def count_message(self, session_id: int):
+        """Учесть пересланное сообщение (запишется в БД при следующем сбросе)"""
+        self.message_counter.increment(session_id)
+
+    async def flush_message_counts(self) -> int:
+        """Записать накопленные счётчики сообщений одним UPDATE"""
+        if not self.message_counter:
+            return 0
+
+        session_ids, counts = self.message_counter.drain()
+        try:
+            async with self.get_connection() as conn:
+                await conn.execute("""
+                    UPDATE chat_sessions cs
+                    SET message_count = cs.message_count + v.cnt
+                    FROM unnest($1::int[], $2::int[]) AS v(id, cnt)
+                    WHERE cs.id = v.id
+                """, session_ids, counts)
+        except (Exception, asyncio.CancelledError) as e:
+            # Не теряем приращения — вернём их в буфер до следующего сброса (и при отмене задачи)
+            for session_id, count in zip(session_ids, counts):
+                self.message_counter.increment(session_id, count)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            logger.error(f"Ошибка сброса счётчиков сообщений ({len(session_ids)} сессий): {e}")
+            return 0
+
+        return len(session_ids)
+
+    async def flush_presence(self) -> int:
+        """Записать накопленные last_seen одним UPDATE"""
+        if not self.presence:
+            return 0
+
+        telegram_ids, seen_at = self.presence.drain()
+        try:
+            async with self.get_connection() as conn:
+                await conn.execute("""
+                    UPDATE users u
+                    SET last_seen = v.seen, is_active = TRUE
+                    FROM unnest($1::bigint[], $2::timestamp[]) AS v(telegram_id, seen)
+                    WHERE u.telegram_id = v.telegram_id
+                      AND (u.last_seen IS NULL OR u.last_seen < v.seen)
+                """, telegram_ids, seen_at)
+        except (Exception, asyncio.CancelledError) as e:
+            self.presence.restore(telegram_ids, seen_at)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            logger.error(f"Ошибка записи last_seen ({len(telegram_ids)} пользователей): {e}")
+            return 0
+
+        return len(telegram_ids)
 
     async def end_chat(self, telegram_id: int) -> Optional[Tuple[int, int]]:
         """Завершить чат"""
@@ -873,11 +2863,17 @@ class Database:
             partner_id = chat_info['partner_telegram_id']
             session_id = chat_info['session_id']
 
+            # Досчитываем сообщения завершаемой сессии
+            await self.flush_message_counts()
+
             # Удаляем активные соединения
             await conn.execute("""
                 DELETE FROM active_chats 
                 WHERE telegram_id IN ($1, $2)
             """, telegram_id, partner_id)
+            self.routes.invalidate(telegram_id, partner_id)
+            self.stats.on_chat_end(telegram_id, partner_id)
+            await self.publish_ids("chat_end", [telegram_id, partner_id])
 
             # Проверяем, есть ли другие активные соединения с этой сессией
             remaining_active = await conn.fetchrow("""
@@ -898,31 +2894,22 @@ class Database:
     async def add_rating(self, rater_telegram_id: int, rated_telegram_id: int,
                          rating: int, session_id: int = None):
         """Добавить оценку собеседнику"""
-        async with self.get_connection() as conn:
-            # Получаем user_id обоих пользователей
-            rater_user = await conn.fetchrow(
-                "SELECT id FROM users WHERE telegram_id = $1",
-                rater_telegram_id
-            )
-            rated_user = await conn.fetchrow(
-                "SELECT id FROM users WHERE telegram_id = $1",
-                rated_telegram_id
-            )
-
-            if not rater_user or not rated_user:
-                return False
+        # Получаем user_id обоих пользователей
+        rater_user_id = await self.get_user_internal_id(rater_telegram_id)
+        rated_user_id = await self.get_user_internal_id(rated_telegram_id)
+        if not rater_user_id or not rated_user_id:
+            return False
 
+        async with self.get_connection() as conn:
             # Если session_id не указан, пытаемся найти последнюю сессию
             if not session_id:
                 session = await conn.fetchrow("""
-                    SELECT cs.id FROM chat_sessions cs
-                    JOIN users u1 ON cs.user1_id = u1.id
-                    JOIN users u2 ON cs.user2_id = u2.id
-                    WHERE (u1.telegram_id = $1 AND u2.telegram_id = $2)
-                       OR (u1.telegram_id = $2 AND u2.telegram_id = $1)
-                    ORDER BY cs.created_at DESC
+                    SELECT id FROM chat_sessions
+                    WHERE (user1_id = $1 AND user2_id = $2)
+                       OR (user1_id = $2 AND user2_id = $1)
+                    ORDER BY created_at DESC
                     LIMIT 1
-                """, rater_telegram_id, rated_telegram_id)
+                """, rater_user_id, rated_user_id)
 
                 if session:
                     session_id = session['id']
@@ -935,38 +2922,29 @@ class Database:
                 DO UPDATE SET 
                     rating = EXCLUDED.rating,
                     created_at = CURRENT_TIMESTAMP
-            """, rater_user['id'], rated_user['id'], session_id, rating)
+            """, rater_user_id, rated_user_id, session_id, rating)
 
             return True
 
     async def add_complaint(self, reporter_telegram_id: int, reported_telegram_id: int,
                             complaint: str, category: str = None, session_id: int = None):
         """Добавить жалобу на собеседника"""
-        async with self.get_connection() as conn:
-            # Получаем user_id обоих пользователей
-            reporter_user = await conn.fetchrow(
-                "SELECT id FROM users WHERE telegram_id = $1",
-                reporter_telegram_id
-            )
-            reported_user = await conn.fetchrow(
-                "SELECT id FROM users WHERE telegram_id = $1",
-                reported_telegram_id
-            )
-
-            if not reporter_user or not reported_user:
-                return False
+        # Получаем user_id обоих пользователей
+        reporter_user_id = await self.get_user_internal_id(reporter_telegram_id)
+        reported_user_id = await self.get_user_internal_id(reported_telegram_id)
+        if not reporter_user_id or not reported_user_id:
+            return False
 
+        async with self.get_connection() as conn:
             # Если session_id не указан, пытаемся найти последнюю сессию
             if not session_id:
                 session = await conn.fetchrow("""
-                    SELECT cs.id FROM chat_sessions cs
-                    JOIN users u1 ON cs.user1_id = u1.id
-                    JOIN users u2 ON cs.user2_id = u2.id
-                    WHERE (u1.telegram_id = $1 AND u2.telegram_id = $2)
-                       OR (u1.telegram_id = $2 AND u2.telegram_id = $1)
-                    ORDER BY cs.created_at DESC
+                    SELECT id FROM chat_sessions
+                    WHERE (user1_id = $1 AND user2_id = $2)
+                       OR (user1_id = $2 AND user2_id = $1)
+                    ORDER BY created_at DESC
                     LIMIT 1
-                """, reporter_telegram_id, reported_telegram_id)
+                """, reporter_user_id, reported_user_id)
 
                 if session:
                     session_id = session['id']
@@ -980,21 +2958,17 @@ class Database:
                     complaint = EXCLUDED.complaint,
                     complaint_category = EXCLUDED.complaint_category,
                     created_at = CURRENT_TIMESTAMP
-            """, reporter_user['id'], reported_user['id'], session_id, complaint, category)
+            """, reporter_user_id, reported_user_id, session_id, complaint, category)
 
             return True
 
     async def get_user_rating_stats(self, telegram_id: int) -> dict:
         """Получить статистику оценок пользователя"""
-        async with self.get_connection() as conn:
-            user = await conn.fetchrow(
-                "SELECT id FROM users WHERE telegram_id = $1",
-                telegram_id
-            )
-
-            if not user:
-                return {"likes": 0, "dislikes": 0, "complaints": 0}
+        user_id = await self.get_user_internal_id(telegram_id)
+        if not user_id:
+            return {"likes": 0, "dislikes": 0, "complaints": 0}
 
+        async with self.get_connection() as conn:
             stats = await conn.fetchrow("""
                 SELECT 
                     COUNT(CASE WHEN rating = 1 THEN 1 END) as likes,
@@ -1002,7 +2976,7 @@ class Database:
                     COUNT(CASE WHEN complaint IS NOT NULL THEN 1 END) as complaints
                 FROM user_ratings 
                 WHERE rated_user_id = $1
-            """, user['id'])
+            """, user_id)
 
             return {
                 "likes": stats['likes'] or 0,
@@ -1010,16 +2984,25 @@ class Database:
                 "complaints": stats['complaints'] or 0
             }
 
-    async def has_active_premium(self, telegram_id: int) -> bool:
+    async def get_premium_expires(self, telegram_id: int) -> Optional[datetime]:
+        """Срок действующего премиума (aware UTC) или None; из кэша, при промахе — из БД"""
+        cached, expires_at = self.premium_cache.get(telegram_id)
+        if cached:
+            return expires_at
+
         async with self.get_connection() as conn:
-            result = await conn.fetchrow("""
-                SELECT 1 FROM premium
-                WHERE telegram_id = $1
-                  AND is_active = TRUE
-                  AND expires_at > CURRENT_TIMESTAMP
-                LIMIT 1
+            expires_at = await conn.fetchval("""
+                SELECT expires_at FROM premium
+                WHERE telegram_id = $1 AND is_active = TRUE
             """, telegram_id)
-            return result is not None
+
+        if expires_at is not None:
+            expires_at = as_utc(expires_at)
+        self.premium_cache.set(telegram_id, expires_at)
+        return expires_at if expires_at and expires_at > datetime.now(timezone.utc) else None
+
+    async def has_active_premium(self, telegram_id: int) -> bool:
+        return await self.get_premium_expires(telegram_id) is not None
 
     async def buy_premium(self, telegram_id: int, stars_paid: int) -> Tuple[bool, str]:
         """Купить/выдать премиум с СТАКИНГОМ (добавление дней к текущему сроку)"""
@@ -1077,7 +3060,10 @@ class Database:
                     is_active = TRUE
             """, telegram_id, stars_paid, duration_days, new_expires_naive)
 
-            return True, message
+        self.premium_cache.set(telegram_id, new_expires_at)
+        self.stats.on_premium(telegram_id, new_expires_at)
+        await self.publish("premium", user=telegram_id, expires=new_expires_at.isoformat())
+        return True, message
 
     async def get_premium_info(self, telegram_id: int) -> Optional[dict]:
         async with self.get_connection() as conn:
@@ -1093,42 +3079,29 @@ class Database:
             return None
 
     async def get_premium_remaining_time(self, telegram_id: int) -> Optional[str]:
-        async with self.get_connection() as conn:
-            row = await conn.fetchrow("""
-                SELECT expires_at FROM premium
-                WHERE telegram_id = $1 AND is_active = TRUE
-                ORDER BY purchased_at DESC
-                LIMIT 1
-            """, telegram_id)
-
-            if not row:
-                return None
-
-            expires_at = row['expires_at']
-            if expires_at.tzinfo is None:
-                expires_at = expires_at.replace(tzinfo=timezone.utc)
-            else:
-                expires_at = expires_at.astimezone(timezone.utc)
+        expires_at = await self.get_premium_expires(telegram_id)
+        if expires_at is None:
+            return None
 
-            now = datetime.now(timezone.utc)
-            remaining = expires_at - now
+        now = datetime.now(timezone.utc)
+        remaining = expires_at - now
 
-            if remaining.total_seconds() <= 0:
-                return None
+        if remaining.total_seconds() <= 0:
+            return None
 
-            days = remaining.days
-            hours = remaining.seconds // 3600
-            minutes = (remaining.seconds % 3600) // 60
+        days = remaining.days
+        hours = remaining.seconds // 3600
+        minutes = (remaining.seconds % 3600) // 60
 
-            parts = []
-            if days > 0:
-                parts.append(f"{days} д.")
-            if hours > 0:
-                parts.append(f"{hours} ч.")
-            if minutes > 0 and days == 0 and hours == 0:
-                parts.append(f"{minutes} мин.")
+        parts = []
+        if days > 0:
+            parts.append(f"{days} д.")
+        if hours > 0:
+            parts.append(f"{hours} ч.")
+        if minutes > 0 and days == 0 and hours == 0:
+            parts.append(f"{minutes} мин.")
 
-            return " ".join(parts) if parts else "менее минуты"
+        return " ".join(parts) if parts else "менее минуты"
 
     async def get_referral_stats(self, telegram_id: int) -> dict:
         """Статистика рефералов пользователя"""
@@ -1197,6 +3170,9 @@ class Database:
                     expires_at = EXCLUDED.expires_at,
                     is_active = TRUE
             """, referrer_id, final_expires_naive)
+            self.premium_cache.set(referrer_id, final_expires)
+            self.stats.on_premium(referrer_id, final_expires)
+            await self.publish("premium", user=referrer_id, expires=final_expires.isoformat())
 
             # Отмечаем, что бонус начислен
             await conn.execute("""
@@ -1208,6 +3184,147 @@ class Database:
             return True
 
 
+# ========== ХРАНИЛИЩЕ FSM В POSTGRESQL ==========
+class PostgresStorage(BaseStorage):
+    """FSM-хранилище в таблице fsm_storage с кэшем в памяти (запись сквозная).
+
+    Чтение из кэша не ходит в БД; промах подгружает запись целиком.
+    """
+
+    # Сколько записей держать в кэше (LRU)
+    CACHE_SIZE = 100_000
+
+    def __init__(self, database: Database):
+        self.db = database
+        # StorageKey -> [state, data]
+        self._cache = OrderedDict()
+        if database.bus is not None:
+            # Запись на другой реплике делает нашу копию устаревшей
+            database.bus.subscribe("fsm", self._forget)
+            database.bus.resync_callbacks.append(self._forget_all)
+
+    def _forget(self, bot: int, chat: int, user: int):
+        self._cache.pop(StorageKey(bot_id=bot, chat_id=chat, user_id=user), None)
+
+    async def _forget_all(self):
+        self._cache.clear()
+
+    async def close(self) -> None:
+        # Пулом подключений владеет Database
+        self._cache.clear()
+
+    def _remember(self, key: StorageKey, record: list, overwrite: bool = True):
+        if overwrite or key not in self._cache:
+            self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    @staticmethod
+    def _from_row(row) -> list:
+        if not row:
+            return [None, {}]
+        return [row['state'], json.loads(row['data'])]
+
+    async def _get_record(self, key: StorageKey) -> list:
+        record = self._cache.get(key)
+        if record is not None:
+            self._cache.move_to_end(key)
+            return record
+
+        async with self.db.get_connection() as conn:
+            row = await conn.fetchrow("""
+                SELECT state, data FROM fsm_storage
+                WHERE bot_id = $1 AND chat_id = $2 AND user_id = $3
+            """, key.bot_id, key.chat_id, key.user_id)
+
+        # Запись, сделанная пока шёл запрос, свежее прочитанной
+        self._remember(key, self._from_row(row), overwrite=False)
+        return self._cache[key]
+
+    async def _write(self, key: StorageKey, state: Optional[str], data: Optional[Dict[str, Any]]):
+        """Сквозная запись: сначала БД, затем кэш; None в data — «не менять это поле».
+
+        set_state(None) сбрасывает состояние, data сохраняется.
+        """
+        record = self._cache.get(key)
+        if record is None and (state is None if data is None else not data):
+            # Запись может стать пустой — нужно знать второе поле
+            record = await self._get_record(key)
+
+        if record is not None:
+            new_state = state if state is not None or data is None else record[0]
+            new_data = data if data is not None else record[1]
+            if new_state is None and not new_data:
+                # Пустое состояние — строка не нужна
+                if record[0] is not None or record[1]:
+                    async with self.db.get_connection() as conn:
+                        await conn.execute("""
+                            DELETE FROM fsm_storage
+                            WHERE bot_id = $1 AND chat_id = $2 AND user_id = $3
+                        """, key.bot_id, key.chat_id, key.user_id)
+                    await self.db.publish("fsm", bot=key.bot_id, chat=key.chat_id, user=key.user_id)
+                self._remember(key, [None, {}])
+                return
+
+        async with self.db.get_connection() as conn:
+            if data is None:
+                row = await conn.fetchrow("""
+                    INSERT INTO fsm_storage (bot_id, chat_id, user_id, state)
+                    VALUES ($1, $2, $3, $4)
+                    ON CONFLICT (bot_id, chat_id, user_id) DO UPDATE SET
+                        state = EXCLUDED.state,
+                        updated_at = CURRENT_TIMESTAMP
+                    RETURNING state, data
+                """, key.bot_id, key.chat_id, key.user_id, state)
+            else:
+                row = await conn.fetchrow("""
+                    INSERT INTO fsm_storage (bot_id, chat_id, user_id, data)
+                    VALUES ($1, $2, $3, $4::jsonb)
+                    ON CONFLICT (bot_id, chat_id, user_id) DO UPDATE SET
+                        data = EXCLUDED.data,
+                        updated_at = CURRENT_TIMESTAMP
+                    RETURNING state, data
+                """, key.bot_id, key.chat_id, key.user_id, json.dumps(data, ensure_ascii=False))
+
+            await self.db.publish("fsm", bot=key.bot_id, chat=key.chat_id, user=key.user_id)
+
+        # Кэш — только после успешной записи и как её вернула БД
+        self._remember(key, self._from_row(row))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._write(key, state.state if isinstance(state, State) else state, None)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._get_record(key))[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._write(key, None, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._get_record(key))[1].copy()
+
+
+def create_fsm_storage(database: Database) -> BaseStorage:
+    """Хранилище FSM по настройке FSM_STORAGE"""
+    if FSM_STORAGE == "memory":
+        if CLUSTER_MODE:
+            raise ValueError("❌ CLUSTER_MODE=1 требует общего хранилища FSM (postgres или redis)")
+        return MemoryStorage()
+
+    if FSM_STORAGE == "redis":
+        if not REDIS_URL:
+            raise ValueError("❌ FSM_STORAGE=redis, но REDIS_URL не задан")
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+        except ImportError:
+            raise ValueError("❌ Для FSM_STORAGE=redis установите пакет redis")
+        # Подходит любой Redis-совместимый сервер (Redis, KeyDB, Dragonfly, Valkey)
+        return RedisStorage.from_url(REDIS_URL)
+
+    return PostgresStorage(database)
+
+
 # ========== ИНИЦИАЛИЗАЦИЯ БАЗЫ И РОУТЕРА ==========
 db = Database()
 router = Router(name="anonymous_chat")
@@ -1558,35 +3675,11 @@ async def group_search_mode_selected(message: Message, state: FSMContext):
     # Добавляем в очередь и запускаем поиск
     await db.add_to_group_search(message.from_user.id, target_gender)
 
-    result = await db.find_group_partner(message.from_user.id, target_gender, message.bot)
+    result = await db.find_group_partner(message.from_user.id, target_gender)
 
     if result:
         members, group_id, is_joining = result
-        member_count = len(members)
-        initiator_id = message.from_user.id
-
-        # === УВЕДОМЛЕНИЯ ТОЛЬКО ПРИ СОЗДАНИИ НОВОЙ ГРУППЫ ===
-        if not is_joining:
-            create_text = (
-                f"👥 Групповой чат создан!\n\n"
-                f"Участников: {member_count}\n\n"
-                f"/leave - Покинуть групповой чат"
-            )
-            for member in members:
-                try:
-                    await message.bot.send_message(member, create_text, parse_mode="HTML")
-                except Exception as e:
-                    logger.error(f"Ошибка уведомления о создании группы {member}: {e}")
-
-        # Устанавливаем состояние "в чате" всем участникам
-        for member in members:
-            try:
-                key = StorageKey(bot_id=message.bot.id, chat_id=member, user_id=member)
-                member_state = FSMContext(storage=state.storage, key=key)
-                await member_state.set_state(ChatState.chatting)
-            except Exception as e:
-                logger.error(f"Ошибка установки состояния участнику {member}: {e}")
-
+        await start_group_chat(message.bot, state.storage, members, is_joining)
         await state.set_state(ChatState.chatting)
 
     else:
@@ -1599,6 +3692,31 @@ async def group_search_mode_selected(message: Message, state: FSMContext):
         await state.set_state(GroupSearchState.searching)
 
 
+async def start_group_chat(bot: Bot, storage, members: list, is_joining: bool):
+    """Уведомить участников о создании группы и перевести всех в состояние чата"""
+    # === УВЕДОМЛЕНИЯ ТОЛЬКО ПРИ СОЗДАНИИ НОВОЙ ГРУППЫ ===
+    if not is_joining:
+        create_text = (
+            f"👥 Групповой чат создан!\n\n"
+            f"Участников: {len(members)}\n\n"
+            f"/leave - Покинуть групповой чат"
+        )
+        for member in members:
+            try:
+                await bot.send_message(member, create_text, parse_mode="HTML")
+            except Exception as e:
+                logger.error(f"Ошибка уведомления о создании группы {member}: {e}")
+
+    # Устанавливаем состояние "в чате" всем участникам
+    for member in members:
+        try:
+            key = StorageKey(bot_id=bot.id, chat_id=member, user_id=member)
+            member_state = FSMContext(storage=storage, key=key)
+            await member_state.set_state(ChatState.chatting)
+        except Exception as e:
+            logger.error(f"Ошибка установки состояния участнику {member}: {e}")
+
+
 @router.callback_query(F.data.startswith("buy_premium_"))
 async def process_buy_premium_callback(callback: CallbackQuery, bot: Bot):
     """Обработка покупки премиума"""
@@ -1918,9 +4036,10 @@ async def cmd_search(message: Message, state: FSMContext):
     if await db.get_partner(message.from_user.id):
         await db.end_chat(message.from_user.id)
 
-    # Начинаем поиск
-    await db.add_to_search(message.from_user.id)
+    # Состояние — до постановки в очередь: фоновый подбор может соединить пользователя
+    # сразу, и его ChatState.chatting не должен перезаписаться поиском
     await state.set_state(ChatState.searching)
+    await db.add_to_search(message.from_user.id, gender=user_profile['gender'])
 
     partner_data = await db.find_partner(message.from_user.id)
 
@@ -2012,6 +4131,9 @@ async def cmd_search(message: Message, state: FSMContext):
             )
             return
     else:
+        # Фоновый подбор уже соединил и уведомил пользователя
+        if await db.get_route(message.from_user.id):
+            return
         await message.answer(
             "🔍 <i>Ищем собеседника...</i>\n\n"
             "<i>/stop — остановить поиск</i>",
@@ -2118,50 +4240,10 @@ async def cmd_leave(message: Message, state: FSMContext):
         logger.info(f"Оставшиеся участники: {remaining_members} (количество: {remaining_count})")
 
         # Уведомляем остальных участников
-        if remaining_count == 1:
-            last_member = remaining_members[0]
-            try:
-                await message.bot.send_message(
-                    last_member,
-                    "👥 Групповой чат завершен\n\n"
-                    "Все участники покинули чат",
-                    reply_markup=get_main_keyboard()
-                )
-                # Сбрасываем состояние для последнего участника
-                key = StorageKey(bot_id=message.bot.id, chat_id=last_member, user_id=last_member)
-                member_state = FSMContext(storage=state.storage, key=key)
-                await member_state.set_state(ChatState.idle)
-                logger.info(f"Уведомление отправлено последнему участнику {last_member}")
-            except Exception as e:
-                logger.error(f"Ошибка уведомления последнего участника {last_member}: {e}")
-        elif remaining_count > 1:
-            text = f"👤 Участник покинул чат\n\nВ групповом чате осталось {remaining_count} участников"
-            for member in remaining_members:
-                try:
-                    await message.bot.send_message(member, text)
-                except Exception as e:
-                    logger.error(f"Ошибка уведомления участника {member}: {e}")
+        await notify_group_member_left(message.bot, state.storage, remaining_members)
 
         # Удаляем пользователя из группы
-        async with db.get_connection() as conn:
-            await conn.execute("""
-                DELETE FROM group_chat_members 
-                WHERE telegram_id = $1
-            """, leaver_id)
-            logger.info(f"Пользователь {leaver_id} удален из group_chat_members")
-
-            # Если группа почти пуста, полностью очищаем ее
-            if remaining_count <= 1:
-                await conn.execute("""
-                    DELETE FROM group_chat_members 
-                    WHERE group_id = $1
-                """, group_id)
-                await conn.execute("""
-                    UPDATE group_chats 
-                    SET is_active = FALSE, ended_at = CURRENT_TIMESTAMP 
-                    WHERE id = $1
-                """, group_id)
-                logger.info(f"Группа {group_id} полностью очищена и деактивирована")
+        await db.leave_group(leaver_id, group_id, close_group=remaining_count <= 1)
 
         await message.answer(
             "👥 Вы покинули групповой чат\n\n"
@@ -2192,6 +4274,35 @@ async def cmd_leave(message: Message, state: FSMContext):
         )
 
 
+async def notify_group_member_left(bot: Bot, storage, remaining_members: list):
+    """Уведомить оставшихся участников группы о выходе участника"""
+    remaining_count = len(remaining_members)
+
+    if remaining_count == 1:
+        last_member = remaining_members[0]
+        try:
+            await bot.send_message(
+                last_member,
+                "👥 Групповой чат завершен\n\n"
+                "Все участники покинули чат",
+                reply_markup=get_main_keyboard()
+            )
+            # Сбрасываем состояние для последнего участника
+            key = StorageKey(bot_id=bot.id, chat_id=last_member, user_id=last_member)
+            member_state = FSMContext(storage=storage, key=key)
+            await member_state.set_state(ChatState.idle)
+            logger.info(f"Уведомление отправлено последнему участнику {last_member}")
+        except Exception as e:
+            logger.error(f"Ошибка уведомления последнего участника {last_member}: {e}")
+    elif remaining_count > 1:
+        text = f"👤 Участник покинул чат\n\nВ групповом чате осталось {remaining_count} участников"
+        for member in remaining_members:
+            try:
+                await bot.send_message(member, text)
+            except Exception as e:
+                logger.error(f"Ошибка уведомления участника {member}: {e}")
+
+
 @router.message(F.text.in_(["👩 Найти девушку", "👨 Найти парня"]))
 async def start_gender_search(message: Message, state: FSMContext):
     """Начать поиск по конкретному полу"""
@@ -2247,11 +4358,13 @@ async def start_gender_search(message: Message, state: FSMContext):
     if await db.get_partner(message.from_user.id):
         await db.end_chat(message.from_user.id)
 
-    # Добавляем в общую очередь поиска с указанием целевого пола
-    await db.add_to_search(message.from_user.id, target_gender=target_gender)
-
     # Сохраняем целевой пол в состоянии (если нужно для других целей)
     await state.update_data(target_gender=target_gender)
+    # Состояние — до постановки в очередь, как в cmd_search
+    await state.set_state(ChatState.searching)
+
+    # Добавляем в общую очередь поиска с указанием целевого пола
+    await db.add_to_search(message.from_user.id, target_gender=target_gender, gender=current_user_gender)
 
     # Начинаем поиск по полу
     partner_data = await db.find_partner_by_gender(message.from_user.id, target_gender)
@@ -2302,6 +4415,9 @@ async def start_gender_search(message: Message, state: FSMContext):
             )
             return
     else:
+        # Фоновый подбор уже соединил и уведомил пользователя
+        if await db.get_route(message.from_user.id):
+            return
         # Простое сообщение о поиске без лишних деталей
         gender_text = "девушку" if target_gender == 'female' else "парня"
         await message.answer(
@@ -2310,7 +4426,6 @@ async def start_gender_search(message: Message, state: FSMContext):
             parse_mode="HTML",
             reply_markup=get_main_keyboard()
         )
-        await state.set_state(ChatState.searching)
 
 
 @router.message(Command("givepremium"))
@@ -2377,68 +4492,36 @@ async def cmd_stats(message: Message):
         await message.answer("❌ Доступ запрещён.")
         return
 
-    # ИСПРАВЛЕНО: убираем tzinfo, чтобы asyncpg не ругался
-    twenty_four_hours_ago = (datetime.now(timezone.utc) - timedelta(hours=24)).replace(tzinfo=None)
-
-    async with db.get_connection() as conn:
-        # === Общее количество пользователей ===
-        total_users = await conn.fetchval("SELECT COUNT(*) FROM users") or 0
-        new_users = await conn.fetchval("""
-            SELECT COUNT(*) FROM users 
-            WHERE created_at >= $1
-        """, twenty_four_hours_ago) or 0
-
-        # === Разбивка по полу (общая + новые за 24ч) ===
-        gender_stats = await conn.fetch("""
-            SELECT
-                COUNT(*) AS total,
-                COUNT(CASE WHEN created_at >= $1 THEN 1 END) AS new_24h,
-                COALESCE(gender, 'unknown') AS gender
-            FROM users
-            GROUP BY COALESCE(gender, 'unknown')
-        """, twenty_four_hours_ago)
-
-        # Инициализация
-        males_total = males_new = females_total = females_new = unknown_total = unknown_new = 0
-
-        for row in gender_stats:
-            g = row['gender']
-            if g == 'male':
-                males_total = row['total']
-                males_new = row['new_24h']
-            elif g == 'female':
-                females_total = row['total']
-                females_new = row['new_24h']
-            else:
-                unknown_total = row['total']
-                unknown_new = row['new_24h']
-
-        # === Остальные метрики (без изменений) ===
-        regular_search = await conn.fetchval("SELECT COUNT(*) FROM search_queue WHERE target_gender IS NULL") or 0
-        gender_search = await conn.fetchval("SELECT COUNT(*) FROM search_queue WHERE target_gender IS NOT NULL") or 0
-        group_search = await conn.fetchval("SELECT COUNT(*) FROM group_search_queue") or 0
-
-        active_chats_count = await conn.fetchval("SELECT COUNT(*) FROM active_chats") or 0
-        one_on_one_pairs = active_chats_count // 2
-
-        active_groups_data = await conn.fetch("""
-            SELECT COUNT(gcm.telegram_id) AS members
-            FROM group_chats gc
-            JOIN group_chat_members gcm ON gc.id = gcm.group_id
-            WHERE gc.is_active = TRUE
-            GROUP BY gc.id
-            HAVING COUNT(gcm.telegram_id) >= 2
-        """)
-
-        active_groups = len(active_groups_data)
-        total_in_groups = sum(row['members'] for row in active_groups_data)
-        groups_of_2 = sum(1 for row in active_groups_data if row['members'] == 2)
-        groups_of_3 = sum(1 for row in active_groups_data if row['members'] == 3)
-
-        premium_users = await conn.fetchval("""
-            SELECT COUNT(*) FROM premium
-            WHERE is_active = TRUE AND expires_at > CURRENT_TIMESTAMP
-        """) or 0
+    # Всё из памяти: счётчики ведутся событиями и сверяются с БД каждые STATS_RECONCILE_INTERVAL с
+    stats = db.stats
+
+    # === Пользователи и разбивка по полу (общая + новые за 24ч) ===
+    males_total = stats.users_by_gender.get('male', 0)
+    females_total = stats.users_by_gender.get('female', 0)
+    unknown_total = stats.users_by_gender.get('unknown', 0)
+    males_new = stats.new_by_gender.get('male', 0)
+    females_new = stats.new_by_gender.get('female', 0)
+    unknown_new = stats.new_by_gender.get('unknown', 0)
+    total_users = males_total + females_total + unknown_total
+    new_users = males_new + females_new + unknown_new
+
+    # === Очереди ===
+    buckets = db.matchmaker.bucket_sizes()
+    regular_search = sum(count for (_, target), count in buckets.items() if target is None)
+    gender_search = sum(count for (_, target), count in buckets.items() if target is not None)
+    group_search = len(stats.group_queue)
+
+    # === Чаты ===
+    active_chats_count = len(stats.chat_users)
+    one_on_one_pairs = active_chats_count // 2
+
+    group_sizes = list(stats.groups.values())
+    active_groups = len(group_sizes)
+    total_in_groups = sum(group_sizes)
+    groups_of_2 = group_sizes.count(2)
+    groups_of_3 = group_sizes.count(3)
+
+    premium_users = stats.active_premium()
 
     # === Сообщение ===
     stats_text = (
@@ -2463,12 +4546,55 @@ async def cmd_stats(message: Message):
         f"   ├ По 2: <code>{groups_of_2}</code>\n"
         f"   └ По 3: <code>{groups_of_3}</code>\n\n"
 
-        f"💎 <b>Активных премиум:</b> <code>{premium_users}</code>"
+        f"💎 <b>Активных премиум:</b> <code>{premium_users}</code>\n\n"
+
+        f"🗂 <b>Кэш профилей:</b> <code>{len(db.profiles)}</code> записей, "
+        f"попаданий <code>{db.profiles.hit_rate():.0%}</code> "
+        f"(<code>{db.profiles.hits}</code>/<code>{db.profiles.hits + db.profiles.misses}</code>)"
     )
 
     await message.answer(stats_text, parse_mode="HTML")
 
 
+@router.message(Command("querystats"))
+async def cmd_querystats(message: Message):
+    """Команда /querystats [N] [total|p99|calls|rows] [reset] — самые дорогие SQL-запросы (только админ)"""
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("❌ Доступ запрещён.")
+        return
+
+    args = message.text.split()[1:]
+    if "reset" in args:
+        QUERY_STATS.reset()
+        await message.answer("Статистика запросов сброшена.")
+        return
+
+    limit = next((int(arg) for arg in args if arg.isdigit()), 10)
+    order = next((arg for arg in args if arg in ("total", "p99", "calls", "rows")), "total")
+
+    top = QUERY_STATS.top(limit, order)
+    if not top:
+        await message.answer("Запросов пока не было.")
+        return
+
+    lines = [f"🗄 <b>SQL-запросы</b> (топ {len(top)} по {order})\n"]
+    for i, (fingerprint, stat) in enumerate(top, 1):
+        lines.append(
+            f"<b>{i}.</b> вызовов <code>{stat.calls}</code>, всего <code>{stat.total_seconds * 1000:.0f} мс</code>, "
+            f"p99 <code>{stat.p99() * 1000:.1f} мс</code>, строк <code>{stat.rows}</code>"
+            + (f", ошибок <code>{stat.errors}</code>" if stat.errors else "")
+            + f"\n<code>{html.escape(fingerprint[:300])}</code>\n"
+        )
+
+    # Сообщение Telegram ограничено 4096 символами
+    text = ""
+    for line in lines:
+        if len(text) + len(line) > 4000:
+            break
+        text += line + "\n"
+    await message.answer(text, parse_mode="HTML")
+
+
 # ========== КОМАНДА /APP — ОТКРЫТИЕ АДМИН-ПАНЕЛИ КАК WEB APP ==========
 @router.message(Command("app"))
 async def cmd_app(message: Message):
@@ -2595,134 +4721,172 @@ async def handle_complaint_callback(callback: CallbackQuery, state: FSMContext):
 
 async def find_last_partner(telegram_id: int):
     """Найти последнего партнера пользователя"""
+    user_id = await db.get_user_internal_id(telegram_id)
+    if not user_id:
+        return None, None
+
     async with db.get_connection() as conn:
-        user = await conn.fetchrow(
-            "SELECT id FROM users WHERE telegram_id = $1",
-            telegram_id
+        last_session = await conn.fetchrow("""
+            SELECT cs.id, 
+                   CASE 
+                       WHEN cs.user1_id = $1 THEN u2.telegram_id
+                       ELSE u1.telegram_id
+                   END as partner_id
+            FROM chat_sessions cs
+            JOIN users u1 ON cs.user1_id = u1.id
+            JOIN users u2 ON cs.user2_id = u2.id
+            WHERE (cs.user1_id = $1 OR cs.user2_id = $1)
+            AND cs.ended_at IS NOT NULL
+            ORDER BY cs.ended_at DESC
+            LIMIT 1
+        """, user_id)
+
+    if last_session:
+        return last_session['partner_id'], last_session['id']
+    return None, None
+
+
+# ========== ПЕРЕСЫЛКА СООБЩЕНИЙ ==========
+def build_fallback_send(message: Message, chat_id: int):
+    """Отправка по типу контента — для сообщений, которые copy_message не копирует"""
+    bot = message.bot
+
+    if message.text:
+        return bot.send_message(chat_id, message.text, entities=message.entities)
+    if message.photo:
+        return bot.send_photo(chat_id, message.photo[-1].file_id, caption=message.caption,
+                              caption_entities=message.caption_entities)
+    if message.video:
+        return bot.send_video(chat_id, message.video.file_id, caption=message.caption,
+                              caption_entities=message.caption_entities,
+                              duration=message.video.duration,
+                              width=message.video.width, height=message.video.height)
+    if message.video_note:  # кружочек
+        return bot.send_video_note(chat_id, message.video_note.file_id,
+                                   duration=message.video_note.duration, length=message.video_note.length)
+    if message.sticker:
+        return bot.send_sticker(chat_id, message.sticker.file_id)
+    if message.animation:  # GIF
+        return bot.send_animation(chat_id, message.animation.file_id, caption=message.caption,
+                                  caption_entities=message.caption_entities)
+    if message.voice:
+        return bot.send_voice(chat_id, message.voice.file_id, caption=message.caption,
+                              caption_entities=message.caption_entities, duration=message.voice.duration)
+    if message.audio:
+        return bot.send_audio(chat_id, message.audio.file_id, caption=message.caption,
+                              caption_entities=message.caption_entities, duration=message.audio.duration,
+                              performer=message.audio.performer, title=message.audio.title)
+    if message.document:
+        return bot.send_document(chat_id, message.document.file_id, caption=message.caption,
+                                 caption_entities=message.caption_entities)
+    if message.location:
+        return bot.send_location(chat_id, message.location.latitude, message.location.longitude)
+    if message.contact:
+        return bot.send_contact(chat_id, phone_number=message.contact.phone_number,
+                                first_name=message.contact.first_name, last_name=message.contact.last_name)
+    if message.dice:
+        return bot.send_dice(chat_id, emoji=message.dice.emoji)
+    if message.poll:
+        # Викторину без известного ответа не скопировать — отправляем обычным опросом
+        return bot.send_poll(chat_id, question=message.poll.question,
+                             options=[option.text for option in message.poll.options],
+                             allows_multiple_answers=message.poll.allows_multiple_answers)
+    return None
+
+
+async def relay_message(message: Message, chat_id: int):
+    """Переслать сообщение любого типа одним copy_message (подпись, разметка и метаданные сохраняются)"""
+    try:
+        return await message.bot.copy_message(
+            chat_id=chat_id,
+            from_chat_id=message.chat.id,
+            message_id=message.message_id
         )
+    except TelegramBadRequest as e:
+        fallback = build_fallback_send(message, chat_id)
+        if fallback is None:
+            raise
+        logger.info(f"copy_message не сработал ({e}) — отправляем по типу контента")
+        return await fallback
 
-        if user:
-            last_session = await conn.fetchrow("""
-                SELECT cs.id, 
-                       CASE 
-                           WHEN cs.user1_id = $1 THEN u2.telegram_id
-                           ELSE u1.telegram_id
-                       END as partner_id
-                FROM chat_sessions cs
-                JOIN users u1 ON cs.user1_id = u1.id
-                JOIN users u2 ON cs.user2_id = u2.id
-                WHERE (cs.user1_id = $1 OR cs.user2_id = $1)
-                AND cs.ended_at IS NOT NULL
-                ORDER BY cs.ended_at DESC
-                LIMIT 1
-            """, user['id'])
 
-            if last_session:
-                return last_session['partner_id'], last_session['id']
+def is_relayable(message: Message) -> bool:
+    """Служебные сообщения (выбор чата/пользователя, доступ к записи) не пересылаем"""
+    return not (message.chat_shared or message.users_shared or message.write_access_allowed)
 
-    return None, None
+
+async def report_relay_error(message: Message, error: Exception):
+    """Сообщить отправителю о неотправленном сообщении"""
+    if "file is too big" in str(error).lower():
+        await message.answer(
+            "❌ Файл слишком большой для отправки. Максимальный размер файла - 50 МБ",
+            reply_markup=get_main_keyboard()
+        )
+    elif isinstance(error, TelegramBadRequest):
+        await message.answer("❌ Этот тип сообщения пока не поддерживается в чате.")
+    else:
+        await message.answer(
+            "❌ Не удалось отправить это сообщение. Попробуйте другой формат или текст.",
+            reply_markup=get_main_keyboard()
+        )
 
 
 @router.message(ChatState.chatting)
 async def chat_forward(message: Message, state: FSMContext):
     """Универсальная пересылка: групповой или 1-на-1 чат — все типы сообщений"""
 
-    # === Проверяем, в групповом ли чате ===
-    group_members = await db.get_group_members(message.from_user.id)
+    if not is_relayable(message):
+        return
 
-    if group_members and len(group_members) > 1:
+    # === Маршрут из памяти: групповой или 1-на-1 ===
+    route = await db.get_route(message.from_user.id)
+
+    if route and route.group_id is not None:
         # === ГРУППОВОЙ ЧАТ ===
         sender_id = message.from_user.id
-        recipients = [m for m in group_members if m != sender_id]
+        recipients = route.partners
 
         if not recipients:
             return
 
-        try:
-            # Пересылаем любой тип контента
-            if message.text:
-                for r in recipients:
-                    await message.bot.copy_message(chat_id=r, from_chat_id=message.chat.id,
-                                                   message_id=message.message_id)
-            elif message.photo:
-                photo = message.photo[-1]
-                for r in recipients:
-                    await message.bot.send_photo(r, photo.file_id, caption=message.caption)
-            elif message.video:
-                for r in recipients:
-                    await message.bot.send_video(r, message.video.file_id, caption=message.caption)
-            elif message.video_note:  # кружочек
-                for r in recipients:
-                    await message.bot.send_video_note(r, message.video_note.file_id)
-            elif message.sticker:
-                for r in recipients:
-                    await message.bot.send_sticker(r, message.sticker.file_id)
-            elif message.animation:  # GIF
-                for r in recipients:
-                    await message.bot.send_animation(r, message.animation.file_id, caption=message.caption)
-            elif message.voice:
-                for r in recipients:
-                    await message.bot.send_voice(r, message.voice.file_id, caption=message.caption)
-            elif message.document:
-                for r in recipients:
-                    await message.bot.send_document(r, message.document.file_id, caption=message.caption)
-            elif message.audio:
-                for r in recipients:
-                    await message.bot.send_audio(r, message.audio.file_id, caption=message.caption)
-            else:
-                # Для остальных типов (например, contact, location) — можно добавить по желанию
-                pass
-        except Exception as e:
-            logger.error(f"Ошибка пересылки в группе от {sender_id}: {e}")
+        # Всем получателям параллельно: ошибка одного не мешает остальным
+        started = time.perf_counter()
+        results = await fan_out(recipients, lambda r: relay_message(message, r))
+        RELAY_SECONDS.observe(time.perf_counter() - started, chat="group")
+
+        members = [sender_id] + recipients
+        failed = []
+        for r, result in results.items():
+            if isinstance(result, TelegramForbiddenError):
+                # Участник заблокировал бота — исключаем его из группы
+                members.remove(r)
+                await evict_group_member(message.bot, state.storage, r, route.group_id, members)
+            elif isinstance(result, Exception):
+                logger.error(f"Ошибка пересылки в группе от {sender_id} к {r}: {result}")
+                failed.append(result)
+
+        if failed and len(failed) == len(recipients):
+            await report_relay_error(message, failed[0])
         return  # Важно — выходим, чтобы не обрабатывать как 1-на-1
 
     # === 1-НА-1 ЧАТ ===
-    partner_id = await db.get_partner(message.from_user.id)
+    partner_id = route.partners[0] if route else None
     if not partner_id:
         await state.set_state(ChatState.idle)
         await message.answer("Диалог завершён. Начните новый поиск.", reply_markup=get_main_keyboard())
         return
 
+    started = time.perf_counter()
     try:
-        # Полная пересылка всех типов сообщений в 1-на-1
-        if message.text:
-            await message.bot.send_message(partner_id, message.text)
-        elif message.photo:
-            photo = message.photo[-1]
-            await message.bot.send_photo(partner_id, photo.file_id, caption=message.caption)
-        elif message.video:
-            await message.bot.send_video(partner_id, message.video.file_id, caption=message.caption)
-        elif message.video_note:  # кружочек
-            await message.bot.send_video_note(partner_id, message.video_note.file_id)
-        elif message.sticker:
-            await message.bot.send_sticker(partner_id, message.sticker.file_id)
-        elif message.animation:  # GIF / анимированный стикер
-            await message.bot.send_animation(partner_id, message.animation.file_id, caption=message.caption)
-        elif message.voice:
-            await message.bot.send_voice(partner_id, message.voice.file_id, caption=message.caption)
-        elif message.document:
-            await message.bot.send_document(partner_id, message.document.file_id, caption=message.caption)
-        elif message.audio:
-            await message.bot.send_audio(partner_id, message.audio.file_id, caption=message.caption)
-        elif message.location:
-            await message.bot.send_location(partner_id, message.location.latitude, message.location.longitude)
-        elif message.contact:
-            await message.bot.send_contact(partner_id, phone_number=message.contact.phone_number,
-                                           first_name=message.contact.first_name, last_name=message.contact.last_name)
-        else:
-            # Если тип не поддерживается — уведомляем
-            await message.answer("❌ Этот тип сообщения пока не поддерживается в чате.")
-            return
+        await relay_message(message, partner_id)
+        RELAY_SECONDS.observe(time.perf_counter() - started, chat="private")
 
         # Обновляем счётчик сообщений (только для 1-на-1)
-        session_id = await db.get_session(message.from_user.id)
-        if session_id:
-            async with db.get_connection() as conn:
-                await conn.execute("UPDATE chat_sessions SET message_count = message_count + 1 WHERE id = $1",
-                                   session_id)
+        if route.session_id:
+            db.count_message(route.session_id)
 
-    except Exception as e:
-        logger.error(f"Ошибка пересылки в 1-на-1 от {message.from_user.id} к {partner_id}: {e}")
+    except TelegramForbiddenError as e:
+        logger.error(f"Собеседник {partner_id} заблокировал бота (от {message.from_user.id}): {e}")
         await db.end_chat(message.from_user.id)
         await state.set_state(ChatState.idle)
         await message.answer(
@@ -2730,174 +4894,31 @@ async def chat_forward(message: Message, state: FSMContext):
             reply_markup=get_main_keyboard()
         )
 
+    except Exception as e:
+        logger.error(f"Ошибка пересылки в 1-на-1 от {message.from_user.id} к {partner_id}: {e}")
+        await report_relay_error(message, e)
 
-# ========== ПЕРЕСЫЛКА МЕДИА ==========
-@router.message(ChatState.chatting)
-async def forward_all_media(message: Message, state: FSMContext):
-    """Пересылать все виды медиа и другие типы сообщений"""
-    # Пропускаем текстовые сообщения (они обрабатываются выше)
-    if message.text:
-        return
-
-    partner_id = await db.get_partner(message.from_user.id)
-
-    if not partner_id:
-        await state.set_state(ChatState.idle)
-        await message.answer(
-            "Диалог завершен 😐\n\nОтправьте /search, чтобы начать новый поиск",
-            reply_markup=get_main_keyboard()
-        )
-        return
-
-    try:
-        # Пересылаем в зависимости от типа контента
-
-        # ФОТО (может быть несколько фото в альбоме)
-        if message.photo:
-            if len(message.photo) > 0:
-                # Берем фото самого высокого качества (последний в массиве)
-                photo = message.photo[-1]
-                await message.bot.send_photo(
-                    chat_id=partner_id,
-                    photo=photo.file_id,
-                    caption=message.caption
-                )
-
-        # ВИДЕО
-        elif message.video:
-            await message.bot.send_video(
-                chat_id=partner_id,
-                video=message.video.file_id,
-                caption=message.caption,
-                duration=message.video.duration,
-                width=message.video.width,
-                height=message.video.height
-            )
-
-        # ВИДЕОЗАПИСЬ (Video Note - кружочки)
-        elif message.video_note:
-            await message.bot.send_video_note(
-                chat_id=partner_id,
-                video_note=message.video_note.file_id,
-                duration=message.video_note.duration,
-                length=message.video_note.length
-            )
-
-        # СТИКЕРЫ
-        elif message.sticker:
-            await message.bot.send_sticker(
-                chat_id=partner_id,
-                sticker=message.sticker.file_id
-            )
-
-        # ГОЛОСОВЫЕ СООБЩЕНИЯ
-        elif message.voice:
-            await message.bot.send_voice(
-                chat_id=partner_id,
-                voice=message.voice.file_id,
-                caption=message.caption,
-                duration=message.voice.duration
-            )
-
-        # АУДИО ФАЙЛЫ
-        elif message.audio:
-            await message.bot.send_audio(
-                chat_id=partner_id,
-                audio=message.audio.file_id,
-                caption=message.caption,
-                duration=message.audio.duration,
-                performer=message.audio.performer,
-                title=message.audio.title
-            )
-
-        # ДОКУМЕНТЫ
-        elif message.document:
-            await message.bot.send_document(
-                chat_id=partner_id,
-                document=message.document.file_id,
-                caption=message.caption
-            )
-
-        # АНИМАЦИИ (GIF)
-        elif message.animation:
-            await message.bot.send_animation(
-                chat_id=partner_id,
-                animation=message.animation.file_id,
-                caption=message.caption,
-                duration=message.animation.duration,
-                width=message.animation.width,
-                height=message.animation.height
-            )
-
-        # КОНТАКТЫ
-        elif message.contact:
-            await message.bot.send_contact(
-                chat_id=partner_id,
-                phone_number=message.contact.phone_number,
-                first_name=message.contact.first_name,
-                last_name=message.contact.last_name
-            )
-
-        # ГЕОЛОКАЦИЯ
-        elif message.location:
-            await message.bot.send_location(
-                chat_id=partner_id,
-                latitude=message.location.latitude,
-                longitude=message.location.longitude
-            )
-
-        # ОПОВЕЩЕНИЕ О НАБОРЕ ТЕКСТА (просто игнорируем)
-        elif message.chat_shared or message.users_shared or message.write_access_allowed:
-            # Эти типы сообщений не пересылаем
-            return
-
-        # Если тип сообщения не поддерживается
-        else:
-            await message.answer(
-                "❌ Этот тип сообщения не поддерживается для пересылки",
-                reply_markup=get_main_keyboard()
-            )
-            return
-
-        # Обновляем счетчик сообщений в сессии
-        session_id = await db.get_session(message.from_user.id)
-        if session_id:
-            async with db.get_connection() as conn:
-                await conn.execute("""
-                    UPDATE chat_sessions 
-                    SET message_count = message_count + 1 
-                    WHERE id = $1
-                """, session_id)
 
-        logger.info(f"Медиа сообщение переслано от {message.from_user.id} к {partner_id}")
+async def fan_out(recipients: list, send) -> dict:
+    """Вызвать send(recipient) для всех получателей параллельно.
 
-    except Exception as e:
-        logger.error(f"Ошибка пересылки медиа: {e}")
+    Возвращает {recipient: результат или исключение} — сбой одного
+    получателя не прерывает доставку остальным.
+    """
+    # Запросы к Bot API идут из дочерних задач: ConnectionReleaseMiddleware в них
+    # не владеет областью и не вернёт соединение — отдаём его в пул здесь
+    scope = CONNECTION_SCOPE.get()
+    if scope is not None and scope.owned():
+        await scope.release_idle()
+    results = await asyncio.gather(*(send(r) for r in recipients), return_exceptions=True)
+    return dict(zip(recipients, results))
 
-        # Проверяем конкретные ошибки
-        error_message = str(e).lower()
 
-        if "forbidden" in error_message or "blocked" in error_message:
-            # Пользователь заблокировал бота
-            await db.end_chat(message.from_user.id)
-            await state.set_state(ChatState.idle)
-            await message.answer(
-                "❌ Собеседник заблокировал бота. Диалог завершен.\n\n"
-                "Отправьте /search, чтобы начать новый поиск",
-                reply_markup=get_main_keyboard()
-            )
-        elif "file is too big" in error_message:
-            # Файл слишком большой
-            await message.answer(
-                "❌ Файл слишком большой для отправки. Максимальный размер файла - 50 МБ",
-                reply_markup=get_main_keyboard()
-            )
-        else:
-            # Общая ошибка
-            await message.answer(
-                "❌ Не удалось отправить это сообщение. Попробуйте другой формат или текст.",
-                reply_markup=get_main_keyboard()
-            )
+async def evict_group_member(bot: Bot, storage, telegram_id: int, group_id: int, remaining_members: list):
+    """Исключить из группы участника, заблокировавшего бота"""
+    logger.info(f"Участник {telegram_id} заблокировал бота — исключаем из группы {group_id}")
+    await db.leave_group(telegram_id, group_id, close_group=len(remaining_members) <= 1)
+    await notify_group_member_left(bot, storage, remaining_members)
 
 
 # ========== ПРОВЕРКА АКТИВНОГО ЧАТА ПРИ ЛЮБОМ СООБЩЕНИИ ==========
@@ -2916,14 +4937,8 @@ async def check_active_chat(message: Message, state: FSMContext):
 
     restored = False
 
-    # === Восстановление 1-на-1 чата ===
-    partner_id = await db.get_partner(message.from_user.id)
-    if partner_id:
-        await state.set_state(ChatState.chatting)
-        restored = True
-
-    # === Восстановление группового чата ===
-    elif await db.is_in_active_group(message.from_user.id):
+    # === Восстановление 1-на-1 или группового чата (маршрут подгрузится в память) ===
+    if await db.get_route(message.from_user.id):
         await state.set_state(ChatState.chatting)
         restored = True
 
@@ -2974,9 +4989,498 @@ async def successful_payment(message: Message):
         )
 
 
+# ========== ФОНОВЫЙ ПОДБОР ПАР ==========
+async def get_match_found_text(viewer_id: int, other_profile: Optional[dict]) -> str:
+    """Текст «Собеседник найден» — премиум видит пол и возраст собеседника"""
+    if other_profile and other_profile.get('gender') and await db.has_active_premium(viewer_id):
+        gender_text = "Парень" if other_profile['gender'] == "male" else "Девушка"
+        age_text = other_profile['age'] if other_profile['age'] else "Не указан"
+        return (
+            f"<b>Собеседник найден!</b>\n\n"
+            f"<i>Пол: {gender_text}</i>\n"
+            f"<i>Возраст: {age_text}</i>\n\n"
+            f"<i>/next — искать следующего</i>\n"
+            f"<i>/stop — закончить диалог</i>"
+        )
+    return (
+        "<b>Собеседник найден!</b>\n\n"
+        "<i>/next — искать следующего</i>\n"
+        "<i>/stop — закончить диалог</i>"
+    )
+
+
+async def announce_match(bot: Bot, storage, user_id: int, partner_id: int):
+    """Уведомить обоих о найденной паре и перевести их в состояние чата"""
+    profiles = {
+        user_id: await db.get_user_profile(user_id),
+        partner_id: await db.get_user_profile(partner_id),
+    }
+    try:
+        for viewer_id, other_id in ((user_id, partner_id), (partner_id, user_id)):
+            text = await get_match_found_text(viewer_id, profiles[other_id])
+            await bot.send_message(viewer_id, text, parse_mode="HTML", reply_markup=None)
+
+            key = StorageKey(bot_id=bot.id, chat_id=viewer_id, user_id=viewer_id)
+            await FSMContext(storage=storage, key=key).set_state(ChatState.chatting)
+
+        logger.info(f"Фоновый подбор: чат начат {user_id} ↔ {partner_id}")
+
+    except Exception as e:
+        logger.error(f"Фоновый подбор: ошибка подключения пары {user_id} ↔ {partner_id}: {e}")
+        await db.end_chat(user_id)
+        for telegram_id in (user_id, partner_id):
+            try:
+                key = StorageKey(bot_id=bot.id, chat_id=telegram_id, user_id=telegram_id)
+                await FSMContext(storage=storage, key=key).set_state(ChatState.idle)
+                await bot.send_message(
+                    telegram_id,
+                    "<i>Ошибка соединения.</i> 😔\n"
+                    "<i>Поиск отменён. Попробуйте снова.</i>",
+                    parse_mode="HTML",
+                    reply_markup=get_main_keyboard()
+                )
+            except Exception:
+                pass  # этот участник и был недоступен
+
+
+def is_group_compatible(entry: dict, other: dict) -> bool:
+    """Может ли find_group_partner собрать группу из entry и other (без открытых групп)"""
+    if entry['target_gender']:
+        return other['gender'] == entry['target_gender'] and other['target_gender'] in (None, entry['gender'])
+    return other['target_gender'] in (None, entry['gender'])
+
+
+async def run_match_round(bot: Bot, storage):
+    """Один проход подбора по обеим очередям"""
+    # === 1-на-1: вся очередь в памяти разбирается за проход ===
+    for user_id, partner_id, _ in await db.match_waiting_users():
+        await announce_match(bot, storage, user_id, partner_id)
+
+    # === Групповой поиск ===
+    queue = await db.get_group_search_queue()
+    if not queue:
+        return
+
+    open_group = await db.has_open_group()
+    matched = set()
+
+    for entry in queue:
+        telegram_id = entry['telegram_id']
+        if telegram_id in matched or not entry['gender']:
+            continue
+
+        # Не тратим транзакцию, если собрать группу заведомо не из кого
+        if not open_group and not any(
+            is_group_compatible(entry, other)
+            for other in queue
+            if other['telegram_id'] != telegram_id and other['telegram_id'] not in matched
+        ):
+            continue
+
+        result = await db.find_group_partner(telegram_id, entry['target_gender'])
+        if not result:
+            continue
+
+        members, group_id, is_joining = result
+        matched.update(members)
+        await start_group_chat(bot, storage, members, is_joining)
+        open_group = await db.has_open_group()
+        logger.info(f"Фоновый подбор: группа {group_id}, участники {members}")
+
+
+async def run_match_scheduler(bot: Bot, storage):
+    """Периодический подбор пар для всех ожидающих, без участия нового ищущего"""
+    logger.info(f"✅ Фоновый подбор пар запущен (каждые {MATCH_SCHEDULER_INTERVAL} с)")
+    while True:
+        await asyncio.sleep(MATCH_SCHEDULER_INTERVAL)
+        # В кластере очередь одна на всех — разбирает её лидер
+        if not db.is_leader:
+            continue
+        try:
+            await run_match_round(bot, storage)
+        except Exception as e:
+            logger.error(f"Ошибка фонового подбора пар: {e}")
+
+
+# ========== СБРОС СЧЁТЧИКОВ СООБЩЕНИЙ ==========
+async def run_message_count_flusher():
+    """Периодическая запись накопленных счётчиков сообщений"""
+    while True:
+        await asyncio.sleep(MESSAGE_COUNT_FLUSH_INTERVAL)
+        flushed = await db.flush_message_counts()
+        if flushed:
+            logger.info(f"Счётчики сообщений записаны: {flushed} сессий")
+
+
+async def run_presence_flusher():
+    """Периодическая запись last_seen одним пакетом"""
+    while True:
+        await asyncio.sleep(PRESENCE_FLUSH_INTERVAL)
+        await db.flush_presence()
+
+
+async def run_stats_reconciler():
+    """Периодическая сверка счётчиков /stats с БД"""
+    while True:
+        await asyncio.sleep(STATS_RECONCILE_INTERVAL)
+        try:
+            await db.reconcile_stats()
+        except Exception as e:
+            logger.error(f"Ошибка сверки статистики: {e}")
+
+
+# ========== ФОНОВАЯ ОЧИСТКА ==========
+SEARCHING_STATES = (ChatState.searching.state, SearchByGenderState.searching.state,
+                    GroupSearchState.searching.state)
+
+
+async def expire_search(bot: Bot, storage, telegram_id: int):
+    """Сбросить поиск, снятый по сроку, и сообщить об этом пользователю"""
+    key = StorageKey(bot_id=bot.id, chat_id=telegram_id, user_id=telegram_id)
+    context = FSMContext(storage=storage, key=key)
+    if await context.get_state() not in SEARCHING_STATES:
+        return
+    await context.clear()
+    db.notify(
+        telegram_id,
+        "⏳ <i>Поиск остановлен — собеседник так и не нашёлся.</i>\n\n"
+        "<i>Нажмите «🔍 Найти собеседника», чтобы искать снова.</i>",
+        parse_mode="HTML",
+        reply_markup=get_main_keyboard()
+    )
+
+
+async def run_janitor(bot: Bot, storage):
+    """Периодическая очистка зависших групп, очередей и соединений"""
+    logger.info(f"✅ Фоновая очистка запущена (каждые {JANITOR_INTERVAL} с)")
+    while True:
+        await asyncio.sleep(JANITOR_INTERVAL)
+        if not db.is_leader:
+            continue
+        try:
+            reclaimed = await db.run_maintenance()
+            expired = await db.expire_searches()
+            for telegram_id in expired:
+                await expire_search(bot, storage, telegram_id)
+        except Exception as e:
+            logger.error(f"Ошибка фоновой очистки: {e}")
+            continue
+        reclaimed["expired_searches"] = len(expired)
+        if any(reclaimed.values()):
+            logger.info("🧹 Очистка: " + ", ".join(f"{name}={count}" for name, count in reclaimed.items()))
+
+
+# ========== ПОРЯДОК ОБНОВЛЕНИЙ ПОЛЬЗОВАТЕЛЯ ==========
+# Кнопки меню, повторное нажатие которых до окончания обработки первого ничего не добавляет
+COALESCED_BUTTONS = frozenset({
+    "🔍 Найти собеседника", "🍓 Поиск по полу", "👥 Групповой поиск", "⚙️ Профиль",
+    "👩 Найти девушку", "👨 Найти парня",
+})
+# То же для команд без аргументов; команды с аргументами и прочий текст со «/» пересылаются как есть
+COALESCED_COMMANDS = frozenset({"/start", "/search", "/next", "/stop", "/leave"})
+
+UPDATES_DROPPED = METRICS.register(Counter(
+    "bot_updates_dropped_total", "Отброшенные обновления: переполнение очереди или дубль кнопки",
+    labels=("reason",)))
+
+
+class UserQueue:
+    """Очередь обновлений одного пользователя: замок (FIFO) и ключи ожидающих нажатий"""
+
+    __slots__ = ('lock', 'pending', 'keys', 'cluster_locked', 'overflowed')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.pending = 0
+        self.keys = {}
+        # Пользователь уже предупреждён о переполнении (до опустошения очереди)
+        self.overflowed = False
+        # Пользователь занят за этой репликой (ClusterBus.lock_user), пока очередь не опустеет
+        self.cluster_locked = False
+
+
+def update_user_id(update: types.Update) -> Optional[int]:
+    try:
+        event = update.event
+    except UpdateTypeLookupError:
+        # Тип обновления новее aiogram — обрабатываем вне очередей пользователей
+        return None
+    user = getattr(event, 'from_user', None)
+    return user.id if user else None
+
+
+def duplicate_key(update: types.Update) -> Optional[tuple]:
+    """Ключ для схлопывания повторных нажатий; None — обновление схлопывать нельзя (обычные сообщения)"""
+    if update.callback_query:
+        query = update.callback_query
+        return "callback", query.data, query.message.message_id if query.message else None
+    if update.message and update.message.text:
+        text = update.message.text
+        if text in COALESCED_BUTTONS or text in COALESCED_COMMANDS:
+            return "text", text
+    return None
+
+
+class OrderedDispatcher(Dispatcher):
+    """Обновления одного пользователя обрабатываются строго по очереди, разных — параллельно.
+
+    Повторное нажатие кнопки, пока такое же ещё ждёт или обрабатывается, отбрасывается;
+    очередь пользователя ограничена USER_QUEUE_LIMIT. В кластере пачка обновлений
+    пользователя обрабатывается под одной блокировкой ClusterBus.lock_user.
+    """
+
+    def __init__(self, *args, user_queue_limit: int = USER_QUEUE_LIMIT,
+                 cluster: Optional[ClusterBus] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.user_queue_limit = user_queue_limit
+        self.cluster = cluster
+        self.user_queues: Dict[int, UserQueue] = {}
+
+    async def feed_update(self, bot: Bot, update: types.Update, **kwargs: Any) -> Any:
+        user_id = update_user_id(update)
+        if user_id is None:
+            return await super().feed_update(bot, update, **kwargs)
+
+        queue = self.user_queues.get(user_id)
+        if queue is None:
+            queue = self.user_queues[user_id] = UserQueue()
+
+        if queue.pending >= self.user_queue_limit:
+            UPDATES_DROPPED.inc(reason="overflow")
+            logger.warning(f"Очередь пользователя {user_id} переполнена — обновление {update.update_id} отброшено")
+            if not queue.overflowed:
+                # Один раз на эпизод: отправитель должен знать, что часть сообщений не дошла
+                queue.overflowed = True
+                db.notify(
+                    user_id,
+                    "⚠️ <i>Слишком много сообщений подряд — часть из них не доставлена.</i>\n"
+                    "<i>Подождите немного и отправьте их снова.</i>",
+                    parse_mode="HTML"
+                )
+            if update.callback_query:
+                return AnswerCallbackQuery(callback_query_id=update.callback_query.id)
+            return UNHANDLED
+
+        key = duplicate_key(update)
+        if key is not None and key in queue.keys:
+            UPDATES_DROPPED.inc(reason="duplicate")
+            logger.info(f"Повторное нажатие {key[1]!r} от {user_id} — пропускаем")
+            if update.callback_query:
+                # Гасим «часики» на кнопке ответом на вебхук/через polling
+                return AnswerCallbackQuery(callback_query_id=update.callback_query.id)
+            return UNHANDLED
+
+        queue.pending += 1
+        if key is not None:
+            queue.keys[key] = True
+        try:
+            async with queue.lock:
+                try:
+                    if self.cluster is not None and not queue.cluster_locked:
+                        queue.cluster_locked = await self.cluster.lock_user(user_id)
+                    return await super().feed_update(bot, update, **kwargs)
+                finally:
+                    if queue.cluster_locked and queue.pending == 1:
+                        # Последнее обновление пачки: снимаем блокировку, пока держим очередь, —
+                        # пришедшее тем временем обновление ждёт её и захватит блокировку заново
+                        queue.cluster_locked = False
+                        await self.cluster.unlock_user(user_id)
+        finally:
+            queue.pending -= 1
+            if key is not None:
+                queue.keys.pop(key, None)
+            if queue.pending == 0:
+                self.user_queues.pop(user_id, None)
+
+    def queue_depths(self) -> Tuple[int, int]:
+        """(обновлений ждут очереди, наибольшая очередь одного пользователя)"""
+        waiting = [max(queue.pending - 1, 0) for queue in self.user_queues.values()]
+        return sum(waiting), max(waiting, default=0)
+
+
+# ========== ВЕБ-СЕРВЕР И ВЕБХУК ==========
+async def handle_health(request: web.Request) -> web.Response:
+    """Проверка живости для балансировщика/Railway"""
+    return web.json_response({
+        "status": "ok" if db.pool is not None else "starting",
+        "mode": BOT_MODE,
+        "node": NODE_ID,
+        "leader": db.is_leader,
+        "search_queue": len(db.matchmaker),
+    })
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    """Метрики процесса в текстовом формате Prometheus"""
+    return web.Response(text=METRICS.expose(), content_type="text/plain", charset="utf-8")
+
+
+def build_web_app() -> web.Application:
+    """Публичное aiohttp-приложение: только /health (и вебхук, если он включён)"""
+    app = web.Application()
+    app.router.add_get("/health", handle_health)
+    return app
+
+
+def build_metrics_app() -> web.Application:
+    """Внутреннее aiohttp-приложение с /metrics: в метриках отпечатки SQL и счётчики по пользователям"""
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    return app
+
+
+async def start_web_server(app: web.Application, host: Optional[str] = None,
+                           port: Optional[int] = None) -> web.AppRunner:
+    """Запустить приложение; по умолчанию — на публичном WEB_SERVER_HOST:WEB_SERVER_PORT"""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host=host or WEB_SERVER_HOST, port=port or WEB_SERVER_PORT)
+    await site.start()
+    return runner
+
+
+def _search_queue_sizes() -> dict:
+    sizes = {}
+    for (gender, target_gender), count in db.matchmaker.bucket_sizes().items():
+        sizes[(gender, target_gender or "any")] = count
+    return sizes
+
+
+def _group_queue_sizes() -> dict:
+    sizes = {}
+    for target_gender in db.stats.group_queue.values():
+        key = (target_gender or "any",)
+        sizes[key] = sizes.get(key, 0) + 1
+    return sizes
+
+
+METRICS.register(Gauge("bot_search_queue_size", "Ожидающие в очереди 1-на-1",
+                       _search_queue_sizes, labels=("gender", "target_gender")))
+METRICS.register(Gauge("bot_group_search_queue_size", "Ожидающие в очереди группового поиска",
+                       _group_queue_sizes, labels=("target_gender",)))
+METRICS.register(Gauge("bot_active_chat_users", "Пользователи в активных чатах 1-на-1",
+                       lambda: len(db.stats.chat_users)))
+METRICS.register(Gauge("bot_active_groups", "Активные групповые чаты",
+                       lambda: len(db.stats.groups)))
+METRICS.register(Gauge("bot_db_pool_size", "Соединений в пуле asyncpg",
+                       lambda: db.pool.get_size() if db.pool else 0))
+METRICS.register(Gauge("bot_db_pool_idle", "Свободных соединений в пуле asyncpg",
+                       lambda: db.pool.get_idle_size() if db.pool else 0))
+METRICS.register(Gauge("bot_profile_cache_hit_ratio", "Доля попаданий в кэш профилей",
+                       lambda: db.profiles.hit_rate()))
+METRICS.register(Gauge("bot_cluster_leader", "1, если реплика выполняет фоновый подбор и очистку",
+                       lambda: int(db.is_leader)))
+
+
+async def on_webhook_startup(bot: Bot, dispatcher: Dispatcher):
+    if not WEBHOOK_URL:
+        logger.warning("⚠️ WEBHOOK_URL не задан — вебхук не зарегистрирован, обновления принимаются только локально")
+        return
+    await bot.set_webhook(
+        url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dispatcher.resolve_used_update_types(),
+    )
+    logger.info(f"✅ Вебхук установлен: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+
+
+async def on_webhook_shutdown(bot: Bot):
+    # Остальные реплики продолжают принимать обновления по тому же вебхуку
+    if not WEBHOOK_URL or CLUSTER_MODE:
+        return
+    await bot.delete_webhook()
+    logger.info("Вебхук удалён")
+
+
+def stop_on_signals() -> asyncio.Event:
+    """Событие, которое выставляют SIGTERM/SIGINT: main успевает выполнить finally (Railway шлёт SIGTERM)"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # Windows: остаётся KeyboardInterrupt
+            pass
+    return stop
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher, stop: asyncio.Event):
+    """Приём обновлений через вебхук вместо long polling"""
+    app = build_web_app()
+
+    # Обработчик проверяет X-Telegram-Bot-Api-Secret-Token
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    dp.startup.register(on_webhook_startup)
+    dp.shutdown.register(on_webhook_shutdown)
+    setup_application(app, dp, bot=bot)
+
+    runner = await start_web_server(app)
+    logger.info(f"✅ Веб-сервер запущен на {WEB_SERVER_HOST}:{WEB_SERVER_PORT} (вебхук {WEBHOOK_PATH})")
+
+    try:
+        await stop.wait()
+        logger.info("Получен сигнал остановки")
+    finally:
+        await runner.cleanup()
+
+
+async def stop_polling_task(dp: Dispatcher, polling: asyncio.Task):
+    try:
+        await dp.stop_polling()
+    except RuntimeError:
+        # Опрос ещё не успел начаться
+        polling.cancel()
+    done, _ = await asyncio.wait({polling}, timeout=5)
+    if not done:
+        polling.cancel()
+    await asyncio.gather(polling, return_exceptions=True)
+
+
+async def run_cluster_polling(bot: Bot, dp: Dispatcher, bus: ClusterBus, stop: asyncio.Event):
+    """Long polling в кластере: getUpdates опрашивает только лидер — второй опрос Telegram отклонит"""
+    polling = None
+    try:
+        while not stop.is_set():
+            if polling is not None and polling.done():
+                polling.result()
+                return
+            if bus.is_leader and polling is None:
+                logger.info("Реплика — лидер, начинаем опрос обновлений")
+                # Сигналы обрабатывает stop_on_signals, а не aiogram
+                polling = asyncio.create_task(
+                    dp.start_polling(bot, handle_signals=False, close_bot_session=False))
+            elif not bus.is_leader and polling is not None:
+                logger.warning("Лидерство потеряно — опрос обновлений остановлен")
+                await stop_polling_task(dp, polling)
+                polling = None
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=LEADER_RETRY_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        logger.info("Получен сигнал остановки")
+    finally:
+        if polling is not None and not polling.done():
+            await stop_polling_task(dp, polling)
+        await bot.session.close()
+
+
 # ========== ЗАПУСК БОТА ==========
 async def main():
     """Главная функция запуска бота"""
+    # Каждая реплика регистрирует вебхук при старте: со случайным секретом последняя
+    # перезаписала бы его, и остальные отклоняли бы все обновления
+    if CLUSTER_MODE and BOT_MODE == "webhook" and not os.getenv("WEBHOOK_SECRET"):
+        logger.error("❌ CLUSTER_MODE=1 с вебхуком требует общего WEBHOOK_SECRET для всех реплик")
+        return
+
+    # Реплики согласуют состояние в памяти через LISTEN/NOTIFY
+    bus = None
+    if CLUSTER_MODE:
+        bus = ClusterBus(DATABASE_URL)
+        db.attach_bus(bus)
+        logger.info(f"✅ Режим кластера, реплика {NODE_ID}")
+
     # Инициализация базы данных
     logger.info("🔄 Инициализация базы данных...")
     db_success = await db.init()
@@ -2986,16 +5490,94 @@ async def main():
 
     # Создание бота и диспетчера
     bot = Bot(token=TOKEN)
-    storage = MemoryStorage()
-    dp = Dispatcher(storage=storage)
+    # Соединение с БД не держим, пока ждём Telegram
+    bot.session.middleware(ConnectionReleaseMiddleware())
+    # Исходящие запросы идут через планировщик с лимитами Bot API
+    bot.session.middleware(TelegramRateLimiter())
+    # Внутри планировщика — измеряем сам запрос, без ожидания лимита
+    bot.session.middleware(TelegramMetricsMiddleware())
+    storage = create_fsm_storage(db)
+    logger.info(f"✅ Хранилище FSM: {type(storage).__name__}")
+    # Обновления одного пользователя — по порядку, разных — параллельно
+    dp = OrderedDispatcher(storage=storage, cluster=bus)
+    METRICS.register(Gauge("bot_user_queue_waiting", "Обновления, ожидающие очереди своего пользователя",
+                           lambda: dp.queue_depths()[0]))
+    METRICS.register(Gauge("bot_user_queue_max_depth", "Наибольшая очередь обновлений одного пользователя",
+                           lambda: dp.queue_depths()[1]))
+    METRICS.register(Gauge("bot_user_queues", "Пользователи с обновлениями в обработке",
+                           lambda: len(dp.user_queues)))
 
     # Регистрация роутера
     dp.include_router(router)
 
+    # Время обработки по обработчикам: внешний middleware открывает трассировку,
+    # внутренние записывают имя обработчика после фильтров
+    dp.update.outer_middleware(UpdateTimingMiddleware())
+    handler_names = HandlerNameMiddleware()
+    for observer in (router.message, router.callback_query, router.pre_checkout_query):
+        observer.middleware(handler_names)
+
+    # Одно соединение из пула на обновление вместо acquire/release на каждый метод Database
+    dp.update.outer_middleware(ConnectionScopeMiddleware(db))
+
+    # Соединение кластера: события других реплик и выбор лидера
+    bus_task = asyncio.create_task(bus.run()) if bus else None
+
+    # Фоновый подбор пар для ожидающих в очередях
+    scheduler_task = asyncio.create_task(run_match_scheduler(bot, storage))
+    # Отложенная запись счётчиков сообщений
+    flusher_task = asyncio.create_task(run_message_count_flusher())
+    # Уборка зависших строк вне обработчиков
+    janitor_task = asyncio.create_task(run_janitor(bot, storage))
+    # Уведомления, отложенные до коммита транзакций
+    outbox_tasks = [asyncio.create_task(db.outbox.run(bot)) for _ in range(OUTBOX_WORKERS)]
+    # Пакетная запись last_seen
+    presence_task = asyncio.create_task(run_presence_flusher())
+    # Сверка счётчиков /stats
+    stats_task = asyncio.create_task(run_stats_reconciler())
+
     logger.info("✅ Бот запускается...")
 
+    metrics_runner = await start_web_server(build_metrics_app(), host=METRICS_HOST, port=METRICS_PORT)
+    logger.info(f"✅ /metrics на {METRICS_HOST}:{METRICS_PORT}")
+
     # Запуск бота
-    await dp.start_polling(bot)
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(bot, dp, stop_on_signals())
+        else:
+            # В режиме polling веб-сервер нужен только для /health
+            runner = await start_web_server(build_web_app())
+            logger.info(f"✅ /health на {WEB_SERVER_HOST}:{WEB_SERVER_PORT}")
+            try:
+                if bus:
+                    await run_cluster_polling(bot, dp, bus, stop_on_signals())
+                else:
+                    await dp.start_polling(bot)
+            finally:
+                await runner.cleanup()
+    finally:
+        await metrics_runner.cleanup()
+        # Даём воркерам дослать накопленные уведомления, включая ждущие повтора
+        db.outbox.flush_retries()
+        try:
+            await asyncio.wait_for(db.outbox.queue.join(), timeout=5)
+        except asyncio.TimeoutError:
+            pass
+        if len(db.outbox):
+            logger.warning(f"Не отправлено уведомлений при остановке: {len(db.outbox)}")
+        scheduler_task.cancel()
+        flusher_task.cancel()
+        janitor_task.cancel()
+        presence_task.cancel()
+        stats_task.cancel()
+        for task in outbox_tasks:
+            task.cancel()
+        if bus_task:
+            bus_task.cancel()
+        # Не теряем счётчики и отметки активности при остановке
+        await db.flush_message_counts()
+        await db.flush_presence()
 
 
 if __name__ == "__main__":
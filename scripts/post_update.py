@@ -0,0 +1,57 @@
+"""Отправить на локальный вебхук бота поддельное обновление Telegram.
+
+Пример (бот запущен с BOT_MODE=webhook и тем же WEBHOOK_SECRET):
+
+    python scripts/post_update.py --user-id 111 --text /search
+    python scripts/post_update.py --url http://localhost:8082/webhook --user-id 222 --text привет
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import time
+
+import aiohttp
+
+_update_ids = itertools.count(int(time.time()))
+
+
+def build_update(user_id: int, text: str, update_id: int = None) -> dict:
+    """Update с личным текстовым сообщением от user_id — в том виде, в каком его шлёт Telegram"""
+    update_id = next(_update_ids) if update_id is None else update_id
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": f"user{user_id}"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": text,
+        },
+    }
+
+
+async def post_update(url: str, secret: str, update: dict) -> int:
+    """POST обновления с заголовком секрета вебхука; возвращает HTTP-статус"""
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret}
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, json=update, headers=headers) as response:
+            return response.status
+
+
+def main():
+    port = os.getenv("PORT", "8080")
+    path = os.getenv("WEBHOOK_PATH", "/webhook")
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default=f"http://localhost:{port}{path}")
+    parser.add_argument("--secret", default=os.getenv("WEBHOOK_SECRET", ""))
+    parser.add_argument("--user-id", type=int, required=True)
+    parser.add_argument("--text", required=True)
+    args = parser.parse_args()
+
+    status = asyncio.run(post_update(args.url, args.secret, build_update(args.user_id, args.text)))
+    print(f"{args.url}: HTTP {status}")
+
+
+if __name__ == "__main__":
+    main()
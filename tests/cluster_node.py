@@ -0,0 +1,73 @@
+"""Реплика для tests/test_cluster.py: отдельный процесс с ClusterBus, управляемый через stdin/stdout.
+
+Запуск: python tests/cluster_node.py <DSN> <NODE_ID>. Команды построчно:
+    listen <kind>        — печатать «event <kind> <ids>» на каждое событие kind
+    publish <kind> <ids> — отправить событие, как Database.publish_ids (ids через запятую)
+    elect                — запустить ClusterBus.run; смена лидерства печатается «leader 0|1»
+    lock <id>            — «locked 0|1» после ClusterBus.lock_user
+    unlock <id>          — «unlocked» после ClusterBus.unlock_user
+    ping                 — «pong»: всё напечатанное до него уже прочитано
+Ответ на каждую команду — строка; «ready» после подключения.
+"""
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+def say(*parts):
+    print(*parts, flush=True)
+
+
+async def watch_leadership(bus: bot.ClusterBus):
+    leader = False
+    while True:
+        if bus.is_leader != leader:
+            leader = bus.is_leader
+            say("leader", int(leader))
+        await asyncio.sleep(0.02)
+
+
+async def main(dsn: str, node_id: str):
+    bus = bot.ClusterBus(dsn, node_id=node_id)
+    await bus.connect()
+    tasks = []
+    say("ready")
+
+    loop = asyncio.get_running_loop()
+    while True:
+        line = await loop.run_in_executor(None, sys.stdin.readline)
+        if not line:
+            break
+        command, *args = line.split()
+        if command == "listen":
+            kind = args[0]
+            bus.subscribe(kind, lambda ids, kind=kind: say("event", kind, ",".join(map(str, ids))))
+            say("ok")
+        elif command == "publish":
+            ids = [int(i) for i in args[1].split(",")]
+            await bus._fetchval("SELECT pg_notify($1, $2)", bot.CLUSTER_CHANNEL,
+                                bus.encode(args[0], {"ids": ids}))
+            say("ok")
+        elif command == "elect":
+            tasks.append(asyncio.create_task(bus.run()))
+            tasks.append(asyncio.create_task(watch_leadership(bus)))
+            say("ok")
+        elif command == "lock":
+            say("locked", int(await bus.lock_user(int(args[0]))))
+        elif command == "unlock":
+            await bus.unlock_user(int(args[0]))
+            say("unlocked")
+        elif command == "ping":
+            say("pong")
+
+    for task in tasks:
+        task.cancel()
+    bus.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1], sys.argv[2]))
@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# Настоящая БД для тестов, которым нужен PostgreSQL; без неё они пропускаются
+TEST_DATABASE_URL = os.environ.get("DATABASE_URL")
+
+# bot.py читает настройки при импорте — тестам без БД хватает заглушек
+os.environ.setdefault("BOT_TOKEN", "123456:test-token")
+os.environ.setdefault("ADMIN_ID", "0")
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/unused")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def database_url():
+    if not TEST_DATABASE_URL:
+        pytest.skip("DATABASE_URL не задан — тест требует PostgreSQL")
+    return TEST_DATABASE_URL
@@ -0,0 +1,123 @@
+"""Две реплики — два процесса tests/cluster_node.py — на одной PostgreSQL.
+
+Проверяются рассылка событий через LISTEN/NOTIFY, передача лидерства при остановке
+лидера и блокировка пользователя за одной репликой. Нужна тестовая БД: лидерство
+и канал событий общие с ботом, запущенным на той же базе.
+"""
+import asyncio
+import os
+import sys
+
+NODE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cluster_node.py")
+
+
+class Node:
+    """Процесс-реплика: команды в stdin, ответы и события — строки stdout"""
+
+    def __init__(self, process: asyncio.subprocess.Process):
+        self.process = process
+
+    @classmethod
+    async def start(cls, dsn: str, node_id: str) -> "Node":
+        env = dict(os.environ, LEADER_RETRY_INTERVAL="0.1", USER_LOCK_TIMEOUT="0.3")
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, NODE_SCRIPT, dsn, node_id,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, env=env)
+        node = cls(process)
+        assert await node.read() == "ready"
+        return node
+
+    async def read(self, timeout: float = 5) -> str:
+        line = await asyncio.wait_for(self.process.stdout.readline(), timeout)
+        if not line:
+            raise EOFError(f"реплика завершилась с кодом {await self.process.wait()}")
+        return line.decode().strip()
+
+    async def wait_for(self, expected: str, timeout: float = 5) -> bool:
+        try:
+            while await self.read(timeout) != expected:
+                pass
+            return True
+        except (asyncio.TimeoutError, EOFError):
+            return False
+
+    async def send(self, command: str) -> str:
+        self.process.stdin.write(f"{command}\n".encode())
+        await self.process.stdin.drain()
+        return await self.read()
+
+    async def stop(self):
+        if self.process.returncode is None:
+            self.process.terminate()
+        await self.process.wait()
+
+
+async def _nodes(dsn: str) -> tuple:
+    node_a = await Node.start(dsn, "test-a")
+    try:
+        return node_a, await Node.start(dsn, "test-b")
+    except BaseException:
+        await node_a.stop()
+        raise
+
+
+def test_events_fan_out_to_other_nodes(database_url):
+    async def scenario():
+        node_a, node_b = await _nodes(database_url)
+        try:
+            assert await node_a.send("listen test_ping") == "ok"
+            assert await node_b.send("listen test_ping") == "ok"
+            assert await node_a.send("publish test_ping 1,2") == "ok"
+            delivered = await node_b.wait_for("event test_ping 1,2")
+            # Свои события реплика не применяет повторно: до ответа на ping событий нет
+            assert await node_a.send("ping") == "pong"
+            return delivered
+        finally:
+            await node_a.stop()
+            await node_b.stop()
+
+    assert asyncio.run(scenario())
+
+
+def test_leadership_moves_when_leader_stops(database_url):
+    async def scenario():
+        node_a, node_b = await _nodes(database_url)
+        try:
+            assert await node_a.send("elect") == "ok"
+            assert await node_a.wait_for("leader 1")
+            assert await node_b.send("elect") == "ok"
+            # Пока лидер жив, вторая реплика лидером не становится
+            assert not await node_b.wait_for("leader 1", timeout=0.5)
+
+            # Процесс лидера завершается — вместе с сессией освобождается блокировка лидера
+            await node_a.stop()
+            return await node_b.wait_for("leader 1")
+        finally:
+            await node_a.stop()
+            await node_b.stop()
+
+    assert asyncio.run(scenario())
+
+
+def test_user_lock_is_held_by_one_node(database_url):
+    async def scenario():
+        node_a, node_b = await _nodes(database_url)
+        try:
+            assert await node_a.send("lock 42") == "locked 1"
+            # Повторный захват той же репликой проходит сразу
+            assert await node_a.send("lock 42") == "locked 1"
+            assert await node_b.send("lock 42") == "locked 0"
+
+            assert await node_a.send("unlock 42") == "unlocked"
+            assert await node_b.send("lock 42") == "locked 0"
+            assert await node_a.send("unlock 42") == "unlocked"
+            assert await node_b.send("lock 42") == "locked 1"
+
+            # Блокировку держит сессия: упавшая реплика не оставляет пользователя занятым
+            await node_b.stop()
+            assert await node_a.send("lock 42") == "locked 1"
+        finally:
+            await node_a.stop()
+            await node_b.stop()
+
+    asyncio.run(scenario())
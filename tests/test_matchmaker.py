@@ -0,0 +1,100 @@
+"""Подбор пар из очередей в памяти: уровни совместимости, порядок ожидания и восстановление после перезапуска"""
+import asyncio
+from contextlib import asynccontextmanager
+
+import bot
+
+
+def test_any_target_pairs_with_oldest_compatible():
+    queue = bot.Matchmaker()
+    queue.add(1, "female", "female")   # ищет только девушек — парню не подходит
+    queue.add(2, "female")
+    queue.add(3, "male", "male")       # ищет только парней — подходит
+    queue.add(4, "male")
+
+    # Случайный поиск: любой случайный или тот, кто ищет мой пол; выигрывает дольше всех ждущий
+    queue.add(5, "male")
+    assert queue.find(5) == 2
+    queue.remove(2)
+    assert queue.find(5) == 3
+
+
+def test_opposite_gender_prefers_mutual_then_random():
+    queue = bot.Matchmaker()
+    queue.add(1, "female")             # случайный поиск — ждёт дольше
+    queue.add(2, "female", "male")     # ищет именно парней — взаимный
+    queue.add(3, "male", "female")
+
+    assert queue.find(3) == 2
+    partner_id, mine, theirs = queue.pop_pair(3)
+    assert partner_id == 2
+    assert mine[:2] == ("male", "female") and theirs[:2] == ("female", "male")
+    assert 2 not in queue and 3 not in queue
+
+    # Взаимных больше нет — берём случайный поиск нужного пола
+    queue.add(4, "male", "female")
+    assert queue.find(4) == 1
+
+
+def test_same_gender_waits_for_mutual_only():
+    queue = bot.Matchmaker()
+    queue.add(1, "female")
+    queue.add(2, "female", "male")
+    queue.add(3, "female", "female")
+    assert queue.find(3) is None
+
+    queue.add(4, "female", "female")
+    assert queue.find(4) == 3
+    assert queue.find(3) == 4
+
+
+def test_queue_is_fifo_and_readd_moves_to_tail():
+    queue = bot.Matchmaker()
+    for telegram_id in (1, 2, 3):
+        queue.add(telegram_id, "female")
+    queue.add(1, "female")
+    assert queue.waiting() == [2, 3, 1]
+
+    queue.add(9, "male")
+    assert queue.find(9) == 2
+    assert queue.bucket_sizes() == {("female", None): 3, ("male", None): 1}
+
+
+def test_restore_returns_entry_to_its_place():
+    queue = bot.Matchmaker()
+    queue.add(1, "female")
+    queue.add(2, "female")
+    queue.add(3, "male")
+    partner_id, mine, theirs = queue.pop_pair(3)
+    assert partner_id == 1
+
+    # Соединение не удалось — оба возвращаются на прежние места, впереди 2
+    queue.restore(3, mine)
+    queue.restore(1, theirs)
+    assert queue.waiting() == [1, 2, 3]
+    assert queue.find(3) == 1
+
+
+def test_restart_restores_queue_from_search_queue():
+    rows = [
+        {"telegram_id": 2, "target_gender": None, "gender": "female"},
+        {"telegram_id": 1, "target_gender": "female", "gender": "male"},
+        {"telegram_id": 3, "target_gender": "male", "gender": "female"},
+    ]
+
+    class Connection:
+        async def fetch(self, query):
+            return rows
+
+    database = bot.Database()
+
+    @asynccontextmanager
+    async def get_connection():
+        yield Connection()
+
+    database.get_connection = get_connection
+    asyncio.run(database._load_search_queue())
+
+    # Порядок — как в search_queue (ORDER BY joined_at)
+    assert database.matchmaker.waiting() == [2, 1, 3]
+    assert database.matchmaker.find(1) == 3
@@ -0,0 +1,89 @@
+"""Буфер счётчиков сообщений: накопление, сброс одним UPDATE и возврат приращений при сбое или отмене"""
+import asyncio
+
+import pytest
+
+import bot
+
+
+class FakeConnection:
+    def __init__(self, error: BaseException = None, delay: float = 0):
+        self.error = error
+        self.delay = delay
+        self.calls = []
+
+    async def execute(self, query: str, *args):
+        self.calls.append(args)
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return "UPDATE %d" % len(args[0])
+
+
+class FakePool:
+    def __init__(self, conn: FakeConnection):
+        self.conn = conn
+
+    async def acquire(self):
+        return self.conn
+
+    async def release(self, conn):
+        pass
+
+
+def _database(conn: FakeConnection) -> bot.Database:
+    database = bot.Database()
+    database.pool = FakePool(conn)
+    return database
+
+
+def test_counter_accumulates_per_session():
+    counter = bot.MessageCounter()
+    counter.increment(1)
+    counter.increment(2, 3)
+    counter.increment(1)
+    assert len(counter) == 2
+    assert counter.drain() == ([1, 2], [2, 3])
+    assert len(counter) == 0
+    assert counter.drain() == ([], [])
+
+
+def test_flush_writes_all_sessions_in_one_update():
+    conn = FakeConnection()
+    database = _database(conn)
+    for session_id in (5, 5, 7):
+        database.count_message(session_id)
+
+    assert asyncio.run(database.flush_message_counts()) == 2
+    assert conn.calls == [([5, 7], [2, 1])]
+    assert len(database.message_counter) == 0
+    # Нечего сбрасывать — в БД не ходим
+    assert asyncio.run(database.flush_message_counts()) == 0
+    assert len(conn.calls) == 1
+
+
+def test_failed_flush_keeps_counts():
+    database = _database(FakeConnection(error=ConnectionError("db down")))
+    database.count_message(5)
+    database.count_message(5)
+
+    assert asyncio.run(database.flush_message_counts()) == 0
+    assert database.message_counter.drain() == ([5], [2])
+
+
+def test_cancelled_flush_keeps_counts_and_new_increments():
+    database = _database(FakeConnection(delay=10))
+    database.count_message(5)
+
+    async def scenario():
+        flush = asyncio.create_task(database.flush_message_counts())
+        await asyncio.sleep(0)
+        # Пока идёт запись, сообщения продолжают считаться
+        database.count_message(5)
+        database.count_message(6)
+        flush.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await flush
+
+    asyncio.run(scenario())
+    assert database.message_counter.drain() == ([5, 6], [2, 1])
@@ -0,0 +1,118 @@
+"""Очереди обновлений пользователей: порядок, схлопывание повторных нажатий, переполнение"""
+import asyncio
+
+import pytest
+from aiogram import Bot, types
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.methods import AnswerCallbackQuery
+
+import bot
+
+_update_ids = iter(range(1, 1_000_000))
+
+
+def message_update(user_id: int, text: str) -> types.Update:
+    update_id = next(_update_ids)
+    return types.Update.model_validate({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Test"},
+            "text": text,
+        },
+    })
+
+
+def callback_update(user_id: int, data: str) -> types.Update:
+    update_id = next(_update_ids)
+    return types.Update.model_validate({
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "chat_instance": "test",
+            "from": {"id": user_id, "is_bot": False, "first_name": "Test"},
+            "data": data,
+        },
+    })
+
+
+@pytest.fixture(autouse=True)
+def fresh_database(monkeypatch):
+    # Уведомления о переполнении уходят в outbox модульного db
+    monkeypatch.setattr(bot, "db", bot.Database())
+
+
+async def _feed(dp: bot.OrderedDispatcher, updates: list) -> list:
+    test_bot = Bot(token="123456:test-token")
+    try:
+        return await asyncio.gather(*(dp.feed_update(test_bot, update) for update in updates))
+    finally:
+        await test_bot.session.close()
+
+
+def test_user_updates_run_in_order_and_users_in_parallel():
+    dp = bot.OrderedDispatcher()
+    log = []
+
+    @dp.message()
+    async def on_message(message: types.Message):
+        log.append(("start", message.from_user.id, message.text))
+        # Первое сообщение пользователя дольше следующих — порядок держит очередь, а не время
+        await asyncio.sleep(0.05 if message.text == "1" else 0)
+        log.append(("end", message.from_user.id, message.text))
+
+    updates = [message_update(1, text) for text in ("1", "2", "3")] + [message_update(2, "1")]
+    asyncio.run(_feed(dp, updates))
+
+    user_1 = [(event, text) for event, user, text in log if user == 1]
+    assert user_1 == [("start", "1"), ("end", "1"), ("start", "2"), ("end", "2"), ("start", "3"), ("end", "3")]
+    # Второй пользователь не ждал первого
+    assert log.index(("start", 2, "1")) < log.index(("end", 1, "1"))
+    assert dp.user_queues == {}
+
+
+def test_duplicate_callback_is_answered_and_dropped():
+    dp = bot.OrderedDispatcher()
+    handled = []
+
+    @dp.callback_query()
+    async def on_callback(callback: types.CallbackQuery):
+        handled.append(callback.data)
+        await asyncio.sleep(0.02)
+
+    results = asyncio.run(_feed(dp, [callback_update(1, "like"), callback_update(1, "like"),
+                                     callback_update(1, "dislike")]))
+
+    assert handled == ["like", "dislike"]
+    assert isinstance(results[1], AnswerCallbackQuery)
+    # Нажатие обработано — следующее такое же уже не дубль
+    asyncio.run(_feed(dp, [callback_update(1, "like")]))
+    assert handled == ["like", "dislike", "like"]
+
+
+def test_overflow_notice_is_sent_once_per_episode():
+    dp = bot.OrderedDispatcher(user_queue_limit=2)
+
+    @dp.message()
+    async def on_message(message: types.Message):
+        await asyncio.sleep(0.02)
+
+    results = asyncio.run(_feed(dp, [message_update(1, str(i)) for i in range(5)]))
+    assert results.count(UNHANDLED) == 3
+    assert len(bot.db.outbox) == 1
+
+    # Очередь опустела — новый эпизод переполнения снова предупреждает
+    asyncio.run(_feed(dp, [message_update(1, str(i)) for i in range(3)]))
+    assert len(bot.db.outbox) == 2
+
+
+def test_unknown_update_type_bypasses_user_queues():
+    dp = bot.OrderedDispatcher()
+    update = types.Update.model_validate({"update_id": next(_update_ids)})
+
+    with pytest.warns(RuntimeWarning, match="unknown update type"):
+        result = asyncio.run(_feed(dp, [update]))
+    assert result == [UNHANDLED]
+    assert bot.update_user_id(update) is None
@@ -0,0 +1,224 @@
+"""Планы горячих запросов: ни один не должен читать таблицу целиком (Seq Scan).
+
+Миграции применяются во временной схеме, таблицы заполняются данными, затем каждый
+запрос проходит через EXPLAIN с enable_seqscan = off: Seq Scan в плане остаётся,
+только если подходящего индекса нет.
+"""
+import asyncio
+import json
+import uuid
+
+import asyncpg
+import pytest
+
+import bot
+
+# Запросы из bot.py, которым нужен индекс (в комментарии — метод)
+HOT_QUERIES = {
+    # Database._load_search_queue
+    "load_search_queue": ("""
+        SELECT sq.telegram_id, sq.target_gender, u.gender
+        FROM search_queue sq
+        JOIN users u ON u.telegram_id = sq.telegram_id
+        WHERE u.gender IS NOT NULL
+        ORDER BY sq.joined_at ASC
+    """, ()),
+    # Database._load_profile
+    "load_profile": ("""
+        SELECT id, telegram_id, username, first_name, gender, age
+        FROM users WHERE telegram_id = $1
+    """, (1000010,)),
+    # commit_match: сессия пары в любом порядке
+    "commit_match_session": ("""
+        SELECT id FROM chat_sessions
+        WHERE (user1_id = $1 AND user2_id = $2)
+           OR (user1_id = $2 AND user2_id = $1)
+        ORDER BY created_at DESC
+        LIMIT 1
+    """, (10, 11)),
+    # find_last_partner
+    "find_last_partner": ("""
+        SELECT cs.id,
+               CASE
+                   WHEN cs.user1_id = $1 THEN u2.telegram_id
+                   ELSE u1.telegram_id
+               END as partner_id
+        FROM chat_sessions cs
+        JOIN users u1 ON cs.user1_id = u1.id
+        JOIN users u2 ON cs.user2_id = u2.id
+        WHERE (cs.user1_id = $1 OR cs.user2_id = $1)
+        AND cs.ended_at IS NOT NULL
+        ORDER BY cs.ended_at DESC
+        LIMIT 1
+    """, (10,)),
+    # Database.end_chat: остались ли соединения с сессией
+    "end_chat_remaining": ("""
+        SELECT COUNT(*) as count FROM active_chats
+        WHERE session_id = $1
+    """, (5,)),
+    # Database.get_route: группа пользователя
+    "get_route_group": ("""
+        SELECT gcm.group_id,
+               ARRAY(SELECT m.telegram_id FROM group_chat_members m
+                     WHERE m.group_id = gcm.group_id) AS members
+        FROM group_chat_members gcm
+        JOIN group_chats gc ON gc.id = gcm.group_id
+        WHERE gcm.telegram_id = $1
+          AND gc.is_active = TRUE
+        LIMIT 1
+    """, (1000010,)),
+    # Database.get_route: собеседник 1-на-1
+    "get_route_chat": ("""
+        SELECT partner_telegram_id, session_id FROM active_chats
+        WHERE telegram_id = $1
+    """, (1000010,)),
+    # Database.has_open_group
+    "has_open_group": ("""
+        SELECT 1
+        FROM group_chats
+        WHERE is_active = TRUE AND member_count = 2
+        LIMIT 1
+    """, ()),
+    # Database.get_group_search_queue
+    "group_search_queue": ("""
+        SELECT gsq.telegram_id, gsq.target_gender, u.gender
+        FROM group_search_queue gsq
+        JOIN users u ON u.telegram_id = gsq.telegram_id
+        ORDER BY gsq.joined_at ASC
+    """, ()),
+    # Database.get_user_rating_stats
+    "user_rating_stats": ("""
+        SELECT
+            COUNT(CASE WHEN rating = 1 THEN 1 END) as likes,
+            COUNT(CASE WHEN rating = -1 THEN 1 END) as dislikes,
+            COUNT(CASE WHEN complaint IS NOT NULL THEN 1 END) as complaints
+        FROM user_ratings
+        WHERE rated_user_id = $1
+    """, (10,)),
+    # Database.get_premium_expires
+    "premium_expires": ("""
+        SELECT expires_at FROM premium
+        WHERE telegram_id = $1 AND is_active = TRUE
+    """, (1000010,)),
+    # Database.reconcile_stats: активные группы и премиум
+    "reconcile_groups": ("""
+        SELECT id, member_count FROM group_chats
+        WHERE is_active = TRUE AND member_count >= 2
+    """, ()),
+    "reconcile_premium": ("""
+        SELECT telegram_id, expires_at FROM premium
+        WHERE is_active = TRUE AND expires_at > CURRENT_TIMESTAMP
+    """, ()),
+}
+
+SEED = [
+    """
+    INSERT INTO users (telegram_id, username, first_name, gender, created_at)
+    SELECT 1000000 + i, 'user' || i, 'User', CASE WHEN i % 2 = 0 THEN 'male' ELSE 'female' END,
+           CURRENT_TIMESTAMP - make_interval(hours => i % 72)
+    FROM generate_series(1, 5000) AS i
+    """,
+    """
+    INSERT INTO search_queue (telegram_id, target_gender, joined_at)
+    SELECT 1000000 + i, CASE i % 3 WHEN 0 THEN NULL WHEN 1 THEN 'male' ELSE 'female' END,
+           CURRENT_TIMESTAMP - make_interval(secs => i)
+    FROM generate_series(1, 5000, 10) AS i
+    """,
+    """
+    INSERT INTO group_search_queue (telegram_id, target_gender, joined_at)
+    SELECT 1000000 + i, CASE WHEN i % 2 = 0 THEN NULL ELSE 'female' END,
+           CURRENT_TIMESTAMP - make_interval(secs => i)
+    FROM generate_series(3, 5000, 10) AS i
+    """,
+    """
+    INSERT INTO chat_sessions (user1_id, user2_id, created_at, ended_at)
+    SELECT i, i + 1, CURRENT_TIMESTAMP - make_interval(mins => i),
+           CASE WHEN i % 5 = 0 THEN NULL ELSE CURRENT_TIMESTAMP - make_interval(secs => i) END
+    FROM generate_series(1, 4998) AS i
+    """,
+    """
+    INSERT INTO active_chats (telegram_id, partner_telegram_id, session_id)
+    SELECT 1000000 + i, 1000000 + i + 1, i
+    FROM generate_series(5, 4995, 5) AS i
+    """,
+    """
+    INSERT INTO group_chats (created_at, is_active)
+    SELECT CURRENT_TIMESTAMP - make_interval(mins => i), i % 10 = 0
+    FROM generate_series(1, 2000) AS i
+    """,
+    """
+    INSERT INTO group_chat_members (group_id, telegram_id)
+    SELECT (i - 1) / 2 + 1, 1000000 + i
+    FROM generate_series(1, 4000) AS i
+    """,
+    """
+    INSERT INTO user_ratings (rater_user_id, rated_user_id, session_id, rating)
+    SELECT i, i + 1, i, CASE WHEN i % 2 = 0 THEN 1 ELSE -1 END
+    FROM generate_series(1, 4998) AS i
+    """,
+    """
+    INSERT INTO premium (telegram_id, stars_paid, duration_days, expires_at, is_active)
+    SELECT 1000000 + i, 99, 7, CURRENT_TIMESTAMP + make_interval(days => i % 14 - 7), i % 4 = 0
+    FROM generate_series(1, 5000, 3) AS i
+    """,
+]
+
+
+async def _prepare(dsn: str, schema: str):
+    conn = await asyncpg.connect(dsn)
+    try:
+        await conn.execute(f'CREATE SCHEMA "{schema}"')
+    finally:
+        await conn.close()
+
+    database = bot.Database()
+    database.pool = await asyncpg.create_pool(dsn, min_size=1, max_size=2,
+                                              server_settings={'search_path': schema})
+    try:
+        await database._migrate()
+        async with database.pool.acquire() as conn:
+            for statement in SEED:
+                await conn.execute(statement)
+            await conn.execute("ANALYZE")
+    finally:
+        await database.pool.close()
+
+
+async def _drop(dsn: str, schema: str):
+    conn = await asyncpg.connect(dsn)
+    try:
+        await conn.execute(f'DROP SCHEMA IF EXISTS "{schema}" CASCADE')
+    finally:
+        await conn.close()
+
+
+async def _explain(dsn: str, schema: str, query: str, args: tuple) -> dict:
+    conn = await asyncpg.connect(dsn, server_settings={'search_path': schema})
+    try:
+        await conn.execute("SET enable_seqscan = off")
+        plan = await conn.fetchval(f"EXPLAIN (FORMAT JSON) {query}", *args)
+    finally:
+        await conn.close()
+    return json.loads(plan)[0]['Plan']
+
+
+def _seq_scans(plan: dict) -> list:
+    found = [plan['Relation Name']] if plan['Node Type'] == 'Seq Scan' else []
+    for child in plan.get('Plans', []):
+        found.extend(_seq_scans(child))
+    return found
+
+
+@pytest.fixture(scope="module")
+def schema(database_url):
+    name = f"test_plans_{uuid.uuid4().hex[:8]}"
+    asyncio.run(_prepare(database_url, name))
+    yield name
+    asyncio.run(_drop(database_url, name))
+
+
+@pytest.mark.parametrize("name", sorted(HOT_QUERIES))
+def test_hot_query_uses_index(database_url, schema, name):
+    query, args = HOT_QUERIES[name]
+    plan = asyncio.run(_explain(database_url, schema, query, args))
+    assert _seq_scans(plan) == [], f"{name}: Seq Scan по {_seq_scans(plan)}"
@@ -0,0 +1,82 @@
+"""Отпечатки SQL-запросов и статистика по ним: нормализация литералов и пробелов, p99, /metrics"""
+import bot
+
+
+def test_literals_become_placeholders():
+    assert bot.fingerprint_query(
+        "SELECT * FROM users WHERE gender = 'male' AND age > 18 AND score < 2.5"
+    ) == "SELECT * FROM users WHERE gender = ? AND age > ? AND score < ?"
+    # Кавычка внутри строки экранирована удвоением
+    assert bot.fingerprint_query("SELECT 'it''s', 'x'") == "SELECT ?, ?"
+    assert bot.fingerprint_query(
+        "SELECT 1 FROM users WHERE created_at >= CURRENT_TIMESTAMP - INTERVAL '24 hours'"
+    ) == "SELECT ? FROM users WHERE created_at >= CURRENT_TIMESTAMP - INTERVAL ?"
+
+
+def test_parameters_and_identifiers_are_kept():
+    assert bot.fingerprint_query(
+        "SELECT user1_id, user2_id FROM chat_sessions WHERE id = $1 OR id = $12 LIMIT 10"
+    ) == "SELECT user1_id, user2_id FROM chat_sessions WHERE id = $1 OR id = $12 LIMIT ?"
+
+
+def test_whitespace_is_collapsed():
+    query = """
+        SELECT id
+        FROM   group_chats
+        WHERE\tis_active = TRUE
+    """
+    assert bot.fingerprint_query(query) == "SELECT id FROM group_chats WHERE is_active = TRUE"
+
+
+def test_same_shape_queries_share_a_fingerprint():
+    stats = bot.QueryStats()
+    stats.record("SELECT * FROM premium WHERE telegram_id = 1", 0.01, 1)
+    stats.record("SELECT *  FROM premium\n WHERE telegram_id = 2", 0.03, 0, failed=True)
+
+    [(fingerprint, stat)] = stats.top()
+    assert fingerprint == "SELECT * FROM premium WHERE telegram_id = ?"
+    assert (stat.calls, stat.errors, stat.rows) == (2, 1, 1)
+    assert abs(stat.total_seconds - 0.04) < 1e-9
+
+
+def test_p99_uses_nearest_rank():
+    assert bot.quantile([], 0.99) == 0.0
+    assert bot.quantile([5.0], 0.99) == 5.0
+    assert bot.quantile(list(range(1, 101)), 0.99) == 99
+    assert bot.quantile(list(range(1, 101)), 0.07) == 7
+    assert bot.quantile(list(range(1, 1001)), 0.99) == 990
+    assert bot.quantile(list(range(1, 11)), 0.5) == 5
+
+
+def test_p99_window_keeps_recent_calls_only():
+    stats = bot.QueryStats(window=100)
+    for i in range(1, 101):
+        stats.record("SELECT 1", i / 1000, 1)
+    assert stats.top()[0][1].p99() == 0.099
+
+    # Старые медленные вызовы вытесняются из окна
+    for _ in range(100):
+        stats.record("SELECT 1", 0.001, 1)
+    assert stats.top()[0][1].p99() == 0.001
+
+
+def test_top_orders_by_requested_column():
+    stats = bot.QueryStats()
+    for _ in range(3):
+        stats.record("SELECT a FROM t", 0.001, 10)
+    stats.record("SELECT b FROM t", 0.5, 1)
+
+    assert [fingerprint for fingerprint, _ in stats.top(order="calls")] == ["SELECT a FROM t", "SELECT b FROM t"]
+    assert [fingerprint for fingerprint, _ in stats.top(order="total")] == ["SELECT b FROM t", "SELECT a FROM t"]
+    assert [fingerprint for fingerprint, _ in stats.top(limit=1, order="rows")] == ["SELECT a FROM t"]
+
+
+def test_expose_labels_by_fingerprint():
+    stats = bot.QueryStats()
+    stats.record("SELECT * FROM users WHERE first_name = 'Bob'", 0.25, 1)
+
+    lines = stats.expose()
+    assert 'bot_db_query_calls_total{query="SELECT * FROM users WHERE first_name = ?"} 1' in lines
+    assert 'bot_db_query_p99_seconds{query="SELECT * FROM users WHERE first_name = ?"} 0.25' in lines
+    # Значения литералов в метки не попадают
+    assert not any("Bob" in line for line in lines)
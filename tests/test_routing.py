@@ -0,0 +1,56 @@
+"""Таблица маршрутов: сброс маршрута пользователя снимает и маршруты всех, кто пересылает ему"""
+import bot
+
+
+def test_pair_routes_point_at_each_other():
+    routes = bot.RoutingTable()
+    routes.set_pair(1, 2, session_id=10)
+    assert routes.get(1).partners == [2]
+    assert routes.get(2).partners == [1]
+    assert routes.get(1).session_id == routes.get(2).session_id == 10
+
+
+def test_invalidate_drops_partner_routes():
+    routes = bot.RoutingTable()
+    routes.set_pair(1, 2, session_id=10)
+    routes.set_pair(3, 4, session_id=11)
+
+    routes.invalidate(1)
+    assert routes.get(1) is None
+    assert routes.get(2) is None
+    # Чужая пара не затронута
+    assert routes.get(3).partners == [4]
+    assert len(routes) == 2
+
+
+def test_invalidate_drops_routes_pointing_at_uncached_user():
+    routes = bot.RoutingTable()
+    # B и C пересылают A, маршрута самого A в памяти нет (промах get_route ещё не случился)
+    routes.set(2, bot.ChatRoute([1, 3], group_id=7))
+    routes.set(3, bot.ChatRoute([1, 2], group_id=7))
+    routes.set(4, bot.ChatRoute([5], session_id=12))
+
+    routes.invalidate(1)
+    assert routes.get(2) is None
+    assert routes.get(3) is None
+    assert routes.get(4).partners == [5]
+
+
+def test_invalidate_group_member_drops_whole_group():
+    routes = bot.RoutingTable()
+    routes.set_group(7, [1, 2, 3])
+    assert routes.get(2).partners == [1, 3]
+    assert routes.get(2).group_id == 7
+
+    routes.invalidate(2)
+    assert len(routes) == 0
+
+
+def test_replaced_route_stops_watching_old_partner():
+    routes = bot.RoutingTable()
+    routes.set(2, bot.ChatRoute([1], session_id=10))
+    # 2 перешёл в новый чат с 3: маршрут 2 -> 1 заменён и больше не зависит от 1
+    routes.set(2, bot.ChatRoute([3], session_id=11))
+
+    routes.invalidate(1)
+    assert routes.get(2).partners == [3]
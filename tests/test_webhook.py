@@ -0,0 +1,92 @@
+"""Приём обновлений через вебхук: подписанный Update доходит до обработчика, чужой — отклоняется"""
+import asyncio
+import socket
+
+import aiohttp
+import pytest
+from aiogram import Bot
+from aiogram.types import Message
+from aiohttp import web
+
+import bot
+from scripts.post_update import build_update, post_update
+
+SECRET = "test-secret"
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def _serve_and_post(secret: str, text: str):
+    received = asyncio.Queue()
+    dp = bot.OrderedDispatcher()
+
+    @dp.message()
+    async def on_message(message: Message):
+        await received.put(message)
+
+    test_bot = Bot(token="123456:test-token")
+    stop = asyncio.Event()
+    server = asyncio.create_task(bot.run_webhook(test_bot, dp, stop))
+    url = f"http://127.0.0.1:{bot.WEB_SERVER_PORT}{bot.WEBHOOK_PATH}"
+    try:
+        for _ in range(50):
+            try:
+                status = await post_update(url, secret, build_update(user_id=111, text=text))
+                break
+            except aiohttp.ClientConnectionError:
+                # Сервер ещё не поднялся
+                await asyncio.sleep(0.05)
+        try:
+            message = await asyncio.wait_for(received.get(), timeout=2)
+        except asyncio.TimeoutError:
+            message = None
+        return status, message
+    finally:
+        stop.set()
+        await server
+        await test_bot.session.close()
+
+
+@pytest.fixture(autouse=True)
+def local_webhook(monkeypatch):
+    monkeypatch.setattr(bot, "WEBHOOK_SECRET", SECRET)
+    monkeypatch.setattr(bot, "WEBHOOK_URL", None)
+    monkeypatch.setattr(bot, "WEB_SERVER_HOST", "127.0.0.1")
+    monkeypatch.setattr(bot, "WEB_SERVER_PORT", _free_port())
+
+
+def test_signed_update_reaches_handler():
+    status, message = asyncio.run(_serve_and_post(SECRET, "/search"))
+    assert status == 200
+    assert message is not None
+    assert message.from_user.id == 111
+    assert message.text == "/search"
+
+
+def test_wrong_secret_is_rejected():
+    status, message = asyncio.run(_serve_and_post("wrong", "/search"))
+    assert status == 401
+    assert message is None
+
+
+async def _get(app: web.Application, path: str) -> int:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host="127.0.0.1", port=0)
+    await site.start()
+    port = runner.addresses[0][1]
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"http://127.0.0.1:{port}{path}") as response:
+                return response.status
+    finally:
+        await runner.cleanup()
+
+
+def test_metrics_are_not_on_the_public_listener():
+    assert asyncio.run(_get(bot.build_web_app(), "/metrics")) == 404
+    assert asyncio.run(_get(bot.build_metrics_app(), "/metrics")) == 200